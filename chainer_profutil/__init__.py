@@ -4,3 +4,28 @@ from chainer_profutil.profiled_optimizer import create_marked_profile_optimizer
 from chainer_profutil.profiled_optimizer import make_wrapped_link
 
 from chainer_profutil.profiled_optimizer import SyncLevel
+
+from chainer_profutil.profiled_optimizer import current_ranges
+from chainer_profutil.profiled_optimizer import RangeMismatchError
+from chainer_profutil.profiled_optimizer import set_range_mismatch_policy
+
+from chainer_profutil.aggregator import ProfileAggregator
+from chainer_profutil.gc_monitor import GCMonitor
+from chainer_profutil.writer import AsyncEventWriter
+from chainer_profutil.flops import FlopCounter
+from chainer_profutil.fused_update import FusedUpdateHook
+from chainer_profutil.bucketing import GradientBucketer
+from chainer_profutil.loss_scaling import DynamicLossScaler
+from chainer_profutil.updaters import PrefetchingUpdater
+from chainer_profutil.converters import StagingConverter
+from chainer_profutil.converters import BatchPreprocessConverter
+from chainer_profutil.synthetic import SyntheticIterator
+from chainer_profutil.synthetic import SyntheticConverter
+from chainer_profutil.replay import record_batches
+from chainer_profutil.replay import ReplayIterator
+from chainer_profutil.replay import ReplayConverter
+from chainer_profutil.sampler import StackSampler
+from chainer_profutil.flamegraph import RangeFlameGraph
+from chainer_profutil.flamegraph import render_flame_graph
+from chainer_profutil.mark_filter import MarkFilter
+from chainer_profutil.governor import OverheadGovernor
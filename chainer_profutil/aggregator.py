@@ -0,0 +1,314 @@
+import collections
+import math
+import threading
+
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import remove_range_listener
+
+
+_default_phases = ('iteration',
+                   'model.forward',
+                   'model.backward',
+                   'model.update')
+
+
+_warmup_sigmas = 3.0
+
+
+Anomaly = collections.namedtuple(
+    'Anomaly', ('iteration', 'phase', 'duration', 'baseline', 'score'))
+
+
+class _EWMADetector(object):
+    def __init__(self, threshold, alpha, min_samples):
+        self._threshold = threshold
+        self._alpha = alpha
+        self._min_samples = min_samples
+        self._count = 0
+        self._mean = 0.0
+        self._var = 0.0
+
+    def update(self, value):
+        is_anomaly = False
+        baseline = self._mean
+        score = 0.0
+        if self._count >= self._min_samples:
+            std = math.sqrt(self._var)
+            if std > 0.0:
+                score = (value - self._mean) / std
+                is_anomaly = score > self._threshold
+
+        if self._count == 0:
+            self._mean = value
+        else:
+            diff = value - self._mean
+            incr = self._alpha * diff
+            self._mean += incr
+            self._var = (1.0 - self._alpha) * (self._var + diff * incr)
+        self._count += 1
+        return is_anomaly, baseline, score
+
+
+class _MADDetector(object):
+    # 1.4826 * MAD is a consistent estimator of the standard deviation
+    # for normally distributed samples.
+    _mad_scale = 1.4826
+
+    def __init__(self, threshold, window, min_samples):
+        self._threshold = threshold
+        self._min_samples = min_samples
+        self._window = collections.deque(maxlen=window)
+
+    def update(self, value):
+        is_anomaly = False
+        baseline = value
+        score = 0.0
+        if len(self._window) >= self._min_samples:
+            baseline = _median(self._window)
+            mad = _median([abs(v - baseline) for v in self._window])
+            scale = self._mad_scale * mad
+            if scale > 0.0:
+                score = (value - baseline) / scale
+                is_anomaly = score > self._threshold
+        self._window.append(value)
+        return is_anomaly, baseline, score
+
+
+def _detect_warmup(values, window, tolerance):
+    # The steady state is estimated from the latter half of the series,
+    # and the warmup ends after the last window whose median is out of the
+    # band around it. Medians of windows ignore isolated spikes (e.g. GC)
+    # in the steady state.
+    n = len(values)
+    if n < 2 * window:
+        return None
+    tail = values[n // 2:]
+    reference = _median(tail)
+    mad = _median([abs(v - reference) for v in tail])
+    band = max(_warmup_sigmas * _MADDetector._mad_scale * mad,
+               tolerance * reference)
+
+    def is_out(value):
+        return abs(value - reference) > band
+
+    begin = n - window
+    while begin >= 0 and not is_out(_median(values[begin:begin + window])):
+        begin -= 1
+    warmup = max(begin, 0)
+    for i in range(warmup, begin + window):
+        if is_out(values[i]):
+            warmup = i + 1
+    if n - warmup < window:
+        # Not stable yet.
+        return None
+    # A steady drift widens the band, so both halves of the steady state
+    # must also agree.
+    steady = values[warmup:]
+    half = len(steady) // 2
+    if abs(_median(steady[:half]) - _median(steady[half:])) > \
+            tolerance * reference:
+        return None
+    return warmup
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return 0.0
+    mid = n // 2
+    if n % 2 == 1:
+        return values[mid]
+    return 0.5 * (values[mid - 1] + values[mid])
+
+
+class ProfileAggregator(object):
+    """Collects per-iteration durations of marked ranges.
+
+    The aggregator listens to ``range_push``/``range_pop`` and keeps a
+    bounded series of the durations of each phase (``'iteration'``,
+    ``'model.forward'``, ``'model.backward'`` and ``'model.update'`` by
+    default) for every iteration. Each new value is checked online and
+    slow steps are recorded in :attr:`anomalies` with the iteration number
+    and the phase that spiked. Ranges tagged with a micro-batch index
+    (e.g. ``'model.forward#1'``) are summed up into their phase.
+
+    The first iterations are slow because of lazy parameter
+    initialization, memory pool growth and autotuning. With
+    ``warmup='auto'``, the warmup is detected as the iterations before the
+    ``'iteration'`` durations settle. The steady state is estimated from
+    the latter half of the series. The warmup ends after the last window
+    of ``warmup_window`` iterations whose median is out of the band around
+    it. The band is ``warmup_tolerance`` (as a fraction) or three standard
+    deviations (estimated by the median absolute deviation), whichever is
+    larger. While the steady state keeps drifting, the warmup is regarded
+    as not finished. :meth:`summary` reports the warmup and the steady
+    state separately.
+
+    Args:
+        phases: Names of ranges to be collected.
+        max_len: Maximum number of iterations (and anomalies) kept.
+        detector: ``'mad'`` (median absolute deviation over a sliding
+            window) or ``'ewma'`` (exponentially weighted mean/variance).
+        threshold: Score above which a value is regarded as anomalous.
+        window: Window size of the ``'mad'`` detector.
+        alpha: Smoothing factor of the ``'ewma'`` detector.
+        min_samples: Number of values seen before detection starts.
+        warmup: ``'auto'`` to detect the warmup, or the number of warmup
+            iterations.
+        warmup_window: Window size of the warmup detection.
+        warmup_tolerance: Relative deviation from the steady state
+            tolerated after the warmup.
+    """
+
+    def __init__(self,
+                 phases=_default_phases,
+                 max_len=1000,
+                 detector='mad',
+                 threshold=5.0,
+                 window=50,
+                 alpha=0.1,
+                 min_samples=10,
+                 warmup='auto',
+                 warmup_window=10,
+                 warmup_tolerance=0.1):
+        if 'iteration' not in phases:
+            raise ValueError('phases must contain \'iteration\'.')
+        if detector not in ('mad', 'ewma'):
+            raise ValueError('Unexpected detector: {}'.format(detector))
+        if max_len <= 0:
+            raise ValueError('max_len must be positive.')
+        if warmup != 'auto' and not (isinstance(warmup, int) and warmup >= 0):
+            raise ValueError(
+                'warmup must be \'auto\' or a non-negative integer.')
+        if warmup_window <= 0:
+            raise ValueError('warmup_window must be positive.')
+
+        self._phases = tuple(phases)
+        self._iterations = collections.deque(maxlen=max_len)
+        self._series = {phase: collections.deque(maxlen=max_len)
+                        for phase in self._phases}
+        if detector == 'mad':
+            self._detectors = {
+                phase: _MADDetector(threshold, window, min_samples)
+                for phase in self._phases}
+        else:
+            self._detectors = {
+                phase: _EWMADetector(threshold, alpha, min_samples)
+                for phase in self._phases}
+        self._warmup = warmup
+        self._warmup_window = warmup_window
+        self._warmup_tolerance = warmup_tolerance
+        self.anomalies = collections.deque(maxlen=max_len)
+        self.iteration = 0
+
+        self._lock = threading.Lock()
+        self._current = {}
+
+    def attach(self):
+        add_range_listener(self)
+        return self
+
+    def detach(self):
+        remove_range_listener(self)
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.detach()
+
+    @property
+    def phases(self):
+        return self._phases
+
+    def range_pushed(self, msg, timestamp):
+        pass
+
+    def range_popped(self, msg, start, end):
+        # Ranges of micro-batches (e.g. 'model.forward#1') are summed up.
+        msg = msg.partition('#')[0]
+        if msg not in self._series:
+            return
+        with self._lock:
+            self._current[msg] = self._current.get(msg, 0.0) + (end - start)
+            if msg == 'iteration':
+                self._finish_iteration()
+
+    def _finish_iteration(self):
+        self.iteration += 1
+        self._iterations.append(self.iteration)
+        for phase in self._phases:
+            duration = self._current.get(phase, 0.0)
+            self._series[phase].append(duration)
+            is_anomaly, baseline, score = \
+                self._detectors[phase].update(duration)
+            if is_anomaly:
+                self.anomalies.append(Anomaly(
+                    self.iteration, phase, duration, baseline, score))
+        self._current = {}
+
+    def iterations(self):
+        return list(self._iterations)
+
+    def series(self, phase):
+        return list(self._series[phase])
+
+    def warmup_iterations(self):
+        """Returns the number of warmup iterations in the kept series.
+
+        It returns ``None`` if the durations have not settled yet (or too
+        few iterations are kept to tell).
+        """
+        with self._lock:
+            values = list(self._series['iteration'])
+        if self._warmup == 'auto':
+            return _detect_warmup(values, self._warmup_window,
+                                  self._warmup_tolerance)
+        # The series may have dropped some of the warmup iterations.
+        dropped = self.iteration - len(values)
+        return min(max(self._warmup - dropped, 0), len(values))
+
+    def summary(self, part='all'):
+        """Returns statistics of each phase.
+
+        Args:
+            part: ``'all'`` for all kept iterations, ``'warmup'`` or
+                ``'steady'`` for the iterations before or after the
+                warmup, or ``'split'`` for a dict with the number of warmup
+                iterations (``None`` if not detected yet) and the
+                statistics of both parts.
+        """
+        if part not in ('all', 'warmup', 'steady', 'split'):
+            raise ValueError('Unexpected part: {}'.format(part))
+        if part == 'all':
+            return self._summarize(0, None)
+        warmup = self.warmup_iterations()
+        if part == 'split':
+            if warmup is None:
+                return {'warmup_iterations': None, 'warmup': {},
+                        'steady': {}}
+            return {'warmup_iterations': warmup,
+                    'warmup': self._summarize(0, warmup),
+                    'steady': self._summarize(warmup, None)}
+        if warmup is None:
+            # The steady state has not been reached yet.
+            return self._summarize(0, None) if part == 'warmup' else {}
+        if part == 'warmup':
+            return self._summarize(0, warmup)
+        return self._summarize(warmup, None)
+
+    def _summarize(self, begin, end):
+        ret = {}
+        for phase in self._phases:
+            values = list(self._series[phase])[begin:end]
+            if not values:
+                continue
+            ret[phase] = {
+                'count': len(values),
+                'mean': sum(values) / len(values),
+                'median': _median(values),
+                'min': min(values),
+                'max': max(values),
+            }
+        return ret
@@ -0,0 +1,231 @@
+import queue
+import threading
+
+from chainer.backends import cuda
+from chainer import function_hook
+
+from chainer_profutil.profiled_optimizer import time_range
+
+
+_sentinel = object()
+
+
+class _Bucket(object):
+    def __init__(self, index):
+        self.index = index
+        self.params = []
+        self.nbytes = 0
+        self.pending = 0
+
+
+class GradientBucketer(function_hook.FunctionHook):
+    """Allreduces gradients in buckets while backward is running.
+
+    Parameters are grouped into buckets of at most ``bucket_bytes`` bytes
+    in the reverse order of their paths, which is roughly the order in
+    which backward produces their gradients for sequentially named
+    layers. While hooked into forward, the bucketer counts the functions
+    consuming each parameter. In backward, a parameter is ready when all
+    of its consumers have been backpropagated, and a bucket is handed off
+    to a communication thread as soon as all of its parameters (and all
+    previous buckets) are ready. The communication thread averages each
+    bucket over all processes by ``communicator.allreduce``, recording it
+    as an ``'allreduce.bucket<k>'`` range.
+
+    Buckets are always launched in the same order, so all processes issue
+    the same sequence of allreduce calls. The communicator must allow
+    calls from a thread other than the main one (e.g. MPI initialized
+    with ``MPI_THREAD_SERIALIZED`` or higher).
+
+    Give an instance to ``create_marked_profile_optimizer`` together with a
+    multi-node optimizer as ``grad_bucketer``.
+
+    Args:
+        communicator: Object with a ``size`` attribute and an
+            ``allreduce(array)`` method returning the elementwise sum
+            over all processes, e.g. a ChainerMN communicator.
+        bucket_bytes: Maximum size of a bucket in bytes.
+    """
+
+    name = 'GradientBucketer'
+
+    def __init__(self, communicator, bucket_bytes=25 * 1024 * 1024):
+        if bucket_bytes <= 0:
+            raise ValueError('bucket_bytes must be positive.')
+        self._communicator = communicator
+        self._bucket_bytes = bucket_bytes
+
+        self._link = None
+        self._signature = None
+        self._buckets = []
+        self._array_to_index = {}
+        self._node_to_index = {}
+        self._param_bucket = []
+        self._consumers = []
+        self._counting = False
+        self._next = 0
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._error = None
+
+    @property
+    def n_buckets(self):
+        return len(self._buckets)
+
+    def _build(self, link):
+        # Parameters are sorted by their paths so that all processes make
+        # the same buckets.
+        params = [p for _, p in sorted(link.namedparams())
+                  if p.array is not None]
+        signature = tuple(id(p.array) for p in params)
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        self._buckets = []
+        # Parameters are found by their arrays in forward and by their
+        # nodes in backward, where inputs not retained are None.
+        self._array_to_index = {}
+        self._node_to_index = {}
+        self._param_bucket = []
+        bucket = None
+        for param in reversed(params):
+            nbytes = param.array.nbytes
+            if bucket is None or \
+                    bucket.params[0].array.dtype != param.array.dtype or \
+                    (bucket.nbytes + nbytes > self._bucket_bytes and
+                     bucket.params):
+                bucket = _Bucket(len(self._buckets))
+                self._buckets.append(bucket)
+            bucket.params.append(param)
+            bucket.nbytes += nbytes
+            self._array_to_index[id(param.array)] = len(self._param_bucket)
+            self._node_to_index[id(param.node)] = len(self._param_bucket)
+            self._param_bucket.append(bucket)
+        return True
+
+    def start(self, link):
+        """Prepares the buckets for an iteration of ``link``.
+
+        It must be called before forward. Buckets not launched in the
+        previous iteration (e.g. forward without backward in evaluation)
+        are discarded.
+        """
+        self.wait()
+        self._link = link
+        self._build(link)
+        self._consumers = [0] * len(self._param_bucket)
+        self._counting = True
+        for bucket in self._buckets:
+            bucket.pending = 0
+        self._next = 0
+
+    def forward_preprocess(self, function, in_data):
+        if not self._counting:
+            # Functions applied in backward do not consume parameters.
+            return
+        for x in in_data:
+            i = self._array_to_index.get(id(x))
+            if i is None:
+                continue
+            if self._consumers[i] == 0:
+                self._param_bucket[i].pending += 1
+            self._consumers[i] += 1
+
+    def backward_preprocess(self, function, in_data, out_grad):
+        # Gradients of parameters whose last consumer has just been
+        # backpropagated are set after backward_postprocess, so ready
+        # buckets are launched here (and in finish()).
+        self._counting = False
+        self._launch_ready()
+
+    def backward_postprocess(self, function, in_data, out_grad):
+        for node in function.inputs:
+            i = self._node_to_index.get(id(node))
+            if i is None or self._consumers[i] == 0:
+                continue
+            self._consumers[i] -= 1
+            if self._consumers[i] == 0:
+                self._param_bucket[i].pending -= 1
+
+    def _launch_ready(self):
+        while self._next < len(self._buckets) and \
+                self._buckets[self._next].pending == 0:
+            self._launch(self._buckets[self._next])
+            self._next += 1
+
+    def _launch(self, bucket):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='GradientBucketer')
+            self._thread.daemon = True
+            self._thread.start()
+        self._queue.put(bucket)
+
+    def finish(self):
+        """Launches all remaining buckets. It must be called after backward.
+
+        Parameters initialized during forward (e.g. ``Linear(None, n)``) are
+        bucketed here in the first iteration. Then all buckets are launched
+        again after the ones launched during backward, whose gradients are
+        already averaged, have finished.
+        """
+        if self._link is None:
+            return
+        if self._build(self._link):
+            self.wait()
+            self._next = 0
+        self._link = None
+        for bucket in self._buckets[self._next:]:
+            self._launch(bucket)
+        self._next = len(self._buckets)
+
+    def wait(self):
+        """Waits for all launched allreduces and re-raises their error."""
+        if self._thread is not None:
+            self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_sentinel)
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while True:
+            bucket = self._queue.get()
+            try:
+                if bucket is _sentinel:
+                    return
+                if self._error is None:
+                    with time_range('allreduce.bucket{}'.format(
+                            bucket.index)):
+                        self._allreduce(bucket)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _allreduce(self, bucket):
+        params = bucket.params
+        head = params[0].array
+        xp = cuda.get_array_module(head)
+        with cuda.get_device_from_array(head):
+            grads = []
+            for param in params:
+                grad = param.grad
+                if grad is None:
+                    grad = xp.zeros_like(param.array)
+                grads.append(grad.ravel())
+            flat = self._communicator.allreduce(xp.concatenate(grads))
+            flat = flat * (1.0 / self._communicator.size)
+            flat = flat.astype(head.dtype, copy=False)
+            offset = 0
+            for param in params:
+                size = param.array.size
+                param.grad = flat[offset:offset + size].reshape(
+                    param.array.shape)
+                offset += size
@@ -0,0 +1,183 @@
+import numpy
+
+from chainer.backends import cuda
+
+
+class _Slot(object):
+    # A host buffer and, on GPU, the device buffer it is copied to and the
+    # event recorded after the copy.
+
+    def __init__(self, host, device_array=None):
+        self.host = host
+        self.device_array = device_array
+        self.event = None
+
+
+def _check_shape(i, x, shape):
+    # Assigning to a buffer would broadcast mismatched examples.
+    if numpy.shape(x) != shape:
+        raise ValueError(
+            'example {} has shape {}, but {} is expected'.format(
+                i, numpy.shape(x), shape))
+
+
+class StagingConverter(object):
+    """``concat_examples`` filling reused (pinned) batch buffers in place.
+
+    The converter keeps ``n_buffers`` batch buffers for each combination of
+    shape and dtype and uses them in turn, so no array is allocated once
+    every buffer has been used. Examples are copied into a host buffer in
+    place. When ``device`` is a GPU, host buffers are allocated in
+    page-locked memory and copied to reused device buffers asynchronously
+    on the current stream. A host buffer is refilled only after its
+    previous copy has finished.
+
+    Returned arrays are overwritten ``n_buffers`` calls later, so
+    ``n_buffers`` must not be less than the number of batches alive at
+    once. With ``PrefetchingUpdater``, it is ``depth + 2``: one batch in
+    training, ``depth`` batches queued and one being converted. Like
+    ``concat_examples``, it raises ``ValueError`` if examples have
+    different shapes. Unlike ``concat_examples``, padding is not
+    supported.
+
+    Args:
+        n_buffers: Number of buffers for each shape and dtype.
+    """
+
+    def __init__(self, n_buffers=2):
+        if n_buffers <= 0:
+            raise ValueError('n_buffers must be positive.')
+        self._n_buffers = n_buffers
+        self._slots = {}
+        self.n_calls = 0
+        self.n_allocations = 0
+        self.allocated_bytes = 0
+
+    def __call__(self, batch, device=None):
+        if len(batch) == 0:
+            raise ValueError('batch is empty')
+        self.n_calls += 1
+        first = batch[0]
+        if isinstance(first, tuple):
+            return tuple(self._concat([example[i] for example in batch],
+                                      device)
+                         for i in range(len(first)))
+        elif isinstance(first, dict):
+            return dict((key, self._concat([example[key] for example in batch],
+                                           device))
+                        for key in first)
+        else:
+            return self._concat(batch, device)
+
+    def stats(self):
+        return {
+            'calls': self.n_calls,
+            'allocations': self.n_allocations,
+            'allocated_bytes': self.allocated_bytes,
+        }
+
+    def _concat(self, arrays, device):
+        head = numpy.asarray(arrays[0])
+        slot = self._acquire((len(arrays),) + head.shape, head.dtype, device)
+        host = slot.host
+        for i, x in enumerate(arrays):
+            _check_shape(i, x, head.shape)
+            host[i] = x
+        return self._send(slot, device)
+
+    def _acquire(self, shape, dtype, device):
+        # Returns a slot whose host buffer can be filled.
+        on_gpu = device is not None and device >= 0
+        slot = self._get_slot(shape, numpy.dtype(dtype),
+                              device if on_gpu else None)
+        if slot.event is not None:
+            # The previous copy from this host buffer may be in flight.
+            slot.event.synchronize()
+        return slot
+
+    def _send(self, slot, device):
+        if slot.device_array is None:
+            return slot.host
+        with cuda.get_device_from_id(device):
+            # The copy from the page-locked buffer is asynchronous only if
+            # a stream is given. The consumer of the batch is ordered after
+            # it on the same stream.
+            stream = cuda.cupy.cuda.get_current_stream()
+            slot.device_array.set(slot.host, stream=stream)
+            slot.event = cuda.cupy.cuda.Event()
+            slot.event.record(stream)
+        return slot.device_array
+
+    def _get_slot(self, shape, dtype, device):
+        key = (shape, dtype, device)
+        entry = self._slots.get(key)
+        if entry is None:
+            entry = [[], 0]
+            self._slots[key] = entry
+        slots, index = entry
+        if len(slots) < self._n_buffers:
+            slots.append(self._allocate(shape, dtype, device))
+            index = len(slots) - 1
+        else:
+            index = (index + 1) % self._n_buffers
+        entry[1] = index
+        return slots[index]
+
+    def _allocate(self, shape, dtype, device):
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+        self.n_allocations += 1
+        self.allocated_bytes += nbytes
+        if device is None:
+            return _Slot(numpy.empty(shape, dtype=dtype))
+
+        cupy = cuda.cupy
+        memory = cupy.cuda.alloc_pinned_memory(nbytes)
+        host = numpy.frombuffer(memory, dtype, int(numpy.prod(shape)))
+        host = host.reshape(shape)
+        with cuda.get_device_from_id(device):
+            device_array = cupy.empty(shape, dtype=dtype)
+        self.n_allocations += 1
+        self.allocated_bytes += nbytes
+        return _Slot(host, device_array)
+
+
+class BatchPreprocessConverter(StagingConverter):
+    """Subtracts the mean from cropped images while concatenating them.
+
+    Examples are ``(image, label, top, left)`` tuples, where ``image`` is a
+    (C, H, W) crop (possibly flipped) taken at ``(top, left)`` from an
+    image of the size of ``mean``. Each crop is copied into a reused
+    float32 batch buffer, and the crop of ``mean`` at the same offset is
+    subtracted from it in place. Then the whole batch is scaled at once.
+    So ``MultiprocessIterator`` workers only decode and crop images, and
+    assembling a batch allocates no temporary array.
+
+    Buffers are reused and sent to the device as in
+    :class:`StagingConverter`.
+
+    Args:
+        mean: (C, H, W) mean image.
+        scale: Factor the batch is multiplied by after the subtraction.
+        n_buffers: Number of buffers for each shape and dtype.
+    """
+
+    def __init__(self, mean, scale=1.0 / 255.0, n_buffers=2):
+        super(BatchPreprocessConverter, self).__init__(n_buffers=n_buffers)
+        self._mean = numpy.asarray(mean, dtype=numpy.float32)
+        self._scale = scale
+
+    def __call__(self, batch, device=None):
+        if len(batch) == 0:
+            raise ValueError('batch is empty')
+        self.n_calls += 1
+        c, h, w = batch[0][0].shape
+        slot = self._acquire((len(batch), c, h, w), numpy.float32, device)
+        images = slot.host
+        mean = self._mean
+        for k, (image, _, top, left) in enumerate(batch):
+            _check_shape(k, image, (c, h, w))
+            images[k] = image
+            images[k] -= mean[:, top:top + h, left:left + w]
+        images *= self._scale
+        labels = self._concat([example[1] for example in batch], device)
+        return self._send(slot, device), labels
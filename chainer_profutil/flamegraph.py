@@ -0,0 +1,236 @@
+import collections
+import threading
+import zlib
+
+from xml.sax import saxutils
+
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import remove_range_listener
+
+
+_frame_height = 16
+_font_size = 12
+# Approximate width of a character of the font in pixels.
+_char_width = 7
+
+
+class _Node(object):
+    def __init__(self, name):
+        self.name = name
+        self.value = 0.0
+        self.children = collections.OrderedDict()
+
+
+def _build_tree(stacks):
+    root = _Node('all')
+    for stack, value in sorted(stacks.items()):
+        if value <= 0:
+            continue
+        node = root
+        node.value += value
+        for name in stack.split(';'):
+            child = node.children.get(name)
+            if child is None:
+                child = _Node(name)
+                node.children[name] = child
+            node = child
+            node.value += value
+    return root
+
+
+def _depth(node):
+    if not node.children:
+        return 0
+    return 1 + max(_depth(child) for child in node.children.values())
+
+
+def _color(name):
+    # Warm colors stable for each name.
+    h = zlib.crc32(name.encode('utf-8'))
+    return 'rgb({},{},{})'.format(205 + h % 50, (h >> 8) % 230,
+                                  (h >> 16) % 55)
+
+
+def render_flame_graph(stacks, title='', unit='', width=1200):
+    """Renders collapsed stacks as a self-contained SVG flame graph.
+
+    Args:
+        stacks: Dict from collapsed stacks (``'a;b;c'``) to their values,
+            e.g. :meth:`RangeFlameGraph.stacks` or
+            :meth:`StackSampler.counts`.
+        title: Title drawn at the top.
+        unit: Unit of the values shown in tooltips.
+        width: Width of the image in pixels.
+
+    Returns:
+        str: SVG document.
+    """
+    root = _build_tree(stacks)
+    depth = _depth(root) + 1
+    top = 2 * _frame_height
+    height = top + depth * _frame_height
+    rects = []
+
+    def visit(node, x, level):
+        w = node.value / root.value * width if root.value > 0 else width
+        if w < 0.1:
+            return
+        y = height - (level + 1) * _frame_height
+        percent = 100.0 * node.value / root.value if root.value > 0 else 0.0
+        tooltip = '{} ({:g}{}, {:.2f}%)'.format(
+            node.name, node.value, unit, percent)
+        n_chars = int((w - 6) // _char_width)
+        if n_chars >= len(node.name):
+            text = node.name
+        elif n_chars > 2:
+            text = node.name[:n_chars - 2] + '..'
+        else:
+            text = ''
+        rects.append(
+            '<g><title>{}</title>'
+            '<rect x="{:.2f}" y="{}" width="{:.2f}" height="{}" '
+            'fill="{}" rx="2" ry="2"/>'
+            '<text x="{:.2f}" y="{}">{}</text></g>'.format(
+                saxutils.escape(tooltip), x, y, w, _frame_height - 1,
+                _color(node.name), x + 3, y + _frame_height - 4,
+                saxutils.escape(text)))
+        for child in node.children.values():
+            visit(child, x, level + 1)
+            x += child.value / root.value * width
+
+    visit(root, 0.0, 0)
+    return (
+        '<?xml version="1.0" standalone="no"?>\n'
+        '<svg version="1.1" xmlns="http://www.w3.org/2000/svg" '
+        'width="{width}" height="{height}" '
+        'viewBox="0 0 {width} {height}" '
+        'font-family="Verdana, sans-serif" font-size="{font}">\n'
+        '<rect width="100%" height="100%" fill="#f8f8f8"/>\n'
+        '<text x="{center}" y="{title_y}" text-anchor="middle" '
+        'font-size="{title_font}">{title}</text>\n'
+        '{rects}\n'
+        '</svg>\n').format(
+            width=width, height=height, font=_font_size,
+            center=width // 2, title_y=_frame_height + 2,
+            title_font=_font_size + 4, title=saxutils.escape(title),
+            rects='\n'.join(rects))
+
+
+class RangeFlameGraph(object):
+    """Records the hierarchy of ranges for flame graphs.
+
+    The recorder listens to ``range_push``/``range_pop`` and accumulates
+    the self time (the duration minus the durations of nested ranges) of
+    each path of nested ranges, e.g. ``iteration;model.forward;
+    Convolution2DFunction``. Ranges tagged with a micro-batch index
+    (e.g. ``'model.forward#1'``) are folded into their name. Paths of
+    ranges on threads other than the main thread start with the name of
+    the thread.
+
+    Times are kept per iteration, and the last ``window`` iterations are
+    exported as collapsed stacks (in microseconds, for ``flamegraph.pl``)
+    or as a self-contained SVG or HTML flame graph.
+
+    Args:
+        window: Number of iterations aggregated.
+    """
+
+    def __init__(self, window=100):
+        if window <= 0:
+            raise ValueError('window must be positive.')
+        self._iterations = collections.deque(maxlen=window)
+        self._current = collections.Counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.iteration = 0
+
+    def attach(self):
+        add_range_listener(self)
+        return self
+
+    def detach(self):
+        remove_range_listener(self)
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.detach()
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = []
+            thread = threading.current_thread()
+            if thread is not threading.main_thread():
+                stack.append([thread.name, 0.0])
+            self._local.stack = stack
+            self._local.base = len(stack)
+        return stack
+
+    def range_pushed(self, msg, timestamp):
+        # Each entry holds the name and the total time of nested ranges.
+        self._get_stack().append([msg.partition('#')[0], 0.0])
+
+    def range_popped(self, msg, start, end):
+        stack = self._get_stack()
+        if len(stack) <= self._local.base:
+            # The range was pushed before attaching.
+            return
+        path = ';'.join(name for name, _ in stack)
+        _, children = stack.pop()
+        duration = end - start
+        if len(stack) > self._local.base:
+            stack[-1][1] += duration
+        with self._lock:
+            self._current[path] += max(duration - children, 0.0)
+            if msg == 'iteration' and len(stack) == self._local.base:
+                self.iteration += 1
+                self._iterations.append(self._current)
+                self._current = collections.Counter()
+
+    def stacks(self):
+        """Returns a dict from collapsed paths to self times in seconds."""
+        total = collections.Counter()
+        with self._lock:
+            for counts in self._iterations:
+                total.update(counts)
+            if not self._iterations:
+                # No iteration has finished, e.g. without marked optimizer.
+                total.update(self._current)
+        return dict(total)
+
+    def collapsed(self):
+        """Returns collapsed stack text weighted by microseconds."""
+        lines = []
+        for path, seconds in sorted(self.stacks().items()):
+            microseconds = int(round(seconds * 1e6))
+            if microseconds > 0:
+                lines.append('{} {}\n'.format(path, microseconds))
+        return ''.join(lines)
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
+
+    def to_svg(self, title=None, width=1200):
+        if title is None:
+            title = 'Ranges of the last {} iterations'.format(
+                len(self._iterations))
+        stacks = dict((path, seconds * 1e3)
+                      for path, seconds in self.stacks().items())
+        return render_flame_graph(stacks, title=title, unit=' ms',
+                                  width=width)
+
+    def write_svg(self, path, title=None, width=1200):
+        with open(path, 'w') as f:
+            f.write(self.to_svg(title=title, width=width))
+
+    def write_html(self, path, title=None, width=1200):
+        svg = self.to_svg(title=title, width=width)
+        # The XML declaration is not allowed in HTML.
+        svg = svg[svg.index('<svg'):]
+        with open(path, 'w') as f:
+            f.write('<!DOCTYPE html>\n<html><head><meta charset="utf-8">'
+                    '<title>chainer_profutil flame graph</title></head>'
+                    '<body>\n{}</body></html>\n'.format(svg))
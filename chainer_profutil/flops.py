@@ -0,0 +1,265 @@
+import collections
+import threading
+import time
+
+from chainer import function as function_module
+from chainer.utils import conv
+
+
+# Functions are identified by their class names, since labels of some
+# functions depend on their arguments (e.g. '_ * 0.5' of MulConstant).
+
+# Number of floating point operations per output element of elementwise
+# functions.
+_elementwise_ops = {
+    'Add': 1,
+    'AddConstant': 1,
+    'Sub': 1,
+    'SubFromConstant': 1,
+    'Mul': 1,
+    'MulConstant': 1,
+    'Div': 1,
+    'DivFromConstant': 1,
+    'ReLU': 1,
+    'LeakyReLU': 2,
+    'ClippedReLU': 2,
+    'Sigmoid': 4,
+    'Tanh': 4,
+    'Exp': 1,
+    'Log': 1,
+    'Sqrt': 1,
+    'Square': 1,
+    'Dropout': 1,
+    'Cast': 0,
+    'Copy': 0,
+}
+
+# Ratio of the backward cost to the forward cost.
+_backward_factor = {
+    'Convolution2DFunction': 2.0,
+    'LinearFunction': 2.0,
+    'BatchNormalization': 1.5,
+}
+
+
+def _function_name(function):
+    if isinstance(function, function_module.FunctionAdapter):
+        # Old-style Function.
+        function = function.function
+    return type(function).__name__
+
+
+def _nbytes(arrays):
+    return sum(a.nbytes for a in arrays if a is not None)
+
+
+def _convolution_2d(function, in_data):
+    x, W = in_data[:2]
+    n, _, h, w = x.shape
+    out_c, in_c_per_group, kh, kw = W.shape
+    out_h = conv.get_conv_outsize(
+        h, kh, function.sy, function.ph,
+        cover_all=function.cover_all, d=getattr(function, 'dy', 1))
+    out_w = conv.get_conv_outsize(
+        w, kw, function.sx, function.pw,
+        cover_all=function.cover_all, d=getattr(function, 'dx', 1))
+    n_out = n * out_c * out_h * out_w
+    flops = 2 * n_out * in_c_per_group * kh * kw
+    if len(in_data) > 2:
+        flops += n_out
+    return flops, _nbytes(in_data) + n_out * x.dtype.itemsize
+
+
+def _linear(function, in_data):
+    x, W = in_data[:2]
+    n = x.shape[0]
+    out_size, in_size = W.shape
+    flops = 2 * n * in_size * out_size
+    if len(in_data) > 2:
+        flops += n * out_size
+    return flops, _nbytes(in_data) + n * out_size * x.dtype.itemsize
+
+
+def _batch_normalization(function, in_data):
+    x = in_data[0]
+    # Statistics (2 passes), normalization and scaling/shifting.
+    flops = 8 * x.size
+    # Read x twice (statistics and normalization) and write y.
+    return flops, 3 * x.nbytes + _nbytes(in_data[1:])
+
+
+def _fixed_batch_normalization(function, in_data):
+    x = in_data[0]
+    return 4 * x.size, 2 * x.nbytes + _nbytes(in_data[1:])
+
+
+def _pooling_2d(function, in_data):
+    x = in_data[0]
+    n, c, h, w = x.shape
+    out_h = conv.get_conv_outsize(
+        h, function.kh, function.sy, function.ph,
+        cover_all=function.cover_all)
+    out_w = conv.get_conv_outsize(
+        w, function.kw, function.sx, function.pw,
+        cover_all=function.cover_all)
+    n_out = n * c * out_h * out_w
+    flops = n_out * function.kh * function.kw
+    return flops, x.nbytes + n_out * x.dtype.itemsize
+
+
+def _elementwise(ops):
+    def estimate(function, in_data):
+        out = max(in_data, key=lambda a: a.size)
+        return ops * out.size, _nbytes(in_data) + out.nbytes
+    return estimate
+
+
+_estimators = {
+    'Convolution2DFunction': _convolution_2d,
+    'LinearFunction': _linear,
+    'BatchNormalization': _batch_normalization,
+    'FixedBatchNormalization': _fixed_batch_normalization,
+    'MaxPooling2D': _pooling_2d,
+    'AveragePooling2D': _pooling_2d,
+}
+_estimators.update(
+    (name, _elementwise(ops)) for name, ops in _elementwise_ops.items())
+
+
+def estimate_cost(function, in_data, backward=False, out_grad=None):
+    """Estimates FLOPs and bytes moved by a function.
+
+    Returns a tuple ``(flops, bytes)`` estimated from the shapes of
+    ``in_data``, or ``None`` if ``function`` is not supported. Backward
+    costs are approximated from the forward ones.
+    """
+    name = _function_name(function)
+    estimator = _estimators.get(name)
+    if estimator is None:
+        return None
+    in_data = [x for x in in_data if x is not None]
+    if not in_data and out_grad is not None:
+        # Functions retaining only their outputs (e.g. ReLU) have no
+        # inputs in backward, and their gradients have the same shapes.
+        in_data = [gy for gy in out_grad if gy is not None]
+    if not in_data:
+        return None
+    flops, nbytes = estimator(function, in_data)
+    if backward:
+        flops *= _backward_factor.get(name, 1.0)
+        nbytes *= 2
+    return flops, nbytes
+
+
+_Entry = collections.namedtuple('_Entry', ('key', 'layer', 'cost', 'start'))
+
+
+class FlopCounter(object):
+    """Accumulates estimated FLOPs, bytes and elapsed time per function.
+
+    Give an instance to ``create_marked_profile_optimizer`` (or
+    ``FwdBwdProfileMarkHook``) as ``cost_counter``. Elapsed time of each
+    function is measured on the host between the pre/post hooks, so it
+    reflects GPU time only when each function is synchronized (i.e.
+    ``sync_level=SyncLevel.FINEST``).
+
+    Layers are identified by the parameters a function takes, so per-layer
+    results are available for the links registered by
+    :meth:`register_link`.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._signature = None
+        self._param_to_layer = {}
+        self._by_function = {}
+        self._by_layer = {}
+
+    def register_link(self, link):
+        # It is called in every forward, so the map is rebuilt only when
+        # the parameter arrays change (e.g. lazy initialization or to_gpu).
+        signature = (id(link),) + tuple(id(p.array) for p in link.params())
+        if signature == self._signature:
+            return
+        self._signature = signature
+        param_to_layer = {}
+        for path, param in link.namedparams():
+            if param.array is not None:
+                param_to_layer[id(param.array)] = path.rsplit('/', 1)[0]
+        self._param_to_layer = param_to_layer
+
+    def _stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def begin(self, function, in_data, backward=False, out_grad=None):
+        cost = estimate_cost(function, in_data, backward=backward,
+                             out_grad=out_grad)
+        layer = None
+        if cost is not None:
+            for x in in_data:
+                layer = self._param_to_layer.get(id(x))
+                if layer is not None:
+                    break
+        key = (_function_name(function),
+               'backward' if backward else 'forward')
+        self._stack().append(_Entry(key, layer, cost, time.perf_counter()))
+
+    def end(self):
+        stack = self._stack()
+        if not stack:
+            return
+        entry = stack.pop()
+        if entry.cost is None:
+            return
+        elapsed = time.perf_counter() - entry.start
+        flops, nbytes = entry.cost
+        with self._lock:
+            _accumulate(self._by_function, entry.key, elapsed, flops, nbytes)
+            if entry.layer is not None:
+                _accumulate(self._by_layer, (entry.layer, entry.key[1]),
+                            elapsed, flops, nbytes)
+
+    def summary(self):
+        """Returns ``{(class_name, 'forward'|'backward'): stats}``."""
+        with self._lock:
+            return _report(self._by_function)
+
+    def layer_summary(self):
+        """Returns ``{(layer_path, 'forward'|'backward'): stats}``."""
+        with self._lock:
+            return _report(self._by_layer)
+
+    def reset(self):
+        with self._lock:
+            self._by_function = {}
+            self._by_layer = {}
+
+
+def _accumulate(table, key, elapsed, flops, nbytes):
+    stats = table.get(key)
+    if stats is None:
+        stats = [0, 0.0, 0, 0]
+        table[key] = stats
+    stats[0] += 1
+    stats[1] += elapsed
+    stats[2] += flops
+    stats[3] += nbytes
+
+
+def _report(table):
+    ret = {}
+    for key, (count, elapsed, flops, nbytes) in table.items():
+        ret[key] = {
+            'count': count,
+            'time': elapsed,
+            'gflop': flops * 1e-9,
+            'gbyte': nbytes * 1e-9,
+            'gflops': flops * 1e-9 / elapsed if elapsed > 0 else 0.0,
+            'gbps': nbytes * 1e-9 / elapsed if elapsed > 0 else 0.0,
+        }
+    return ret
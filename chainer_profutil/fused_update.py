@@ -0,0 +1,201 @@
+import numpy
+
+from chainer.backends import cuda
+from chainer import optimizers
+
+
+_fused_dtypes = (numpy.float32, numpy.float64)
+
+
+def _momentum_sgd_state_names(hp):
+    return ('v',)
+
+def _adam_state_names(hp):
+    if getattr(hp, 'amsgrad', False) or getattr(hp, 'adabound', False):
+        raise ValueError('AMSGrad and AdaBound are not supported '
+                         'by the fused update.')
+    return ('m', 'v')
+
+_state_names = (
+    (optimizers.MomentumSGD, _momentum_sgd_state_names),
+    (optimizers.Adam, _adam_state_names),
+)
+
+
+class _FlatGroup(object):
+    # Parameters of the same device and dtype, whose arrays, gradients and
+    # states are views into flat buffers.
+
+    def __init__(self, params, state_names):
+        self.params = params
+        self.sizes = [p.array.size for p in params]
+        self.offsets = numpy.cumsum([0] + self.sizes).tolist()
+        total = self.offsets[-1]
+
+        xp = cuda.get_array_module(params[0].array)
+        dtype = params[0].array.dtype
+        self.xp = xp
+        with cuda.get_device_from_array(params[0].array):
+            self.param = xp.empty(total, dtype=dtype)
+            self.grad = xp.empty(total, dtype=dtype)
+            self.states = dict(
+                (name, xp.empty(total, dtype=dtype)) for name in state_names)
+            self.grads = []
+            for i, p in enumerate(params):
+                rule = p.update_rule
+                if rule.state is None:
+                    rule._state = {}
+                    rule.init_state(p)
+                p.array = self._pack(self.param, i, p.array)
+                p.grad = self._pack(self.grad, i, p.grad)
+                self.grads.append(p.grad)
+                for name, flat in self.states.items():
+                    rule.state[name] = self._pack(flat, i, rule.state[name])
+
+    def _pack(self, flat, i, array):
+        view = flat[self.offsets[i]:self.offsets[i + 1]].reshape(array.shape)
+        view[...] = array
+        return view
+
+    def gather_grads(self):
+        # Backward binds new arrays to the gradients, which are copied into
+        # the flat buffer. Gradients updated in place (e.g. by allreduce of
+        # ChainerMN) are already there.
+        for p, view in zip(self.params, self.grads):
+            if p.grad is not view:
+                view[...] = p.grad
+                p.grad = view
+        return self.grad
+
+
+class FusedUpdateHook(object):
+    """Updates all parameters with a few operations on flat buffers.
+
+    Parameters, gradients and optimizer states are packed into contiguous
+    buffers per device and dtype, and each of them becomes a view into its
+    buffer. The buffers are allocated once. At every update, gradients
+    that backward has bound to new arrays are copied into the flat
+    gradient buffer, and the whole buffer is updated at once, i.e. with
+    vectorized NumPy operations on CPU and a single elementwise kernel on
+    GPU, instead of running an ``UpdateRule`` per parameter.
+
+    Only ``MomentumSGD`` and ``Adam`` are supported, and the hyperparameters
+    of the optimizer are used for all parameters. Hooks called for each
+    parameter (e.g. ``WeightDecay`` in recent Chainer) are not run for the
+    fused parameters. Parameters other than float32/float64 ones are
+    updated by their own update rules from the hook. This includes
+    float16 parameters under ``use_fp32_update``, whose rules keep the
+    float32 master copies.
+
+    Call :meth:`setup` after ``optimizer.setup`` and before adding the
+    hook, and do not move the link to another device after the first
+    update. If ``loss_scaler`` is given, the update is skipped when it has
+    detected an overflow.
+    """
+
+    name = 'FusedUpdate'
+    call_for_each_param = False
+    timing = 'post'
+
+    def __init__(self, loss_scaler=None):
+        self._loss_scaler = loss_scaler
+        self._state_names = None
+        self._signature = None
+        self._groups = []
+
+    def setup(self, optimizer):
+        """Disables the per-parameter update rules of ``optimizer``."""
+        for klass, state_names in _state_names:
+            if isinstance(optimizer, klass):
+                self._state_names = state_names(optimizer.hyperparam)
+                break
+        else:
+            raise ValueError(
+                'Fused update is not supported for {}.'.format(
+                    optimizer.__class__.__name__))
+
+        for param in optimizer.target.params(include_uninit=True):
+            param.update_rule.enabled = False
+
+    def _build(self, params):
+        groups = {}
+        for param in params:
+            key = (cuda.get_device_from_array(param.array).id,
+                   param.array.dtype)
+            groups.setdefault(key, []).append(param)
+        self._groups = [_FlatGroup(group, self._state_names)
+                        for group in groups.values()]
+
+    def __call__(self, optimizer):
+        if self._state_names is None:
+            raise RuntimeError('FusedUpdateHook.setup is not called.')
+        if self._loss_scaler is not None and self._loss_scaler.overflow:
+            return
+
+        params = []
+        for param in optimizer.target.params():
+            if param.grad is None or param.update_rule.enabled:
+                continue
+            if param.dtype in _fused_dtypes:
+                params.append(param)
+            else:
+                # e.g. float16 parameters without fp32 update.
+                param.update_rule.enabled = True
+                param.update()
+                param.update_rule.enabled = False
+        if not params:
+            return
+        signature = tuple(id(p) for p in params)
+        if signature != self._signature:
+            self._build(params)
+            self._signature = signature
+
+        for group in self._groups:
+            for param in group.params:
+                param.update_rule.t += 1
+            with cuda.get_device_from_array(group.param):
+                grad = group.gather_grads()
+                if isinstance(optimizer, optimizers.MomentumSGD):
+                    _momentum_sgd(optimizer, group, grad)
+                else:
+                    _adam(optimizer, group, grad)
+
+
+def _momentum_sgd(optimizer, group, grad):
+    hp = optimizer.hyperparam
+    param, v = group.param, group.states['v']
+    if group.xp is numpy:
+        v *= hp.momentum
+        v -= hp.lr * grad
+        param += v
+    else:
+        cuda.elementwise(
+            'T grad, T lr, T momentum',
+            'T param, T v',
+            '''v = momentum * v - lr * grad;
+               param += v;''',
+            'fused_momentum_sgd')(
+                grad, hp.lr, hp.momentum, param, v)
+
+
+def _adam(optimizer, group, grad):
+    hp = optimizer.hyperparam
+    lr = optimizer.lr
+    param, m, v = group.param, group.states['m'], group.states['v']
+    if group.xp is numpy:
+        m += (1 - hp.beta1) * (grad - m)
+        v += (1 - hp.beta2) * (grad * grad - v)
+        param -= hp.eta * (lr * m / (numpy.sqrt(v) + hp.eps) +
+                           hp.weight_decay_rate * param)
+    else:
+        cuda.elementwise(
+            'T grad, T lr, T one_minus_beta1, T one_minus_beta2, T eps, '
+            'T eta, T weight_decay_rate',
+            'T param, T m, T v',
+            '''m += one_minus_beta1 * (grad - m);
+               v += one_minus_beta2 * (grad * grad - v);
+               param -= eta * (lr * m / (sqrt(v) + eps) +
+                               weight_decay_rate * param);''',
+            'fused_adam')(
+                grad, lr, 1 - hp.beta1, 1 - hp.beta2, hp.eps, hp.eta,
+                hp.weight_decay_rate, param, m, v)
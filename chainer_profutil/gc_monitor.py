@@ -0,0 +1,133 @@
+import collections
+import gc
+import threading
+import time
+
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import current_ranges
+from chainer_profutil.profiled_optimizer import remove_range_listener
+
+
+_default_phases = ('model.forward',
+                   'model.backward',
+                   'model.update')
+
+
+GCEvent = collections.namedtuple(
+    'GCEvent', ('iteration', 'phase', 'generation',
+                'collected', 'uncollectable', 'duration'))
+
+
+class GCMonitor(object):
+    """Records Python garbage collections and attributes them to ranges.
+
+    The monitor hooks ``gc.callbacks`` and records the generation, the
+    number of collected and uncollectable objects and the pause duration
+    of each collection. Each collection is attributed to the innermost
+    enclosing phase (``'model.forward'``, ``'model.backward'`` or
+    ``'model.update'`` by default), to ``'iteration'`` when it happens
+    outside of those phases in an iteration, or to ``'other'``.
+
+    Args:
+        phases: Names of ranges collections are attributed to.
+        max_len: Maximum number of events and iterations kept.
+    """
+
+    def __init__(self, phases=_default_phases, max_len=1000):
+        if max_len <= 0:
+            raise ValueError('max_len must be positive.')
+        self._phases = tuple(phases)
+        self.events = collections.deque(maxlen=max_len)
+        self._per_iteration = collections.deque(maxlen=max_len)
+        self.iteration = 0
+
+        # Reentrant, because a collection may start while the lock is
+        # held by the same thread (e.g. allocating in _finish_iteration).
+        self._lock = threading.RLock()
+        self._current = {}
+        self._gc_start = None
+        self._gc_generation = None
+
+    def attach(self):
+        add_range_listener(self)
+        if self._gc_callback not in gc.callbacks:
+            gc.callbacks.append(self._gc_callback)
+        return self
+
+    def detach(self):
+        if self._gc_callback in gc.callbacks:
+            gc.callbacks.remove(self._gc_callback)
+        remove_range_listener(self)
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.detach()
+
+    def range_pushed(self, msg, timestamp):
+        pass
+
+    def range_popped(self, msg, start, end):
+        if msg == 'iteration':
+            with self._lock:
+                self._finish_iteration()
+
+    def _current_phase(self):
+        ranges = current_ranges()
+        for msg in reversed(ranges):
+            msg = msg.partition('#')[0]
+            if msg in self._phases:
+                return msg
+        if 'iteration' in ranges:
+            return 'iteration'
+        return 'other'
+
+    def _gc_callback(self, phase, info):
+        if phase == 'start':
+            self._gc_start = time.perf_counter()
+            self._gc_generation = info['generation']
+        elif phase == 'stop' and self._gc_start is not None:
+            duration = time.perf_counter() - self._gc_start
+            self._gc_start = None
+            owner = self._current_phase()
+            with self._lock:
+                self.events.append(GCEvent(
+                    self.iteration + 1, owner, self._gc_generation,
+                    info.get('collected', 0), info.get('uncollectable', 0),
+                    duration))
+                self._current[owner] = \
+                    self._current.get(owner, 0.0) + duration
+
+    def _finish_iteration(self):
+        # Collections during the allocations below go to the next
+        # iteration.
+        self.iteration, current, self._current = \
+            self.iteration + 1, self._current, {}
+        self._per_iteration.append((self.iteration, current))
+
+    def per_iteration(self):
+        """Returns a list of ``(iteration, total, {phase: duration})``."""
+        return [(itr, sum(durations.values()), dict(durations))
+                for itr, durations in self._per_iteration]
+
+    def summary(self):
+        total = 0.0
+        by_phase = {}
+        by_generation = {}
+        for event in self.events:
+            total += event.duration
+            by_phase[event.phase] = \
+                by_phase.get(event.phase, 0.0) + event.duration
+            by_generation[event.generation] = \
+                by_generation.get(event.generation, 0) + 1
+        n_iters = len(self._per_iteration)
+        return {
+            'count': len(self.events),
+            'total': total,
+            'per_iteration': (sum(sum(d.values())
+                                  for _, d in self._per_iteration) /
+                              n_iters if n_iters else 0.0),
+            'by_phase': by_phase,
+            'count_by_generation': by_generation,
+        }
@@ -0,0 +1,229 @@
+import collections
+
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import range_overhead
+from chainer_profutil.profiled_optimizer import remove_range_listener
+from chainer_profutil.profiled_optimizer import SyncLevel
+
+
+Change = collections.namedtuple(
+    'Change', ('iteration', 'setting', 'old', 'new', 'overhead'))
+
+
+def _median(values):
+    values = sorted(values)
+    n = len(values)
+    mid = n // 2
+    if n % 2 == 1:
+        return values[mid]
+    return 0.5 * (values[mid - 1] + values[mid])
+
+
+class OverheadGovernor(object):
+    """Keeps the overhead of profiling under a budget.
+
+    The governor listens to the ``'iteration'`` ranges of a marked
+    optimizer and estimates the overhead of profiling over each window of
+    ``window`` iterations as a fraction of the iteration time. The
+    overhead is the sum of
+
+    * the time spent in range push/pop (see ``range_overhead``) and in
+      sampling stacks by ``sampler``, and
+    * the increase of the median iteration time over the one measured at
+      ``SyncLevel.COARSEST``, which is the cost of the finer
+      synchronization and marking. The baseline is measured (calibrated)
+      by running a window at ``COARSEST`` at the beginning and every
+      ``recalibrate`` windows.
+
+    While the governor is attached, functions are marked only at
+    ``SyncLevel.FINEST``, so coarser levels emit only the iteration and
+    phase ranges. Lowering the level thus removes both synchronizations
+    and ranges, and it pays off even with ``sync=False``.
+
+    If the overhead exceeds ``budget``, the governor lowers the
+    granularity, i.e. the synchronization level of the optimizer down to
+    ``COARSEST`` first and then the sampling rate of ``sampler`` by
+    doubling its interval. If the overhead is below ``headroom * budget``,
+    it raises the granularity again in the reverse order up to the initial
+    settings. When raising a setting exceeds the budget again, the next
+    attempt is delayed for exponentially more windows, so the settings do
+    not oscillate.
+
+    Changes are recorded in :attr:`changes`, and the last estimate is
+    :attr:`overhead`.
+
+    Args:
+        optimizer: Optimizer made by ``create_marked_profile_optimizer``.
+        budget: Maximum overhead as a fraction of the iteration time.
+        sampler: ``StackSampler`` whose interval is adjusted.
+        window: Number of iterations of a window.
+        headroom: Fraction of the budget below which the granularity is
+            raised.
+        max_interval: Maximum sampling interval. It defaults to 64 times
+            the initial interval.
+        recalibrate: Number of windows after which the baseline is
+            measured again.
+        max_backoff: Maximum number of windows to wait before raising.
+    """
+
+    def __init__(self, optimizer, budget=0.05, sampler=None, window=20,
+                 headroom=0.5, max_interval=None, recalibrate=100,
+                 max_backoff=64):
+        if budget <= 0:
+            raise ValueError('budget must be positive.')
+        if window <= 0:
+            raise ValueError('window must be positive.')
+        if not 0 <= headroom < 1:
+            raise ValueError('headroom must be in [0, 1).')
+        self._optimizer = optimizer
+        self._budget = budget
+        self._sampler = sampler
+        self._window = window
+        self._headroom = headroom
+        self._recalibrate = recalibrate
+        self._max_backoff = max_backoff
+
+        self._max_level = optimizer.sync_level
+        # Restored on detach.
+        self._function_mark_level = None
+        if sampler is not None:
+            self._min_interval = sampler.interval
+            self._max_interval = max_interval or 64 * sampler.interval
+
+        self.overhead = None
+        self.changes = []
+        self.iteration = 0
+
+        self._durations = []
+        self._overhead_begin = None
+        self._sampling_begin = 0.0
+        self._baseline = None
+        # Level to restore after calibration.
+        self._calibrating = None
+        self._windows_since_calibration = 0
+        self._last_raised = False
+        self._backoff = 1
+        self._wait = 0
+
+    def attach(self):
+        self._function_mark_level = self._optimizer.function_mark_level
+        self._optimizer.set_function_mark_level(SyncLevel.FINEST)
+        add_range_listener(self)
+        return self
+
+    def detach(self):
+        remove_range_listener(self)
+        if self._function_mark_level is not None:
+            self._optimizer.set_function_mark_level(
+                self._function_mark_level)
+            self._function_mark_level = None
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.detach()
+
+    def range_pushed(self, msg, timestamp):
+        pass
+
+    def range_popped(self, msg, start, end):
+        if msg != 'iteration':
+            return
+        self.iteration += 1
+        if self._overhead_begin is None:
+            # The first iteration is not measured (e.g. lazy
+            # initialization).
+            self._start_window()
+            return
+        self._durations.append(end - start)
+        if len(self._durations) >= self._window:
+            self._finish_window()
+            self._start_window()
+
+    def _start_window(self):
+        self._durations = []
+        self._overhead_begin = range_overhead()
+        if self._sampler is not None:
+            self._sampling_begin = self._sampler.sampling_time
+
+    def _finish_window(self):
+        total = sum(self._durations)
+        direct = range_overhead() - self._overhead_begin
+        if self._sampler is not None:
+            direct += self._sampler.sampling_time - self._sampling_begin
+        median = _median(self._durations)
+        level = self._optimizer.sync_level
+
+        if level == SyncLevel.COARSEST:
+            self._baseline = median
+            self._windows_since_calibration = 0
+        else:
+            self._windows_since_calibration += 1
+        if self._calibrating is not None:
+            restored, self._calibrating = self._calibrating, None
+            self._set_level(restored, None)
+            return
+
+        overhead = direct / total if total > 0 else 0.0
+        if level > SyncLevel.COARSEST and self._baseline:
+            overhead += max(median / self._baseline - 1.0, 0.0)
+        self.overhead = overhead
+
+        if level > SyncLevel.COARSEST and (
+                self._baseline is None or
+                self._windows_since_calibration >= self._recalibrate):
+            self._calibrating = level
+            self._set_level(SyncLevel.COARSEST, overhead)
+            return
+
+        if overhead > self._budget:
+            if self._lower(overhead) and self._last_raised:
+                # The last raise did not fit in the budget.
+                self._backoff = min(2 * self._backoff, self._max_backoff)
+                self._wait = self._backoff
+            self._last_raised = False
+        elif overhead < self._headroom * self._budget:
+            if self._wait > 0:
+                self._wait -= 1
+                self._last_raised = False
+            else:
+                self._last_raised = self._raise(overhead)
+        else:
+            self._last_raised = False
+
+    def _lower(self, overhead):
+        level = self._optimizer.sync_level
+        if level > SyncLevel.COARSEST:
+            self._set_level(level - 1, overhead)
+            return True
+        sampler = self._sampler
+        if sampler is not None and sampler.interval < self._max_interval:
+            self._set_interval(min(2 * sampler.interval, self._max_interval),
+                               overhead)
+            return True
+        return False
+
+    def _raise(self, overhead):
+        sampler = self._sampler
+        if sampler is not None and sampler.interval > self._min_interval:
+            self._set_interval(max(sampler.interval / 2, self._min_interval),
+                               overhead)
+            return True
+        level = self._optimizer.sync_level
+        if level < self._max_level:
+            self._set_level(level + 1, overhead)
+            return True
+        return False
+
+    def _set_level(self, level, overhead):
+        old = self._optimizer.sync_level
+        self._optimizer.set_sync_level(SyncLevel(level))
+        self.changes.append(Change(self.iteration, 'sync_level', int(old),
+                                   int(level), overhead))
+
+    def _set_interval(self, interval, overhead):
+        old = self._sampler.interval
+        self._sampler.interval = interval
+        self.changes.append(Change(self.iteration, 'interval', old,
+                                   interval, overhead))
@@ -0,0 +1,71 @@
+from chainer.dataset import iterator
+
+
+class BatchSourceIterator(iterator.Iterator):
+    """Base of iterators serving batches prepared in advance.
+
+    It keeps the epoch and iteration bookkeeping of Chainer iterators, so
+    subclasses only provide batches by :meth:`get_batch`. An epoch has
+    ``epoch_size`` units (e.g. examples or batches), and each call of
+    ``next()`` returns the batch at the current position and advances it
+    by ``step`` units.
+
+    Args:
+        epoch_size: Number of units in an epoch.
+        step: Number of units in a batch.
+        repeat: If ``False``, it stops after an epoch.
+    """
+
+    def __init__(self, epoch_size, step, repeat=True):
+        self._epoch_size = epoch_size
+        self._step = step
+        self._repeat = repeat
+        self.reset()
+
+    def get_batch(self, position):
+        """Returns the batch at ``position`` in the epoch."""
+        raise NotImplementedError
+
+    def reset(self):
+        self.current_position = 0
+        self.epoch = 0
+        self.is_new_epoch = False
+        self._previous_epoch_detail = -1.
+
+    def __next__(self):
+        if not self._repeat and self.epoch > 0:
+            raise StopIteration
+        self._previous_epoch_detail = self.epoch_detail
+        batch = self.get_batch(self.current_position)
+        self.current_position += self._step
+        if self.current_position >= self._epoch_size:
+            self.current_position = 0
+            self.epoch += 1
+            self.is_new_epoch = True
+        else:
+            self.is_new_epoch = False
+        return batch
+
+    next = __next__
+
+    @property
+    def epoch_detail(self):
+        return self.epoch + float(self.current_position) / self._epoch_size
+
+    @property
+    def previous_epoch_detail(self):
+        if self._previous_epoch_detail < 0:
+            return None
+        return self._previous_epoch_detail
+
+    @property
+    def repeat(self):
+        return self._repeat
+
+    def serialize(self, serializer):
+        self.current_position = serializer('current_position',
+                                           self.current_position)
+        self.epoch = serializer('epoch', self.epoch)
+        self.is_new_epoch = serializer('is_new_epoch', self.is_new_epoch)
+        self._previous_epoch_detail = serializer(
+            'previous_epoch_detail', self._previous_epoch_detail)
@@ -0,0 +1,127 @@
+import math
+
+import numpy
+
+import chainer.functions as F
+
+from chainer_profutil.profiled_optimizer import time_range
+
+
+class _UnscaleHook(object):
+    name = 'LossUnscale'
+    call_for_each_param = False
+    timing = 'pre'
+
+    def __init__(self, scaler):
+        self._scaler = scaler
+
+    def __call__(self, optimizer):
+        self._scaler._unscale(optimizer)
+
+
+class _ScaleUpdateHook(object):
+    name = 'LossScaleUpdate'
+    call_for_each_param = False
+    timing = 'post'
+
+    def __init__(self, scaler):
+        self._scaler = scaler
+
+    def __call__(self, optimizer):
+        self._scaler._update_scale()
+
+
+class DynamicLossScaler(object):
+    """Dynamic loss scaling for half-precision training.
+
+    The loss is multiplied by :attr:`scale` before backward so that small
+    gradients do not underflow in float16, and gradients are divided by it
+    before the update. If any gradient has overflowed, the update is
+    skipped and the scale is divided by ``factor``. After ``interval``
+    updates without overflow, the scale is multiplied by ``factor``.
+
+    Give an instance to ``create_marked_profile_optimizer`` as
+    ``loss_scaler``. Then the optimizer also keeps float32 master copies
+    of float16 parameters (``use_fp32_update``), and scaling and unscaling
+    are recorded as ``'loss.scale'`` and ``'loss.unscale'`` ranges.
+    Optimizer hooks not called for each parameter (e.g.
+    ``GradientClipping``) see the scaled gradients.
+
+    Args:
+        scale: Initial scale.
+        factor: Factor to decrease or increase the scale.
+        interval: Number of updates without overflow after which the
+            scale is increased.
+        min_scale: Minimum scale.
+    """
+
+    def __init__(self, scale=2. ** 15, factor=2., interval=1000,
+                 min_scale=1.):
+        if scale < min_scale or min_scale <= 0:
+            raise ValueError('scale must be at least min_scale (> 0).')
+        if factor <= 1:
+            raise ValueError('factor must be greater than 1.')
+        if interval <= 0:
+            raise ValueError('interval must be positive.')
+        self.scale = float(scale)
+        self.factor = factor
+        self.interval = interval
+        self.min_scale = min_scale
+
+        self.overflow = False
+        self.n_overflows = 0
+        self._n_good = 0
+        self._disabled_rules = []
+
+    def make_hooks(self):
+        """Returns the pre- and post-update hooks of the optimizer."""
+        return _UnscaleHook(self), _ScaleUpdateHook(self)
+
+    def scale_loss(self, loss):
+        with time_range('loss.scale'):
+            if loss.dtype == numpy.float16:
+                # The scaled loss easily exceeds the float16 range.
+                loss = F.cast(loss, numpy.float32)
+            return loss * self.scale
+
+    def _unscale(self, optimizer):
+        with time_range('loss.unscale'):
+            params = [p for p in optimizer.target.params()
+                      if p.grad is not None]
+            # Sum up in float32 so that only a single synchronization is
+            # needed to find inf/nan in any gradient.
+            total = float(sum(p.grad.sum(dtype=numpy.float32)
+                              for p in params))
+            self.overflow = not math.isfinite(total)
+            if self.overflow:
+                self.n_overflows += 1
+                for param in optimizer.target.params():
+                    rule = param.update_rule
+                    if rule is not None and rule.enabled:
+                        rule.enabled = False
+                        self._disabled_rules.append(rule)
+                return
+
+            inv_scale = 1. / self.scale
+            for param in params:
+                rule = param.update_rule
+                if param.dtype == numpy.float16 and \
+                        getattr(rule, '_use_fp32_update', False):
+                    # The update rule divides the float32 copy of the
+                    # gradient, which keeps small gradients.
+                    param._loss_scale = self.scale
+                else:
+                    param.grad *= param.grad.dtype.type(inv_scale)
+
+    def _update_scale(self):
+        for rule in self._disabled_rules:
+            rule.enabled = True
+        self._disabled_rules = []
+        if self.overflow:
+            self.scale = max(self.scale / self.factor, self.min_scale)
+            self._n_good = 0
+        else:
+            self._n_good += 1
+            if self._n_good >= self.interval:
+                self.scale *= self.factor
+                self._n_good = 0
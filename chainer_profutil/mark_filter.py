@@ -0,0 +1,100 @@
+import re
+
+
+def _compile(patterns):
+    if patterns is None:
+        return None
+    if isinstance(patterns, str):
+        patterns = [patterns]
+    return [re.compile(pattern) for pattern in patterns]
+
+
+def _search(patterns, s):
+    return any(pattern.search(s) for pattern in patterns)
+
+
+class MarkFilter(object):
+    """Selects functions marked by per-function ranges.
+
+    ``FwdBwdProfileMarkHook`` pushes a range for every function, and at
+    ``SyncLevel.FINEST`` it also synchronizes before and after each of
+    them. With a filter, only the selected functions get their ranges and
+    synchronizations, and the time of the other functions is folded into
+    the enclosing range (e.g. ``model.forward``).
+
+    A function is selected if its label (e.g. ``'Convolution2DFunction'``)
+    matches any of ``include`` and none of ``exclude``, and its link path
+    (e.g. ``'/predictor/conv1'``) matches any of ``include_links`` and none
+    of ``exclude_links``. Patterns are regular expressions searched in the
+    strings, and omitted patterns do not filter anything. As with
+    ``FlopCounter``, a link path is found from the parameters a function
+    takes, so functions without parameters (e.g. ``ReLU``) have no link
+    path and are not selected when ``include_links`` is given.
+
+    Give an instance to ``create_marked_profile_optimizer`` as
+    ``mark_filter``.
+
+    Args:
+        include: Pattern or list of patterns of labels to mark.
+        exclude: Pattern or list of patterns of labels not to mark.
+        include_links: Pattern or list of patterns of link paths to mark.
+        exclude_links: Pattern or list of patterns of link paths not to
+            mark.
+    """
+
+    def __init__(self, include=None, exclude=None, include_links=None,
+                 exclude_links=None):
+        self._include = _compile(include)
+        self._exclude = _compile(exclude)
+        self._include_links = _compile(include_links)
+        self._exclude_links = _compile(exclude_links)
+        self._signature = None
+        self._param_to_layer = {}
+
+    def register_link(self, link):
+        # It is called in every forward, so the map is rebuilt only when
+        # the parameters change (e.g. lazy initialization or to_gpu).
+        signature = (id(link),) + tuple(
+            (id(p.array), id(p.node)) for p in link.params())
+        if signature == self._signature:
+            return
+        self._signature = signature
+        # Parameters are found by their arrays in forward and by their
+        # nodes in backward, where inputs not retained are None.
+        param_to_layer = {}
+        for path, param in link.namedparams():
+            layer = path.rsplit('/', 1)[0]
+            if param.array is not None:
+                param_to_layer[id(param.array)] = layer
+            param_to_layer[id(param.node)] = layer
+        self._param_to_layer = param_to_layer
+
+    def layer_of(self, function, in_data):
+        """Returns the link path of a function, or ``None``."""
+        for x in in_data:
+            layer = self._param_to_layer.get(id(x))
+            if layer is not None:
+                return layer
+        # Inputs are set after forward.
+        for node in getattr(function, 'inputs', None) or ():
+            layer = self._param_to_layer.get(id(node))
+            if layer is not None:
+                return layer
+        return None
+
+    def __call__(self, function, in_data):
+        label = function.label
+        if self._include is not None and not _search(self._include, label):
+            return False
+        if self._exclude is not None and _search(self._exclude, label):
+            return False
+        if self._include_links is None and self._exclude_links is None:
+            return True
+        layer = self.layer_of(function, in_data)
+        if self._include_links is not None and \
+                (layer is None or not _search(self._include_links, layer)):
+            return False
+        if self._exclude_links is not None and layer is not None and \
+                _search(self._exclude_links, layer):
+            return False
+        return True
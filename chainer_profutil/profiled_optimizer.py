@@ -1,12 +1,17 @@
 
 
+import contextlib
 import enum
+import threading
+import time
+import warnings
 
 from chainer.optimizer import Optimizer
 from chainer.function_hooks import CUDAProfileHook
 
+from chainer_profutil.fused_update import FusedUpdateHook
+
 from cupy import cuda
-from cupy import prof
 from cupy.cuda import runtime
 
 
@@ -22,20 +27,148 @@ class SyncLevel(enum.IntEnum):
     FINEST = 3
 
 
+class RangeMismatchError(RuntimeError):
+    pass
+
+
+_range_listeners = []
+
+_range_local = threading.local()
+_range_stacks = {}
+_range_stacks_lock = threading.Lock()
+
+_mismatch_policies = ('raise', 'warn', 'ignore')
+_mismatch_policy = 'warn'
+
+
+def add_range_listener(listener):
+    """Registers an object notified on every range push/pop.
+
+    ``listener`` must have ``range_pushed(msg, timestamp)`` and
+    ``range_popped(msg, start, end)`` methods, which are called on the
+    thread pushing/popping the range. Timestamps are taken by
+    ``time.perf_counter()`` after the optional synchronization, so they
+    include the GPU work when the range is synchronized.
+    """
+    if listener not in _range_listeners:
+        _range_listeners.append(listener)
+
+def remove_range_listener(listener):
+    if listener in _range_listeners:
+        _range_listeners.remove(listener)
+
+
+def set_range_mismatch_policy(policy):
+    """Sets how unbalanced ``range_pop`` calls are handled.
+
+    ``'raise'`` raises :class:`RangeMismatchError`, ``'warn'`` (default)
+    emits a warning with the offending names and ``'ignore'`` does nothing.
+    """
+    global _mismatch_policy
+    if policy not in _mismatch_policies:
+        raise ValueError('Unexpected policy: {}'.format(policy))
+    _mismatch_policy = policy
+
+
+def _get_range_stack():
+    stack = getattr(_range_local, 'stack', None)
+    if stack is None:
+        stack = []
+        _range_local.stack = stack
+        alive = set(t.ident for t in threading.enumerate())
+        with _range_stacks_lock:
+            for ident in list(_range_stacks.keys()):
+                if ident not in alive:
+                    del _range_stacks[ident]
+            _range_stacks[threading.get_ident()] = stack
+    return stack
+
+def current_ranges(thread_id=None):
+    """Returns names of the open ranges, outermost first.
+
+    ``thread_id`` defaults to the calling thread.
+    """
+    if thread_id is None:
+        stack = _get_range_stack()
+    else:
+        with _range_stacks_lock:
+            stack = _range_stacks.get(thread_id, ())
+    return tuple(msg for msg, _ in list(stack))
+
+def _handle_range_mismatch(message):
+    if _mismatch_policy == 'raise':
+        raise RangeMismatchError(message)
+    elif _mismatch_policy == 'warn':
+        warnings.warn(message, RuntimeWarning, stacklevel=3)
+
+
 def _try_to_sync_if_needed(sync):
     if sync:
         runtime.deviceSynchronize()
 
+def _add_overhead(seconds):
+    _range_local.overhead = getattr(_range_local, 'overhead', 0.0) + seconds
+
+def range_overhead():
+    """Returns the time the calling thread has spent in range push/pop.
+
+    It includes NVTX calls, bookkeeping and range listeners, but not the
+    time waiting for synchronization, which is mostly spent by the GPU
+    work of the range itself.
+    """
+    return getattr(_range_local, 'overhead', 0.0)
+
 def range_push(sync, msg, argb_color):
     _try_to_sync_if_needed(sync)
+    begin = time.perf_counter()
     if argb_color is None:
         cuda.nvtx.RangePush(msg)
     else:
         cuda.nvtx.RangePushC(msg, argb_color)
+    now = time.perf_counter()
+    _get_range_stack().append((msg, now))
+    for listener in _range_listeners:
+        listener.range_pushed(msg, now)
+    _add_overhead(time.perf_counter() - begin)
+
+def range_pop(sync, msg=None):
+    stack = _get_range_stack()
+    if not stack:
+        _handle_range_mismatch(
+            'range_pop({!r}) is called without range_push '
+            'on thread {}.'.format(msg, threading.current_thread().name))
+        return
+    if msg is not None and stack[-1][0] != msg:
+        _handle_range_mismatch(
+            'range_pop({!r}) does not match the innermost range {!r} '
+            'on thread {} (open ranges: {}).'.format(
+                msg, stack[-1][0], threading.current_thread().name,
+                ' > '.join(name for name, _ in stack)))
 
-def range_pop(sync):
     _try_to_sync_if_needed(sync)
+    begin = time.perf_counter()
     cuda.nvtx.RangePop()
+    now = time.perf_counter()
+    popped, start = stack.pop()
+    # Overhead is added before listeners too, which may read it at the end
+    # of an iteration.
+    _add_overhead(now - begin)
+    for listener in _range_listeners:
+        listener.range_popped(popped, start, now)
+    _add_overhead(time.perf_counter() - now)
+
+def _maybe_hook(hook):
+    if hook is None:
+        return contextlib.ExitStack()
+    return hook
+
+@contextlib.contextmanager
+def time_range(msg, sync=False, argb_color=None):
+    range_push(sync, msg, argb_color)
+    try:
+        yield
+    finally:
+        range_pop(sync, msg)
 
 
 class UpdateProfileMarkHookMixin(object):
@@ -76,45 +209,84 @@ class UpdateProfileMarkPostHook(UpdateProfileMarkHookMixin):
         else:
             itr_sync = (self._sync_level >= SyncLevel.COARSEST)
 
-        range_pop(upd_sync)  # pop 'model.update'
+        range_pop(upd_sync, 'model.update')
         if self._seprately_mark_for_iter:
-            range_pop(itr_sync)  # pop 'iteration'
+            range_pop(itr_sync, 'iteration')
 
 
 class FwdBwdProfileMarkHook(CUDAProfileHook):
 
     name = 'FwdBwdProfileMarkHook'
 
-    def __init__(self, sync=True, argb_color=None):
+    def __init__(self, sync=True, argb_color=None, cost_counter=None,
+                 mark_filter=None, mark=True):
         super(FwdBwdProfileMarkHook, self).__init__()
         self._sync = sync
+        # Whether functions are marked at all. Costs are counted anyway.
+        self._mark = mark
         self._argb_color = argb_color
+        self._cost_counter = cost_counter
+        self._mark_filter = mark_filter
+        # Whether each function being processed is marked.
+        self._marked = []
+
+    def _push(self, function, in_data, suffix):
+        marked = self._mark and (self._mark_filter is None or
+                                 self._mark_filter(function, in_data))
+        self._marked.append(marked)
+        if marked:
+            range_push(self._sync,
+                       function.label + suffix,
+                       self._argb_color)
+
+    def _pop(self, function, suffix):
+        if self._marked.pop():
+            range_pop(self._sync, function.label + suffix)
 
     def forward_preprocess(self, function, in_data):
-        range_push(self._sync,
-                   function.label + '.forward',
-                   self._argb_color)
+        self._push(function, in_data, '.forward')
+        if self._cost_counter is not None:
+            self._cost_counter.begin(function, in_data)
 
     def forward_postprocess(self, function, in_data):
-        range_pop(self._sync)
+        self._pop(function, '.forward')
+        if self._cost_counter is not None:
+            self._cost_counter.end()
 
     def backward_preprocess(self, function, in_data, out_grad):
-        range_push(self._sync,
-                   function.label + '.backward',
-                   self._argb_color)
+        self._push(function, in_data, '.backward')
+        if self._cost_counter is not None:
+            self._cost_counter.begin(function, in_data, backward=True,
+                                     out_grad=out_grad)
 
     def backward_postprocess(self, function, in_data, out_grad):
-        range_pop(self._sync)
+        self._pop(function, '.backward')
+        if self._cost_counter is not None:
+            self._cost_counter.end()
 
 
 class _VariableWrapper(object):
-    def __init__(self, variable, sync, sync_level):
+    def __init__(self, variable, sync, sync_level, cost_counter=None,
+                 grad_bucketer=None, loss_scaler=None, micro_batch=None,
+                 mark_filter=None, mark_functions=True):
         super(_VariableWrapper, self).__setattr__(
             '_variable', variable)
         super(_VariableWrapper, self).__setattr__(
             '_sync', sync)
         super(_VariableWrapper, self).__setattr__(
             '_sync_level', sync_level)
+        super(_VariableWrapper, self).__setattr__(
+            '_cost_counter', cost_counter)
+        super(_VariableWrapper, self).__setattr__(
+            '_grad_bucketer', grad_bucketer)
+        super(_VariableWrapper, self).__setattr__(
+            '_loss_scaler', loss_scaler)
+        super(_VariableWrapper, self).__setattr__(
+            '_micro_batch', micro_batch)
+        super(_VariableWrapper, self).__setattr__(
+            '_mark_filter', mark_filter)
+        super(_VariableWrapper, self).__setattr__(
+            '_mark_functions', mark_functions)
 
     def backward(self, *args, **kwargs):
         if not self._sync:
@@ -124,9 +296,24 @@ class _VariableWrapper(object):
             bwd_sync = (self._sync_level >= SyncLevel.SECOND)
             bwd_each_sync = (self._sync_level >= SyncLevel.FINEST)
 
-        with prof.time_range('model.backward', sync=bwd_sync, argb_color=_bwd_argb_color):
-            with FwdBwdProfileMarkHook(sync=bwd_each_sync, argb_color=_bwd_argb_color):
-                ret = self._variable.backward(*args, **kwargs)
+        variable = self._variable
+        range_name = 'model.backward'
+        if self._micro_batch is not None:
+            index, weight = self._micro_batch
+            range_name += '#{}'.format(index)
+            variable = variable * weight
+        if self._loss_scaler is not None:
+            variable = self._loss_scaler.scale_loss(variable)
+        with time_range(range_name, sync=bwd_sync, argb_color=_bwd_argb_color):
+            with FwdBwdProfileMarkHook(sync=bwd_each_sync,
+                                       argb_color=_bwd_argb_color,
+                                       cost_counter=self._cost_counter,
+                                       mark_filter=self._mark_filter,
+                                       mark=self._mark_functions):
+                with _maybe_hook(self._grad_bucketer):
+                    ret = variable.backward(*args, **kwargs)
+        if self._grad_bucketer is not None:
+            self._grad_bucketer.finish()
         return ret
 
     def __getattr__(self, attr_name):
@@ -139,7 +326,11 @@ class _VariableWrapper(object):
 def make_wrapped_link(link,
                       sync=True,
                       sync_level=SyncLevel.COARSEST,
-                      seprately_mark_for_iter=True):
+                      seprately_mark_for_iter=True,
+                      cost_counter=None,
+                      grad_bucketer=None,
+                      loss_scaler=None,
+                      mark_filter=None):
     assert SyncLevel.COARSEST <= sync_level <= SyncLevel.FINEST, \
         'Unexpected sync_level: {}'.format(sync_level)
     if link is None:
@@ -148,54 +339,204 @@ def make_wrapped_link(link,
         raise RuntimeError('link must have forward method.')
 
     def forward_wrapper(*args, **kwargs):
-        if seprately_mark_for_iter and sync_level >= SyncLevel.COARSEST:
+        # The level may be changed by set_sync_level of the optimizer.
+        level = link._sync_level
+        if seprately_mark_for_iter and level >= SyncLevel.COARSEST:
             range_push(sync, 'iteration', _itr_argb_color)
 
         if not sync:
             fwd_sync = False
             fwd_each_sync = False
         else:
-            fwd_sync = (sync_level >= SyncLevel.SECOND)
-            fwd_each_sync = (sync_level >= SyncLevel.FINEST)
-
-        with prof.time_range('model.forward', sync=fwd_sync, argb_color=_fwd_argb_color):
-            with FwdBwdProfileMarkHook(sync=fwd_each_sync, argb_color=_fwd_argb_color):
-                loss = link._org_forward(*args, **kwargs)
-        return _VariableWrapper(loss, sync, sync_level)
-
+            fwd_sync = (level >= SyncLevel.SECOND)
+            fwd_each_sync = (level >= SyncLevel.FINEST)
+        # Functions are marked only at or above this level (e.g. while the
+        # level is governed by OverheadGovernor).
+        mark_functions = (level >= link._function_mark_level)
+
+        if cost_counter is not None:
+            cost_counter.register_link(link)
+        if mark_filter is not None and mark_functions:
+            mark_filter.register_link(link)
+        if grad_bucketer is not None:
+            grad_bucketer.start(link)
+
+        # (index, loss weight) set by the optimizer accumulating gradients.
+        micro_batch = link._micro_batch
+        range_name = 'model.forward'
+        if micro_batch is not None:
+            range_name += '#{}'.format(micro_batch[0])
+
+        with time_range(range_name, sync=fwd_sync, argb_color=_fwd_argb_color):
+            with FwdBwdProfileMarkHook(sync=fwd_each_sync,
+                                       argb_color=_fwd_argb_color,
+                                       cost_counter=cost_counter,
+                                       mark_filter=mark_filter,
+                                       mark=mark_functions):
+                with _maybe_hook(grad_bucketer):
+                    loss = link._org_forward(*args, **kwargs)
+        return _VariableWrapper(loss, sync, level, cost_counter,
+                                grad_bucketer, loss_scaler, micro_batch,
+                                mark_filter, mark_functions)
+
+    link._micro_batch = None
+    link._sync_level = sync_level
+    link._function_mark_level = SyncLevel.COARSEST
     link._org_forward = link.forward
     link.forward = forward_wrapper
     return link
 
 
+def _get_batchsize(args, kwds):
+    for x in list(args) + list(kwds.values()):
+        shape = getattr(x, 'shape', None)
+        if shape:
+            return shape[0]
+    raise ValueError('No array is given to split into micro-batches.')
+
+def _slice_batch(x, begin, end, batchsize):
+    shape = getattr(x, 'shape', None)
+    if shape and shape[0] == batchsize:
+        return x[begin:end]
+    return x
+
+
 class _MarkedProfileOptimizerBase(object):
-    def __init__(self, actual_optimizer, sync, sync_level):
+    def __init__(self, actual_optimizer, sync, sync_level, cost_counter=None,
+                 fused_update=False, grad_bucketer=None, loss_scaler=None,
+                 accum_steps=1, mark_filter=None):
         super(_MarkedProfileOptimizerBase, self).__setattr__(
             'actual_optimizer', actual_optimizer)
         super(_MarkedProfileOptimizerBase, self).__setattr__(
             '_sync', sync)
         super(_MarkedProfileOptimizerBase, self).__setattr__(
             '_sync_level', sync_level)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_cost_counter', cost_counter)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_fused_update', fused_update)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_grad_bucketer', grad_bucketer)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_loss_scaler', loss_scaler)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_accum_steps', accum_steps)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_mark_filter', mark_filter)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_mark_hooks', ())
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_function_mark_level', SyncLevel.COARSEST)
+
+    @property
+    def sync_level(self):
+        return self._sync_level
+
+    def set_sync_level(self, sync_level):
+        """Changes the synchronization level while training.
+
+        It takes effect from the next iteration, so call it between
+        iterations (e.g. from a range listener at the end of an
+        iteration or from a trainer extension).
+        """
+        assert SyncLevel.COARSEST <= sync_level <= SyncLevel.FINEST, \
+            'Unexpected sync_level: {}'.format(sync_level)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_sync_level', sync_level)
+        for hook in self._mark_hooks:
+            hook._sync_level = sync_level
+        target = self.actual_optimizer.target
+        if target is not None:
+            target._sync_level = sync_level
+
+    @property
+    def function_mark_level(self):
+        return self._function_mark_level
+
+    def set_function_mark_level(self, level):
+        """Changes the lowest synchronization level marking functions.
+
+        Below this level, only the iteration and the forward, backward and
+        update phases are marked. By default, functions are marked at
+        every level.
+        """
+        assert SyncLevel.COARSEST <= level <= SyncLevel.FINEST, \
+            'Unexpected level: {}'.format(level)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_function_mark_level', level)
+        target = self.actual_optimizer.target
+        if target is not None:
+            target._function_mark_level = level
 
     def _setup(self, link, seprately_mark_for_iter=True):
         make_wrapped_link(
             link,
             sync=self._sync,
             sync_level=self._sync_level,
-            seprately_mark_for_iter=seprately_mark_for_iter)
+            seprately_mark_for_iter=seprately_mark_for_iter,
+            cost_counter=self._cost_counter,
+            grad_bucketer=self._grad_bucketer,
+            loss_scaler=self._loss_scaler,
+            mark_filter=self._mark_filter)
+        link._function_mark_level = self._function_mark_level
         ret = self.actual_optimizer.setup(link)
-
-        self.actual_optimizer.add_hook(
-            UpdateProfileMarkPreHook(sync=self._sync,
-                                     sync_level=self._sync_level,
-                                     argb_color=_upd_argb_color))
-        self.actual_optimizer.add_hook(
-            UpdateProfileMarkPostHook(sync=self._sync,
-                                      sync_level=self._sync_level,
-                                      seprately_mark_for_iter=seprately_mark_for_iter))
+        single_node_optimizer = getattr(
+            self.actual_optimizer, 'actual_optimizer', self.actual_optimizer)
+
+        pre_hook = UpdateProfileMarkPreHook(sync=self._sync,
+                                            sync_level=self._sync_level,
+                                            argb_color=_upd_argb_color)
+        self.actual_optimizer.add_hook(pre_hook)
+        # The following hooks must run inside 'model.update'.
+        if self._loss_scaler is not None:
+            single_node_optimizer.use_fp32_update()
+            unscale_hook, scale_update_hook = self._loss_scaler.make_hooks()
+            self.actual_optimizer.add_hook(unscale_hook)
+        if self._fused_update:
+            fused_hook = FusedUpdateHook(loss_scaler=self._loss_scaler)
+            fused_hook.setup(single_node_optimizer)
+            self.actual_optimizer.add_hook(fused_hook)
+        if self._loss_scaler is not None:
+            self.actual_optimizer.add_hook(scale_update_hook)
+        post_hook = UpdateProfileMarkPostHook(
+            sync=self._sync,
+            sync_level=self._sync_level,
+            seprately_mark_for_iter=seprately_mark_for_iter)
+        self.actual_optimizer.add_hook(post_hook)
+        super(_MarkedProfileOptimizerBase, self).__setattr__(
+            '_mark_hooks', (pre_hook, post_hook))
 
         return ret
 
+    def _accumulate_grads(self, lossfun, *args, **kwds):
+        # It runs forward/backward for each micro-batch split along the
+        # first axis. Each loss is weighted by the fraction of the batch,
+        # so the accumulated gradient is that of the whole batch.
+        target = self.actual_optimizer.target
+        batchsize = _get_batchsize(args, kwds)
+        n_steps = self._accum_steps
+        if batchsize < n_steps:
+            raise ValueError(
+                'Batch size {} is smaller than accum_steps {}.'.format(
+                    batchsize, n_steps))
+        single_node_optimizer = getattr(
+            self.actual_optimizer, 'actual_optimizer', self.actual_optimizer)
+
+        target.cleargrads()
+        for k in range(n_steps):
+            begin = k * batchsize // n_steps
+            end = (k + 1) * batchsize // n_steps
+            sub_args = [_slice_batch(x, begin, end, batchsize) for x in args]
+            sub_kwds = dict((key, _slice_batch(x, begin, end, batchsize))
+                            for key, x in kwds.items())
+            target._micro_batch = (k, float(end - begin) / batchsize)
+            try:
+                loss = lossfun(*sub_args, **sub_kwds)
+            finally:
+                target._micro_batch = None
+            loss.backward(loss_scale=single_node_optimizer._loss_scale)
+            del loss
+
     def __getattr__(self, attr_name):
         return getattr(self.actual_optimizer, attr_name)
 
@@ -203,48 +544,117 @@ class _MarkedProfileOptimizerBase(object):
         setattr(self.actual_optimizer, attr_name, value)
 
 class _MarkedProfileOptimizer(_MarkedProfileOptimizerBase):
-    def __init__(self, actual_optimizer, sync, sync_level):
+    def __init__(self, actual_optimizer, sync, sync_level, cost_counter=None,
+                 fused_update=False, loss_scaler=None, accum_steps=1,
+                 mark_filter=None):
         super(_MarkedProfileOptimizer, self).__init__(
-            actual_optimizer, sync, sync_level)
+            actual_optimizer, sync, sync_level, cost_counter, fused_update,
+            loss_scaler=loss_scaler, accum_steps=accum_steps,
+            mark_filter=mark_filter)
 
     def setup(self, link):
-        return self._setup(link, seprately_mark_for_iter=True)
+        # With accumulation, 'iteration' is marked by update() because the
+        # link is called for each micro-batch.
+        return self._setup(link,
+                           seprately_mark_for_iter=(self._accum_steps == 1))
+
+    def update(self, lossfun=None, *args, **kwds):
+        if self._accum_steps == 1 or lossfun is None:
+            return self.actual_optimizer.update(lossfun, *args, **kwds)
+        with time_range('iteration',
+                        sync=self._sync,
+                        argb_color=_itr_argb_color):
+            self._accumulate_grads(lossfun, *args, **kwds)
+            return self.actual_optimizer.update()
 
 class _MarkedProfileOptimizerForMN(_MarkedProfileOptimizerBase):
-    def __init__(self, actual_optimizer, sync, sync_level):
+    def __init__(self, actual_optimizer, sync, sync_level, cost_counter=None,
+                 fused_update=False, grad_bucketer=None, loss_scaler=None,
+                 accum_steps=1, mark_filter=None):
         super(_MarkedProfileOptimizerForMN, self).__init__(
-            actual_optimizer, sync, sync_level)
+            actual_optimizer, sync, sync_level, cost_counter, fused_update,
+            grad_bucketer, loss_scaler, accum_steps, mark_filter)
 
     def setup(self, link):
         return self._setup(link, seprately_mark_for_iter=False)
 
     def update(self, lossfun=None, *args, **kwds):
-        if self._sync:
-            iter_sync = True
-        with prof.time_range('iteration',
-                             sync=iter_sync,
-                             argb_color=_itr_argb_color):
-            ret = self.actual_optimizer.update(lossfun,
-                                               *args,
-                                               **kwds)
+        iter_sync = self._sync
+        with time_range('iteration',
+                        sync=iter_sync,
+                        argb_color=_itr_argb_color):
+            if lossfun is not None and self._accum_steps > 1:
+                # The multi-node optimizer allreduces the accumulated
+                # gradients once.
+                self._accumulate_grads(lossfun, *args, **kwds)
+                ret = self.actual_optimizer.update()
+            elif self._grad_bucketer is None or lossfun is None:
+                ret = self.actual_optimizer.update(lossfun,
+                                                   *args,
+                                                   **kwds)
+            else:
+                ret = self._bucketed_update(lossfun, *args, **kwds)
         return ret
 
+    def _bucketed_update(self, lossfun, *args, **kwds):
+        # Same as the update of the multi-node optimizer, except that
+        # gradients have been allreduced by the bucketer during backward.
+        mn_optimizer = self.actual_optimizer
+        target = mn_optimizer.target
+        loss = lossfun(*args, **kwds)
+        target.cleargrads()
+        loss.backward(loss_scale=mn_optimizer.actual_optimizer._loss_scale)
+        del loss
+
+        with time_range('allreduce.wait'):
+            self._grad_bucketer.finish()
+            self._grad_bucketer.wait()
+        if mn_optimizer.is_changed(target):
+            mn_optimizer.communicator.bcast_data(target)
+        else:
+            mn_optimizer.actual_optimizer.update(None)
+
 
 def create_marked_profile_optimizer(
         actual_optimizer,
         sync=True,
-        sync_level=SyncLevel.COARSEST):
+        sync_level=SyncLevel.COARSEST,
+        cost_counter=None,
+        fused_update=False,
+        grad_bucketer=None,
+        loss_scaler=None,
+        accum_steps=1,
+        mark_filter=None):
     assert actual_optimizer is not None, 'actual_optimizer is required.'
     assert SyncLevel.COARSEST <= sync_level <= SyncLevel.FINEST, \
         'Unexpected sync_level: {}'.format(sync_level)
+    if accum_steps < 1:
+        raise ValueError('accum_steps must be positive.')
+    if accum_steps > 1 and grad_bucketer is not None:
+        raise ValueError(
+            'grad_bucketer cannot be used with gradient accumulation.')
 
     if issubclass(actual_optimizer.__class__, Optimizer):
+        if grad_bucketer is not None:
+            raise ValueError(
+                'grad_bucketer requires a multi-node optimizer.')
         optimizer = _MarkedProfileOptimizer(actual_optimizer,
                                             sync=sync,
-                                            sync_level=sync_level)
+                                            sync_level=sync_level,
+                                            cost_counter=cost_counter,
+                                            fused_update=fused_update,
+                                            loss_scaler=loss_scaler,
+                                            accum_steps=accum_steps,
+                                            mark_filter=mark_filter)
     else:
         optimizer = _MarkedProfileOptimizerForMN(actual_optimizer,
                                                  sync=sync,
-                                                 sync_level=sync_level)
+                                                 sync_level=sync_level,
+                                                 cost_counter=cost_counter,
+                                                 fused_update=fused_update,
+                                                 grad_bucketer=grad_bucketer,
+                                                 loss_scaler=loss_scaler,
+                                                 accum_steps=accum_steps,
+                                                 mark_filter=mark_filter)
 
     return optimizer
@@ -0,0 +1,136 @@
+import json
+
+import numpy
+
+from chainer.dataset import convert
+
+from chainer_profutil.iterators import BatchSourceIterator
+
+
+def _meta_path(prefix):
+    return prefix + '_meta.json'
+
+
+def _array_path(prefix, key):
+    return '{}_{}.npy'.format(prefix, key)
+
+
+def _flatten(in_arrays):
+    if isinstance(in_arrays, tuple):
+        return 'tuple', [str(i) for i in range(len(in_arrays))], \
+            list(in_arrays)
+    elif isinstance(in_arrays, dict):
+        keys = sorted(in_arrays)
+        return 'dict', keys, [in_arrays[key] for key in keys]
+    else:
+        return 'array', ['0'], [in_arrays]
+
+
+def record_batches(iterator, prefix, n_batches,
+                   converter=convert.concat_examples):
+    """Records converted batches into memory-mapped files.
+
+    The first ``n_batches`` batches of ``iterator`` are converted on CPU by
+    ``converter``, and each of the converted arrays (e.g. images and
+    labels) is written into ``<prefix>_<key>.npy`` as an array of shape
+    ``(n_batches,) + shape``. The structure of the batches is written into
+    ``<prefix>_meta.json``. All batches must have the same shapes and
+    dtypes, so use an iterator with ``repeat=True`` (or drop a smaller
+    last batch).
+
+    Args:
+        iterator: Dataset iterator.
+        prefix: Prefix of output files.
+        n_batches: Number of batches to record.
+        converter: Converter function to build input arrays.
+
+    Returns:
+        int: Number of recorded batches, which is smaller than
+        ``n_batches`` if the iterator has stopped.
+    """
+    if n_batches <= 0:
+        raise ValueError('n_batches must be positive.')
+    outputs = None
+    n = 0
+    for n in range(n_batches):
+        try:
+            batch = iterator.next()
+        except StopIteration:
+            break
+        kind, keys, arrays = _flatten(converter(batch, None))
+        arrays = [numpy.asarray(x) for x in arrays]
+        if outputs is None:
+            outputs = [numpy.lib.format.open_memmap(
+                _array_path(prefix, key), mode='w+', dtype=x.dtype,
+                shape=(n_batches,) + x.shape)
+                for key, x in zip(keys, arrays)]
+        for out, x in zip(outputs, arrays):
+            if out.shape[1:] != x.shape or out.dtype != x.dtype:
+                raise ValueError(
+                    'batch {} has shape {} and dtype {}, but {} and {} are '
+                    'expected'.format(n, x.shape, x.dtype, out.shape[1:],
+                                      out.dtype))
+            out[n] = x
+    else:
+        n = n_batches
+    if outputs is None:
+        raise ValueError('iterator has no batch.')
+
+    for out in outputs:
+        out.flush()
+    del outputs
+    with open(_meta_path(prefix), 'w') as f:
+        json.dump({'kind': kind, 'keys': keys, 'n_batches': n}, f)
+    return n
+
+
+class ReplayIterator(BatchSourceIterator):
+    """Iterator serving batches recorded by :func:`record_batches`.
+
+    Recorded arrays are memory-mapped, and each call of ``next()`` returns
+    views of a recorded batch in the recorded structure (a tuple, a dict or
+    an array), so no example is loaded, decoded nor concatenated. The same
+    batches are served in the same order every time, so runs are
+    reproducible without the original dataset. Use it with
+    :class:`ReplayConverter`. An epoch is a pass over all recorded
+    batches.
+
+    Args:
+        prefix: Prefix given to :func:`record_batches`.
+        repeat: If ``False``, it stops after an epoch.
+    """
+
+    def __init__(self, prefix, repeat=True):
+        with open(_meta_path(prefix)) as f:
+            meta = json.load(f)
+        self._kind = meta['kind']
+        self._keys = meta['keys']
+        self.n_batches = meta['n_batches']
+        self._arrays = [numpy.load(_array_path(prefix, key), mmap_mode='r')
+                        for key in self._keys]
+        super(ReplayIterator, self).__init__(self.n_batches, 1, repeat)
+
+    def get_batch(self, position):
+        arrays = [x[position] for x in self._arrays]
+        if self._kind == 'tuple':
+            return tuple(arrays)
+        elif self._kind == 'dict':
+            return dict(zip(self._keys, arrays))
+        else:
+            return arrays[0]
+
+
+class ReplayConverter(object):
+    """Converter of batches from :class:`ReplayIterator`.
+
+    It only sends the recorded arrays to ``device``.
+    """
+
+    def __call__(self, batch, device=None):
+        if isinstance(batch, tuple):
+            return tuple(convert.to_device(device, x) for x in batch)
+        elif isinstance(batch, dict):
+            return dict((key, convert.to_device(device, x))
+                        for key, x in batch.items())
+        else:
+            return convert.to_device(device, batch)
@@ -0,0 +1,136 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+from chainer_profutil.profiled_optimizer import current_ranges
+
+
+def _frame_label(code):
+    label = '{} ({}:{})'.format(code.co_name,
+                                os.path.basename(code.co_filename),
+                                code.co_firstlineno)
+    # ';' separates frames and ' ' the count in collapsed stacks.
+    return label.replace(';', ':')
+
+
+def _range_label(msg):
+    return '[{}]'.format(msg.replace(';', ':'))
+
+
+class StackSampler(object):
+    """Samples Python stacks of threads and tags them with open ranges.
+
+    A background thread takes the stacks of the sampled threads by
+    ``sys._current_frames()`` every ``interval`` seconds. Each sample is
+    prefixed by the ranges open on the thread (e.g. ``[iteration]``,
+    ``[model.forward]`` and per-function ranges of
+    ``FwdBwdProfileMarkHook``), outermost first, and counted. So the
+    Python code (e.g. graph construction of Chainer) responsible for the
+    time of each range is found, which NVTX ranges do not show.
+
+    :meth:`collapsed` returns the counts in the collapsed stack format of
+    ``flamegraph.pl``, i.e. ``frame;frame;... count`` per line.
+
+    Args:
+        interval: Sampling interval in seconds. It may be changed while
+            sampling.
+        thread_ids: Identifiers of sampled threads. The thread calling
+            :meth:`start` is sampled by default.
+        all_threads: If ``True``, all threads except the sampler are
+            sampled.
+        max_depth: Maximum number of (innermost) Python frames kept in a
+            sample.
+    """
+
+    def __init__(self, interval=0.005, thread_ids=None, all_threads=False,
+                 max_depth=64):
+        if interval <= 0:
+            raise ValueError('interval must be positive.')
+        if max_depth <= 0:
+            raise ValueError('max_depth must be positive.')
+        self.interval = interval
+        self._thread_ids = None if thread_ids is None else set(thread_ids)
+        self._all_threads = all_threads
+        self._max_depth = max_depth
+
+        self._counts = collections.Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.n_samples = 0
+        self.sampling_time = 0.0
+
+    def start(self):
+        if self._thread is not None:
+            raise RuntimeError('StackSampler is already started.')
+        if self._thread_ids is None and not self._all_threads:
+            self._thread_ids = {threading.get_ident()}
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='StackSampler')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            begin = time.perf_counter()
+            self._sample(own_id)
+            self.sampling_time += time.perf_counter() - begin
+
+    def _sample(self, own_id):
+        frames = sys._current_frames()
+        stacks = []
+        for thread_id, frame in frames.items():
+            if thread_id == own_id:
+                continue
+            if not self._all_threads and thread_id not in self._thread_ids:
+                continue
+            labels = []
+            while frame is not None and len(labels) < self._max_depth:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.reverse()
+            ranges = [_range_label(msg)
+                      for msg in current_ranges(thread_id)]
+            stacks.append(';'.join(ranges + labels))
+        del frames
+        with self._lock:
+            for stack in stacks:
+                self._counts[stack] += 1
+            self.n_samples += 1
+
+    def counts(self):
+        """Returns a dict from collapsed stacks to numbers of samples."""
+        with self._lock:
+            return dict(self._counts)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+            self.n_samples = 0
+            self.sampling_time = 0.0
+
+    def collapsed(self):
+        """Returns the samples as collapsed stack text."""
+        return ''.join('{} {}\n'.format(stack, count)
+                       for stack, count in sorted(self.counts().items()))
+
+    def write_collapsed(self, path):
+        with open(path, 'w') as f:
+            f.write(self.collapsed())
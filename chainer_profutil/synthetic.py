@@ -0,0 +1,70 @@
+import numpy
+
+from chainer.backends import cuda
+
+from chainer_profutil.iterators import BatchSourceIterator
+
+
+class SyntheticIterator(BatchSourceIterator):
+    """Iterator yielding one pre-generated batch of random data.
+
+    Every call of ``next()`` returns the same tuple of arrays, i.e. random
+    inputs of shape ``(batch_size,) + shape`` and random int32 labels in
+    ``[0, n_classes)``, which are already concatenated. So nothing is read,
+    decoded or allocated per iteration, and training with it measures the
+    throughput of the model alone. Use it with :class:`SyntheticConverter`.
+
+    Args:
+        batch_size: Number of examples in a batch.
+        shape: Shape of each input (e.g. ``(3, model.insize,
+            model.insize)``).
+        dtype: Dtype of the inputs.
+        n_classes: Number of classes of the labels.
+        n_examples: Number of examples in an epoch. It defaults to
+            ``batch_size``.
+        repeat: If ``False``, it stops after an epoch.
+        seed: Seed of the random data.
+    """
+
+    def __init__(self, batch_size, shape, dtype=numpy.float32,
+                 n_classes=1000, n_examples=None, repeat=True, seed=0):
+        if batch_size <= 0:
+            raise ValueError('batch_size must be positive.')
+        if n_examples is None:
+            n_examples = batch_size
+        self.batch_size = batch_size
+        self.n_examples = n_examples
+
+        rng = numpy.random.RandomState(seed)
+        x = rng.uniform(-1, 1, (batch_size,) + tuple(shape)).astype(dtype)
+        t = rng.randint(0, n_classes, size=batch_size).astype(numpy.int32)
+        # Models must not modify the shared batch.
+        x.flags.writeable = False
+        t.flags.writeable = False
+        self._batch = (x, t)
+        super(SyntheticIterator, self).__init__(n_examples, batch_size,
+                                                repeat)
+
+    def get_batch(self, position):
+        return self._batch
+
+
+class SyntheticConverter(object):
+    """Converter of batches from :class:`SyntheticIterator`.
+
+    A batch is sent to each device only once, and the copy is returned
+    from the second time on.
+    """
+
+    def __init__(self):
+        self._cache = {}
+
+    def __call__(self, batch, device=None):
+        if device is None or device < 0:
+            return batch
+        key = (tuple(id(x) for x in batch), device)
+        arrays = self._cache.get(key)
+        if arrays is None:
+            arrays = tuple(cuda.to_gpu(x, device) for x in batch)
+            self._cache[key] = arrays
+        return arrays
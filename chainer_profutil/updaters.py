@@ -0,0 +1,154 @@
+import collections
+import queue
+import threading
+
+from chainer.backends import cuda
+from chainer.dataset import convert
+from chainer.training import updaters
+
+from chainer_profutil.profiled_optimizer import time_range
+
+
+_EpochState = collections.namedtuple(
+    '_EpochState', ('epoch', 'epoch_detail', 'previous_epoch_detail',
+                    'is_new_epoch'))
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class PrefetchingUpdater(updaters.StandardUpdater):
+    """Updater preparing next batches in a background thread.
+
+    It is the same as ``StandardUpdater`` except that ``iterator.next()``
+    and the converter (including the transfer to ``device``) run in a
+    background thread, which keeps up to ``depth`` converted batches ahead
+    of the training loop. Preparing a batch is recorded as a
+    ``'batch.prefetch'`` range on the background thread, and the time the
+    training loop waits for a batch as a ``'batch.wait'`` range, so
+    ``batch.wait`` shows how much of the batch preparation is not hidden.
+
+    The epoch information of the updater follows the batches consumed by
+    the training loop, but the iterator (and its serialized state) is up
+    to ``depth`` batches ahead.
+
+    Up to ``depth + 2`` converted batches are alive at once: one in
+    training, ``depth`` queued and one being converted. A converter
+    reusing its output buffers (e.g. ``StagingConverter``) needs at least
+    that many buffers.
+
+    Args:
+        iterator: Dataset iterator for the training dataset.
+        optimizer: Optimizer to update parameters.
+        converter: Converter function to build input arrays.
+        device: Device to which the training data is sent.
+        loss_func: Loss function. The target link of the optimizer is used
+            by default.
+        loss_scale: Loss scaling factor.
+        depth: Maximum number of batches prepared ahead.
+    """
+
+    def __init__(self, iterator, optimizer, converter=convert.concat_examples,
+                 device=None, loss_func=None, loss_scale=None, depth=2):
+        if depth <= 0:
+            raise ValueError('depth must be positive.')
+        super(PrefetchingUpdater, self).__init__(
+            iterator, optimizer, converter=converter, device=device,
+            loss_func=loss_func, loss_scale=loss_scale)
+        self._depth = depth
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._state = None
+
+    @property
+    def epoch(self):
+        if self._state is None:
+            return super(PrefetchingUpdater, self).epoch
+        return self._state.epoch
+
+    @property
+    def epoch_detail(self):
+        if self._state is None:
+            return super(PrefetchingUpdater, self).epoch_detail
+        return self._state.epoch_detail
+
+    @property
+    def previous_epoch_detail(self):
+        if self._state is None:
+            return super(PrefetchingUpdater, self).previous_epoch_detail
+        return self._state.previous_epoch_detail
+
+    @property
+    def is_new_epoch(self):
+        if self._state is None:
+            return super(PrefetchingUpdater, self).is_new_epoch
+        return self._state.is_new_epoch
+
+    def _start(self):
+        self._stop.clear()
+        self._queue = queue.Queue(maxsize=self._depth)
+        self._thread = threading.Thread(
+            target=self._run, name='PrefetchingUpdater')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run(self):
+        iterator = self._iterators['main']
+        device = self.device
+        if device is not None and device >= 0:
+            cuda.get_device_from_id(device).use()
+        while not self._stop.is_set():
+            try:
+                with time_range('batch.prefetch'):
+                    batch = iterator.next()
+                    in_arrays = self.converter(batch, device)
+                state = _EpochState(
+                    iterator.epoch, iterator.epoch_detail,
+                    iterator.previous_epoch_detail, iterator.is_new_epoch)
+            except BaseException as e:
+                # StopIteration of an iterator without repeat is also
+                # passed to the training loop.
+                self._put(_Failure(e))
+                return
+            if not self._put((in_arrays, state)):
+                return
+
+    def update_core(self):
+        if self._thread is None:
+            self._start()
+        with time_range('batch.wait'):
+            item = self._queue.get()
+        if isinstance(item, _Failure):
+            self._thread.join()
+            self._thread = None
+            raise item.error
+        in_arrays, self._state = item
+
+        optimizer = self._optimizers['main']
+        loss_func = self.loss_func or optimizer.target
+
+        if isinstance(in_arrays, tuple):
+            optimizer.update(loss_func, *in_arrays)
+        elif isinstance(in_arrays, dict):
+            optimizer.update(loss_func, **in_arrays)
+        else:
+            optimizer.update(loss_func, in_arrays)
+
+    def finalize(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        super(PrefetchingUpdater, self).finalize()
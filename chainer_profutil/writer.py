@@ -0,0 +1,194 @@
+import atexit
+import json
+import os
+import queue
+import signal
+import threading
+
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import remove_range_listener
+
+
+_policies = ('block', 'drop', 'sample')
+
+_sentinel = object()
+
+
+class AsyncEventWriter(object):
+    """Writes recorded ranges from a background thread.
+
+    Each popped range is handed off to a writer thread through a bounded
+    queue, so the training loop only pays for an enqueue. The writer
+    thread drains the queue in batches and writes the ranges in the Trace
+    Event Format, which can be loaded by ``chrome://tracing`` or Perfetto.
+    Pending events are flushed at interpreter exit, which one of
+    ``signals`` triggers unless it had another handler.
+
+    Args:
+        out: Path of the output file or a file-like object.
+        max_queue: Maximum number of events waiting for the writer.
+        batch_size: Maximum number of events written at once.
+        policy: What to do when the queue is full. ``'block'`` waits for
+            the writer, ``'drop'`` discards the new event and ``'sample'``
+            keeps only one of every ``sample_interval`` events once the
+            queue is half full and discards the rest.
+        sample_interval: Sampling interval of the ``'sample'`` policy.
+        signals: Signals on which the process exits normally, so pending
+            events are flushed. If a signal already had a handler, it is
+            invoked instead.
+    """
+
+    def __init__(self,
+                 out,
+                 max_queue=10000,
+                 batch_size=256,
+                 policy='block',
+                 sample_interval=10,
+                 signals=(signal.SIGTERM,)):
+        if policy not in _policies:
+            raise ValueError('Unexpected policy: {}'.format(policy))
+        if max_queue <= 0 or batch_size <= 0 or sample_interval <= 0:
+            raise ValueError(
+                'max_queue, batch_size and sample_interval must be positive.')
+
+        if isinstance(out, str):
+            self._file = open(out, 'w')
+            self._owns_file = True
+        else:
+            self._file = out
+            self._owns_file = False
+        self._max_queue = max_queue
+        self._batch_size = batch_size
+        self._policy = policy
+        self._sample_interval = sample_interval
+        self._signals = tuple(signals)
+
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._pid = os.getpid()
+        self._n_written = 0
+        self._n_sampled = 0
+        self.dropped = 0
+        self._thread = None
+        self._prev_handlers = {}
+        self._closed = False
+
+    @property
+    def written(self):
+        return self._n_written
+
+    def attach(self):
+        if self._thread is not None:
+            return self
+        self._file.write('[\n')
+        self._thread = threading.Thread(
+            target=self._run, name='AsyncEventWriter')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.close)
+        if threading.current_thread() is threading.main_thread():
+            for signum in self._signals:
+                self._prev_handlers[signum] = signal.signal(
+                    signum, self._signal_handler)
+        add_range_listener(self)
+        return self
+
+    def detach(self):
+        remove_range_listener(self)
+        for signum, handler in self._prev_handlers.items():
+            signal.signal(signum, handler)
+        self._prev_handlers = {}
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, *args):
+        self.close()
+
+    def range_pushed(self, msg, timestamp):
+        pass
+
+    def range_popped(self, msg, start, end):
+        self.put((msg, start, end, threading.get_ident()))
+
+    def put(self, event):
+        if self._policy == 'block':
+            self._queue.put(event)
+            return
+        if self._policy == 'sample' and \
+                self._queue.qsize() * 2 >= self._max_queue:
+            self._n_sampled += 1
+            if self._n_sampled % self._sample_interval != 0:
+                self.dropped += 1
+                return
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self):
+        """Blocks until all enqueued events have been written."""
+        if self._thread is not None:
+            self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self.detach()
+        atexit.unregister(self.close)
+        if self._thread is not None:
+            self._queue.put(_sentinel)
+            self._thread.join()
+            self._thread = None
+            self._file.write(']\n')
+            self._file.flush()
+        if self._owns_file:
+            self._file.close()
+
+    def _signal_handler(self, signum, frame):
+        # Writing or even enqueueing here may deadlock if the signal
+        # interrupted the main thread holding the lock of the queue. The
+        # signal is turned into a normal exit instead, and pending events
+        # are flushed by the atexit hook.
+        prev = self._prev_handlers.get(signum, signal.SIG_DFL)
+        if callable(prev):
+            prev(signum, frame)
+        elif prev == signal.SIG_DFL:
+            raise SystemExit(128 + signum)
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = [self._queue.get()]
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            events = []
+            for event in batch:
+                if event is _sentinel:
+                    stop = True
+                else:
+                    events.append(event)
+            if events:
+                self._write(events)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write(self, events):
+        lines = []
+        for msg, start, end, tid in events:
+            lines.append(json.dumps({
+                'name': msg,
+                'ph': 'X',
+                'ts': start * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': self._pid,
+                'tid': tid,
+            }))
+        if self._n_written > 0:
+            self._file.write(',\n')
+        self._file.write(',\n'.join(lines))
+        self._file.flush()
+        self._n_written += len(lines)
@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 import argparse
+import multiprocessing
+import os
 import sys
 
 import numpy as np
@@ -7,16 +9,104 @@ import numpy as np
 import chainer
 
 
-def compute_mean(dataset):
+_worker_dataset = None
+
+
+def _init_worker(dataset):
+    global _worker_dataset
+    _worker_dataset = dataset
+
+
+def _sum_range(args):
+    # It returns partial sums of a range of images accumulated in float64.
+    index, start, stop = args
+    sum_image = None
+    sum_sq = None
+    for i in range(start, stop):
+        image, _ = _worker_dataset[i]
+        image = image.astype(np.float64)
+        if sum_image is None:
+            sum_image = np.zeros_like(image)
+            sum_sq = np.zeros(image.shape[0], dtype=np.float64)
+        sum_image += image
+        sum_sq += np.square(image).sum(axis=(1, 2))
+    return index, sum_image, sum_sq
+
+
+def _save_checkpoint(path, n, chunk_size, done, sum_image, sum_sq):
+    tmp_path = path + '.tmp.npz'
+    np.savez(tmp_path, n=n, chunk_size=chunk_size,
+             done=np.array(sorted(done), dtype=np.int64),
+             sum_image=sum_image, sum_sq=sum_sq)
+    os.replace(tmp_path, path)
+
+
+def _load_checkpoint(path, n, chunk_size):
+    with np.load(path) as f:
+        if int(f['n']) != n or int(f['chunk_size']) != chunk_size:
+            raise ValueError(
+                'Checkpoint {} was made for another dataset or chunk '
+                'size.'.format(path))
+        return set(f['done'].tolist()), f['sum_image'], f['sum_sq']
+
+
+def compute_mean(dataset, n_processes=1, chunk_size=1000,
+                 checkpoint=None, checkpoint_interval=10, with_std=False):
+    # It splits the dataset into chunks, sums up each chunk in a process
+    # pool and reduces the partial sums. If checkpoint is given, the partial
+    # sums are saved to it every checkpoint_interval chunks and the
+    # computation resumes from it.
+    N = len(dataset)
+    if N == 0:
+        raise ValueError('dataset has no image.')
     print('compute mean image')
+    n_chunks = (N + chunk_size - 1) // chunk_size
+
+    done = set()
     sum_image = 0
-    N = len(dataset)
-    for i, (image, _) in enumerate(dataset):
-        sum_image += image
-        sys.stderr.write('{} / {}\r'.format(i, N))
+    sum_sq = 0
+    if checkpoint is not None and os.path.exists(checkpoint):
+        done, sum_image, sum_sq = _load_checkpoint(checkpoint, N, chunk_size)
+        print('resume from {} ({} / {} chunks)'.format(
+            checkpoint, len(done), n_chunks))
+
+    tasks = [(k, k * chunk_size, min((k + 1) * chunk_size, N))
+             for k in range(n_chunks) if k not in done]
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes, initializer=_init_worker,
+                                    initargs=(dataset,))
+        results = pool.imap_unordered(_sum_range, tasks)
+    else:
+        pool = None
+        _init_worker(dataset)
+        results = map(_sum_range, tasks)
+
+    for index, partial_sum, partial_sum_sq in results:
+        if partial_sum is not None:
+            sum_image = sum_image + partial_sum
+            sum_sq = sum_sq + partial_sum_sq
+        done.add(index)
+        if checkpoint is not None and len(done) % checkpoint_interval == 0:
+            _save_checkpoint(checkpoint, N, chunk_size, done,
+                             sum_image, sum_sq)
+        sys.stderr.write('{} / {} chunks\r'.format(len(done), n_chunks))
         sys.stderr.flush()
     sys.stderr.write('\n')
-    return sum_image / N
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if checkpoint is not None:
+        _save_checkpoint(checkpoint, N, chunk_size, done, sum_image, sum_sq)
+
+    mean = sum_image / N
+    if not with_std:
+        return mean.astype(np.float32)
+    # Per-channel standard deviation over all pixels of all images.
+    n_pixels = N * mean.shape[1] * mean.shape[2]
+    ch_mean = mean.mean(axis=(1, 2))
+    ch_var = sum_sq / n_pixels - np.square(ch_mean)
+    std = np.sqrt(np.maximum(ch_var, 0))
+    return mean.astype(np.float32), std.astype(np.float32)
 
 
 def main():
@@ -27,10 +117,27 @@ def main():
                         help='Root directory path of image files')
     parser.add_argument('--output', '-o', default='mean.npy',
                         help='path to output mean array')
+    parser.add_argument('--loaderjob', '-j', type=int, default=1,
+                        help='Number of parallel data loading processes')
+    parser.add_argument('--chunk_size', type=int, default=1000,
+                        help='Number of images summed up in each task')
+    parser.add_argument('--checkpoint',
+                        help=('Path to a checkpoint of partial sums '
+                              'to save and resume from'))
+    parser.add_argument('--std',
+                        help='path to output per-channel std array')
     args = parser.parse_args()
 
     dataset = chainer.datasets.LabeledImageDataset(args.dataset, args.root)
-    mean = compute_mean(dataset)
+    ret = compute_mean(dataset, n_processes=args.loaderjob,
+                       chunk_size=args.chunk_size,
+                       checkpoint=args.checkpoint,
+                       with_std=args.std is not None)
+    if args.std is not None:
+        mean, std = ret
+        np.save(args.std, std)
+    else:
+        mean = ret
     np.save(args.output, mean)
 
 
@@ -15,7 +15,15 @@ from chainer.training import extensions
 
 import chainermn
 
+from chainer_profutil import BatchPreprocessConverter
 from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import GradientBucketer
+from chainer_profutil import PrefetchingUpdater
+from chainer_profutil import ReplayConverter
+from chainer_profutil import ReplayIterator
+from chainer_profutil import StagingConverter
+from chainer_profutil import SyntheticConverter
+from chainer_profutil import SyntheticIterator
 
 import models.alex as alex
 import models.googlenet as googlenet
@@ -36,13 +44,23 @@ if major <= 2 or (major == 3 and minor < 4):
     exit(-1)
 
 
+# Numbers of the training and the validation images of ILSVRC2012, which
+# set the length of an epoch of synthetic data.
+_n_train_examples = 1281167
+_n_val_examples = 50000
+
+
 class PreprocessedDataset(chainer.dataset.DatasetMixin):
 
-    def __init__(self, path, root, mean, crop_size, random=True):
+    def __init__(self, path, root, mean, crop_size, random=True,
+                 crop_only=False):
         self.base = chainer.datasets.LabeledImageDataset(path, root)
         self.mean = mean.astype('f')
         self.crop_size = crop_size
         self.random = random
+        # If True, the mean subtraction and the scaling are left to
+        # BatchPreprocessConverter.
+        self.crop_only = crop_only
 
     def __len__(self):
         return len(self.base)
@@ -53,6 +71,8 @@ class PreprocessedDataset(chainer.dataset.DatasetMixin):
         #     - Cropping (random or center rectangular)
         #     - Random flip
         #     - Scaling to [0, 1] value
+        # With crop_only, it returns the cropped (and flipped) image, the
+        # label and the crop offset instead.
         crop_size = self.crop_size
 
         image, label = self.base[i]
@@ -72,6 +92,8 @@ class PreprocessedDataset(chainer.dataset.DatasetMixin):
         right = left + crop_size
 
         image = image[:, top:bottom, left:right]
+        if self.crop_only:
+            return image, label, top, left
         image -= self.mean[:, top:bottom, left:right]
         image *= (1.0 / 255.0)  # Scale to [0, 1]
         return image, label
@@ -130,6 +152,32 @@ def main():
     parser.add_argument('--test', action='store_true')
     parser.add_argument('--communicator', default='hierarchical')    
     parser.set_defaults(test=False)
+    parser.add_argument('--batch_preprocess', action='store_true',
+                        help=('Only decode and crop images in the loader '
+                              'processes, and subtract the mean while '
+                              'assembling each minibatch'))
+    parser.add_argument('--staging', action='store_true',
+                        help=('Concatenate examples into reused (pinned) '
+                              'batch buffers'))
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help=('Number of batches converted and transferred '
+                              'ahead in a background thread'))
+    parser.add_argument('--synthetic', action='store_true',
+                        help=('Train on a single random batch instead of '
+                              'the dataset to measure the model throughput '
+                              '(train, val and the mean file are ignored)'))
+    parser.add_argument('--replay',
+                        help=('Prefix of minibatches recorded by '
+                              'record_batches.py to train on instead of the '
+                              'dataset (all workers replay the same '
+                              'minibatches, and train and the mean file are '
+                              'ignored)'))
+    parser.add_argument('--replay_val',
+                        help=('Prefix of recorded minibatches to validate on '
+                              '(defaults to --replay)'))
+    parser.add_argument('--grad_bucket_mb', type=float, default=0,
+                        help=('Allreduce gradients in buckets of this size '
+                              'during backward (requires --nvtx_mark)'))
 
     parser.add_argument('--nvtx_mark', action='store_true',
                         help='Enable NVTX\'s marks during profiling by nvprof.')
@@ -176,37 +224,87 @@ def main():
     chainer.cuda.get_device_from_id(device).use()  # Make the GPU current
     model.to_gpu()
 
-    # Split and distribute the dataset. Only worker 0 loads the whole dataset.
-    # Datasets of worker 0 are evenly split and distributed to all workers.
-    mean = np.load(args.mean)
-    if comm.rank == 0:
-        train = PreprocessedDataset(args.train, args.root, mean, model.insize)
-        val = PreprocessedDataset(
-            args.val, args.root, mean, model.insize, False)
+    if args.synthetic:
+        # Each worker uses one pre-generated batch of the input size of the
+        # model in every iteration, so nothing is read nor converted.
+        insize = model.insize
+        dtype = getattr(model, 'dtype', np.float32)
+        train_iter = SyntheticIterator(
+            args.batchsize, (3, insize, insize), dtype=dtype,
+            n_examples=_n_train_examples // comm.size, seed=comm.rank)
+        val_iter = SyntheticIterator(
+            args.val_batchsize, (3, insize, insize), dtype=dtype,
+            n_examples=_n_val_examples // comm.size, repeat=False,
+            seed=comm.size + comm.rank)
+        converter = SyntheticConverter()
+        val_converter = converter
+    elif args.replay:
+        # Recorded minibatches are served from memory-mapped files in the
+        # same order in every run.
+        train_iter = ReplayIterator(args.replay)
+        val_iter = ReplayIterator(args.replay_val or args.replay,
+                                  repeat=False)
+        converter = ReplayConverter()
+        val_converter = converter
     else:
-        train = None
-        val = None
-    train = chainermn.scatter_dataset(train, comm, shuffle=True)
-    val = chainermn.scatter_dataset(val, comm)
-
-    # A workaround for processes crash should be done before making
-    # communicator above, when using fork (e.g. MultiProcessIterator)
-    # along with Infiniband.
-    train_iter = chainer.iterators.MultiprocessIterator(
-        train, args.batchsize, n_processes=args.loaderjob)
-    val_iter = chainer.iterators.MultiprocessIterator(
-        val, args.val_batchsize, repeat=False, n_processes=args.loaderjob)
+        # Split and distribute the dataset. Only worker 0 loads the whole
+        # dataset. Datasets of worker 0 are evenly split and distributed to
+        # all workers.
+        mean = np.load(args.mean)
+        if comm.rank == 0:
+            train = PreprocessedDataset(
+                args.train, args.root, mean, model.insize,
+                crop_only=args.batch_preprocess)
+            val = PreprocessedDataset(
+                args.val, args.root, mean, model.insize, False,
+                crop_only=args.batch_preprocess)
+        else:
+            train = None
+            val = None
+        if args.batch_preprocess:
+            # The loader processes only decode and crop images, and the
+            # converter subtracts the mean while assembling each minibatch.
+            converter = BatchPreprocessConverter(
+                mean, n_buffers=args.prefetch + 2)
+            val_converter = BatchPreprocessConverter(mean)
+        elif args.staging:
+            converter = StagingConverter(n_buffers=args.prefetch + 2)
+            val_converter = StagingConverter()
+        else:
+            converter = chainer.dataset.concat_examples
+            val_converter = converter
+        train = chainermn.scatter_dataset(train, comm, shuffle=True)
+        val = chainermn.scatter_dataset(val, comm)
+
+        # A workaround for processes crash should be done before making
+        # communicator above, when using fork (e.g. MultiProcessIterator)
+        # along with Infiniband.
+        train_iter = chainer.iterators.MultiprocessIterator(
+            train, args.batchsize, n_processes=args.loaderjob)
+        val_iter = chainer.iterators.MultiprocessIterator(
+            val, args.val_batchsize, repeat=False,
+            n_processes=args.loaderjob)
 
     # Create a multi node optimizer from a standard Chainer optimizer.
     optimizer = chainermn.create_multi_node_optimizer(
         chainer.optimizers.MomentumSGD(lr=0.01, momentum=0.9), comm)
     if args.nvtx_mark:
+        grad_bucketer = None
+        if args.grad_bucket_mb > 0:
+            grad_bucketer = GradientBucketer(
+                comm, bucket_bytes=int(args.grad_bucket_mb * 1024 * 1024))
         optimizer = create_marked_profile_optimizer(
-            optimizer, sync=True, sync_level=2)
+            optimizer, sync=True, sync_level=2, grad_bucketer=grad_bucketer)
     optimizer.setup(model)
 
     # Set up a trainer
-    updater = training.StandardUpdater(train_iter, optimizer, device=device)
+    if args.prefetch > 0:
+        updater = PrefetchingUpdater(train_iter, optimizer,
+                                     converter=converter, device=device,
+                                     depth=args.prefetch)
+    else:
+        updater = training.StandardUpdater(train_iter, optimizer,
+                                           converter=converter, device=device)
 
     if args.iter > 0:
         # Evaluation and etc are skipped during profiling
@@ -225,7 +323,8 @@ def main():
         trainer.extend(checkpointer, trigger=checkpoint_interval)
 
         # Create a multi node evaluator from an evaluator.
-        evaluator = TestModeEvaluator(val_iter, model, device=device)
+        evaluator = TestModeEvaluator(val_iter, model,
+                                      converter=val_converter, device=device)
         evaluator = chainermn.create_multi_node_evaluator(evaluator, comm)
         trainer.extend(evaluator, trigger=val_interval)
 
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+"""Benchmark training throughput of the ImageNet models.
+
+For each architecture of train_imagenet.py and each batch size, it trains
+the model on a synthetic minibatch with the marked optimizer until
+``--iterations`` iterations after the warmup have been measured. The
+warmup is detected by ``ProfileAggregator`` (or given by ``--warmup``)
+and excluded, and images/sec and the mean duration of the iteration,
+forward, backward and update in the steady state are written into
+``<out>.csv`` and ``<out>.json`` together with the warmup length.
+
+    python benchmark.py --arch alex nin --batchsizes 2 4 8 --out bench
+
+"""
+from __future__ import print_function
+import argparse
+import csv
+import json
+
+import chainer
+import numpy as np
+
+from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import ProfileAggregator
+from chainer_profutil import SyntheticConverter
+from chainer_profutil import SyntheticIterator
+
+from train_imagenet import archs
+
+
+_phases = (('iteration', 'iteration'),
+           ('forward', 'model.forward'),
+           ('backward', 'model.backward'),
+           ('update', 'model.update'))
+
+_fields = (('arch', 'batchsize', 'warmup', 'iterations', 'images_per_sec')
+           + tuple(name for name, _ in _phases) + ('error',))
+
+
+def run(arch, batchsize, warmup, iterations, max_iterations, gpu=-1,
+        sync_level=1):
+    model = archs[arch]()
+    if gpu >= 0:
+        model.to_gpu(gpu)
+    optimizer = create_marked_profile_optimizer(
+        chainer.optimizers.MomentumSGD(lr=0.01, momentum=0.9),
+        sync=gpu >= 0, sync_level=sync_level)
+    optimizer.setup(model)
+    insize = model.insize
+    iterator = SyntheticIterator(batchsize, (3, insize, insize),
+                                 dtype=getattr(model, 'dtype', np.float32))
+    converter = SyntheticConverter()
+
+    # Lazily initialized parameters, memory pool growth and autotuning
+    # make the first iterations slow.
+    aggregator = ProfileAggregator(phases=[phase for _, phase in _phases],
+                                   max_len=max_iterations, warmup=warmup)
+    with aggregator:
+        for n in range(1, max_iterations + 1):
+            x, t = converter(iterator.next(), gpu)
+            optimizer.update(model, x, t)
+            n_warmup = aggregator.warmup_iterations()
+            if n_warmup is not None and n - n_warmup >= iterations:
+                break
+    if n_warmup is None:
+        raise RuntimeError(
+            'timings did not settle in {} iterations'.format(max_iterations))
+
+    summary = aggregator.summary('steady')
+    result = {'arch': arch, 'batchsize': batchsize, 'warmup': n_warmup,
+              'iterations': summary['iteration']['count']}
+    for name, phase in _phases:
+        result[name] = summary[phase]['mean']
+    result['images_per_sec'] = batchsize / result['iteration']
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark training throughput of the ImageNet models')
+    parser.add_argument('--arch', '-a', nargs='+', choices=sorted(archs),
+                        default=sorted(archs),
+                        help='Convnet architectures (all by default)')
+    parser.add_argument('--batchsizes', '-B', type=int, nargs='+',
+                        default=[1, 2, 4, 8],
+                        help='Minibatch sizes')
+    parser.add_argument('--gpu', '-g', type=int, default=-1,
+                        help='GPU ID (negative value indicates CPU)')
+    parser.add_argument('--warmup', default='auto',
+                        help=('Number of iterations excluded from results, '
+                              'or auto to detect the warmup'))
+    parser.add_argument('--iterations', '-i', type=int, default=10,
+                        help='Number of measured iterations after warmup')
+    parser.add_argument('--max_iterations', type=int, default=200,
+                        help=('Maximum number of iterations including '
+                              'warmup'))
+    parser.add_argument('--sync_level', type=int, default=1,
+                        choices=(1, 2, 3),
+                        help='Synchronization level of the marked optimizer')
+    parser.add_argument('--out', '-o', default='benchmark',
+                        help='Prefix of output CSV and JSON files')
+    args = parser.parse_args()
+    warmup = args.warmup if args.warmup == 'auto' else int(args.warmup)
+
+    if args.gpu >= 0:
+        chainer.backends.cuda.get_device_from_id(args.gpu).use()
+
+    results = []
+    for arch in args.arch:
+        for batchsize in args.batchsizes:
+            try:
+                result = run(arch, batchsize, warmup, args.iterations,
+                             args.max_iterations, gpu=args.gpu,
+                             sync_level=args.sync_level)
+            except Exception as e:
+                # e.g. out of memory with a large batch. The other
+                # combinations are still measured.
+                result = {'arch': arch, 'batchsize': batchsize,
+                          'error': '{}: {}'.format(type(e).__name__, e)}
+                print('{} (batchsize {}): {}'.format(
+                    arch, batchsize, result['error']))
+            else:
+                print('{} (batchsize {}): {:.2f} images/sec '
+                      '(warmup: {} iterations)'.format(
+                          arch, batchsize, result['images_per_sec'],
+                          result['warmup']))
+            results.append(result)
+
+    with open(args.out + '.csv', 'w') as f:
+        writer = csv.DictWriter(f, fieldnames=_fields)
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+    with open(args.out + '.json', 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
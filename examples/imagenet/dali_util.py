@@ -109,45 +109,187 @@ class DaliPipelineVal(pipeline.Pipeline):
         return images, labels
 
 
+class _DaliTensorBackend(object):
+
+    """Copies DALI tensors into CuPy arrays in stream order.
+
+    A GPU tensor is copied on a dedicated stream which waits for the work
+    already queued on the current (consumer) stream, and the consumer
+    stream waits for the copy by an event. So neither the host nor the
+    other streams are blocked.
+    """
+
+    def __init__(self):
+        self._copy_stream = None
+        self._accepts_stream = None
+
+    def is_cpu(self, x):
+        return isinstance(x, dali.backend_impl.TensorCPU)
+
+    def is_gpu(self, x):
+        return isinstance(x, dali.backend_impl.TensorGPU)
+
+    def to_numpy(self, x):
+        return np.array(x)
+
+    def from_numpy(self, array, device):
+        return cuda.to_gpu(array, device)
+
+    def empty(self, shape, dtype):
+        return cuda.cupy.empty(shape, dtype=dtype)
+
+    def copy(self, x, out):
+        if self._accepts_stream is None:
+            self._accepts_stream = _accepts_stream(x)
+        if not self._accepts_stream:
+            # DALI without the stream argument uses its own stream.
+            cuda.cupy.cuda.runtime.deviceSynchronize()
+            x.copy_to_external(ctypes.c_void_p(out.data.ptr))
+            cuda.cupy.cuda.runtime.deviceSynchronize()
+            return
+        if self._copy_stream is None:
+            self._copy_stream = cuda.cupy.cuda.Stream(non_blocking=True)
+        consumer = cuda.cupy.cuda.get_current_stream()
+        # The buffer may still be read by work queued on the consumer stream.
+        self._copy_stream.wait_event(consumer.record())
+        x.copy_to_external(ctypes.c_void_p(out.data.ptr),
+                           cuda_stream=self._copy_stream.ptr)
+        consumer.wait_event(self._copy_stream.record())
+
+
+def _accepts_stream(tensor):
+    # Signatures of pybind11 functions are in their docstrings.
+    doc = getattr(type(tensor).copy_to_external, '__doc__', None) or ''
+    return 'cuda_stream' in doc
+
+
+class MockTensor(object):
+
+    """NumPy-backed stand-in of DALI tensors to test converters on CPU."""
+
+    def __init__(self, array, is_gpu=True):
+        self.array = np.asarray(array)
+        self.is_gpu = is_gpu
+
+    def as_tensor(self):
+        return self
+
+    def shape(self):
+        return self.array.shape
+
+    def dtype(self):
+        return self.array.dtype
+
+
+class MockTensorBackend(object):
+
+    """Tensor backend for :class:`MockTensor` which uses NumPy arrays."""
+
+    def __init__(self):
+        self.n_copies = 0
+
+    def is_cpu(self, x):
+        return not x.is_gpu
+
+    def is_gpu(self, x):
+        return x.is_gpu
+
+    def to_numpy(self, x):
+        return np.array(x.array)
+
+    def from_numpy(self, array, device):
+        return array
+
+    def empty(self, shape, dtype):
+        return np.empty(shape, dtype=dtype)
+
+    def copy(self, x, out):
+        self.n_copies += 1
+        np.copyto(out, x.array)
+
+
+class _BufferPool(object):
+
+    # Output buffers are used in turn, so a buffer is not overwritten
+    # while the consumer still reads a batch returned recently. With
+    # n_buffers=None, a new buffer is allocated every time.
+
+    def __init__(self, backend, n_buffers):
+        self._backend = backend
+        self._n_buffers = n_buffers
+        self._buffers = {}
+        self.n_allocations = 0
+
+    def get(self, shape, dtype):
+        if self._n_buffers is None:
+            self.n_allocations += 1
+            return self._backend.empty(shape, dtype)
+        key = (tuple(shape), np.dtype(dtype))
+        entry = self._buffers.get(key)
+        if entry is None:
+            entry = [[], 0]
+            self._buffers[key] = entry
+        buffers, index = entry
+        if len(buffers) < self._n_buffers:
+            buffers.append(self._backend.empty(shape, dtype))
+            self.n_allocations += 1
+            index = len(buffers) - 1
+        else:
+            index = (index + 1) % self._n_buffers
+        entry[1] = index
+        return buffers[index]
+
+
 class DaliConverter(object):
 
-    def __init__(self, mean, crop_size):
+    def __init__(self, mean=None, crop_size=None, n_buffers=2,
+                 tensor_backend=None, dtype=None):
         self.mean = mean
         self.crop_size = crop_size
+        # Dtype of output images. None keeps the dtype of DALI outputs.
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        # Outputs are overwritten n_buffers calls later. None returns new
+        # arrays in every call.
+        self.n_buffers = n_buffers
+
+        if mean is not None:
+            ch_mean = np.average(mean, axis=(1, 2))
+            perturbation = (mean - ch_mean.reshape(3, 1, 1)) / 255.0
+            perturbation = perturbation[:3, :crop_size, :crop_size].astype(
+                np.float32)
+            self.perturbation = perturbation.reshape(
+                1, 3, crop_size, crop_size)
+        else:
+            self.perturbation = None
 
-        ch_mean = np.average(mean, axis=(1, 2))
-        perturbation = (mean - ch_mean.reshape(3, 1, 1)) / 255.0
-        perturbation = perturbation[:3, :crop_size, :crop_size].astype(
-            np.float32)
-        self.perturbation = perturbation.reshape(1, 3, crop_size, crop_size)
+        if tensor_backend is None:
+            tensor_backend = _DaliTensorBackend()
+        self.tensor_backend = tensor_backend
+        self._pool = _BufferPool(tensor_backend, n_buffers)
+        self._perturbation_ready = False
 
     def __call__(self, inputs, device=None):
         """Convert DALI arrays to Numpy/CuPy arrays"""
 
-        xp = cuda.get_array_module(self.perturbation)
-        if xp is not cuda.cupy:
-            self.perturbation = cuda.to_gpu(self.perturbation, device)
+        backend = self.tensor_backend
+        if self.perturbation is not None and not self._perturbation_ready:
+            self.perturbation = backend.from_numpy(self.perturbation, device)
+            self._perturbation_ready = True
 
         outputs = []
         for i in range(len(inputs)):
             x = inputs[i].as_tensor()
-            if (isinstance(x, dali.backend_impl.TensorCPU)):
-                x = np.array(x)
+            if backend.is_cpu(x):
+                x = backend.to_numpy(x)
                 if x.ndim == 2 and x.shape[1] == 1:
                     x = x.squeeze(axis=1)
                 if device is not None and device >= 0:
                     x = cuda.to_gpu(x, device)
-            elif (isinstance(x, dali.backend_impl.TensorGPU)):
-                x_cupy = cuda.cupy.empty(shape=x.shape(), dtype=x.dtype())
-                # Synchronization is necessary here to avoid data corruption
-                # because DALI and CuPy will use different CUDA streams.
-                cuda.cupy.cuda.runtime.deviceSynchronize()
-                # copy data from DALI array to CuPy array
-                x.copy_to_external(ctypes.c_void_p(x_cupy.data.ptr))
-                cuda.cupy.cuda.runtime.deviceSynchronize()
-                x = x_cupy
-                if self.perturbation is not None:
-                    x = x - self.perturbation
+            elif backend.is_gpu(x):
+                # copy data from DALI array to a reused CuPy array
+                staging = self._pool.get(x.shape(), x.dtype())
+                backend.copy(x, staging)
+                x = self._subtract_and_cast(staging)
                 if device is not None and device < 0:
                     x = cuda.to_cpu(x)
             else:
@@ -155,31 +297,36 @@ class DaliConverter(object):
             outputs.append(x)
         return tuple(outputs)
 
+    def _subtract_and_cast(self, x):
+        # It subtracts the perturbation and casts to the output dtype in one
+        # pass, writing into the copied buffer itself or into a reused
+        # output buffer.
+        if self.dtype is None or self.dtype == x.dtype:
+            if self.perturbation is not None:
+                x -= self.perturbation
+            return x
+        out = self._pool.get(x.shape, self.dtype)
+        xp = cuda.get_array_module(x)
+        if self.perturbation is not None:
+            xp.subtract(x, self.perturbation, out=out)
+        else:
+            xp.copyto(out, x, casting='same_kind')
+        return out
+
+    @property
+    def n_allocations(self):
+        return self._pool.n_allocations
+
+
+_default_converter = None
+
 
 def dali_converter(inputs, device=None):
-    """Convert DALI arrays to Numpy/CuPy arrays"""
-
-    outputs = []
-    for i in range(len(inputs)):
-        x = inputs[i].as_tensor()
-        if (isinstance(x, dali.backend_impl.TensorCPU)):
-            x = np.array(x)
-            if x.ndim == 2 and x.shape[1] == 1:
-                x = x.squeeze(axis=1)
-            if device is not None and device >= 0:
-                x = cuda.to_gpu(x, device)
-        elif (isinstance(x, dali.backend_impl.TensorGPU)):
-            x_cupy = cuda.cupy.empty(shape=x.shape(), dtype=x.dtype())
-            # Synchronization is necessary here to avoid data corruption
-            # because DALI and CuPy will use different CUDA streams.
-            cuda.cupy.cuda.runtime.deviceSynchronize()
-            # copy data from DALI array to CuPy array
-            x.copy_to_external(ctypes.c_void_p(x_cupy.data.ptr))
-            cuda.cupy.cuda.runtime.deviceSynchronize()
-            x = x_cupy
-            if device is not None and device < 0:
-                x = cuda.to_cpu(x)
-        else:
-            raise ValueError('Unexpected object')
-        outputs.append(x)
-    return tuple(outputs)
+    """Convert DALI arrays to new Numpy/CuPy arrays"""
+
+    global _default_converter
+    if _default_converter is None:
+        # It only keeps the copy stream. Outputs are not reused because
+        # callers may hold any number of batches.
+        _default_converter = DaliConverter(n_buffers=None)
+    return _default_converter(inputs, device)
@@ -0,0 +1,274 @@
+import hashlib
+import json
+import multiprocessing
+import os
+
+import numpy as np
+
+import chainer
+
+
+# Size of the header of each record in the ring, which also aligns records.
+_align = 16
+_max_ndim = 3
+
+
+def _record_size(nbytes):
+    return (_align + nbytes + _align - 1) // _align * _align
+
+
+def _raw_array(dtype, size):
+    # Zero-filled array in shared memory inherited by child processes.
+    return multiprocessing.RawArray('b', size * np.dtype(dtype).itemsize)
+
+
+def file_digest(path):
+    """Returns the SHA-1 hex digest of the content of a file."""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class CachedImageDataset(chainer.dataset.DatasetMixin):
+
+    """Decoded image cache in front of an image dataset.
+
+    It keeps decoded images as uint8 arrays in a byte-budgeted cache in
+    shared memory, so later epochs and validation passes skip reading and
+    decoding them. The cache is allocated when the dataset is made, and
+    ``MultiprocessIterator`` workers inherit it, so all processes share
+    one budget and see the images decoded by each other.
+
+    Images are appended to a ring buffer, and the oldest ones are evicted
+    when it is full. An image hit in the older half of the ring is moved to
+    its head, so eviction approximates least recently used. Images may
+    have different shapes.
+
+    Optionally, images are also spilled to a memory-mapped uint8 file,
+    which is reused by later runs. The spill file requires all images to
+    have the same shape.
+
+    The base dataset must return ``(image, label)`` pairs whose images have
+    integral values in [0, 255] and at most three dimensions (e.g.
+    ``LabeledImageDataset``), and whose labels are int32 values.
+
+    Args:
+        base: Base dataset.
+        max_bytes: Byte budget of the shared cache. Each image takes its
+            size plus a 16-byte header, rounded up to 16 bytes.
+        spill_path: Path of the memory-mapped file. Labels and flags telling
+            which images are stored are kept in ``spill_path + '.labels'``
+            and ``spill_path + '.flags'``, and a header identifying the
+            content in ``spill_path + '.header'``.
+        image_shape: Shape of each image in the spill file. If ``None``, it
+            is taken from the first image of ``base``.
+        spill_key: String identifying the content of ``base``, e.g. a
+            digest of its list file by :func:`file_digest`. Existing spill
+            files are reused only if they were made with the same key,
+            number of images and image shape.
+    """
+
+    def __init__(self, base, max_bytes=0, spill_path=None, image_shape=None,
+                 spill_key=''):
+        self.base = base
+        self.max_bytes = max_bytes - max_bytes % _align
+        # Hits and misses of this process.
+        self.hits = 0
+        self.misses = 0
+
+        self._shared = None
+        self._lock = None
+        self._views = None
+        if self.max_bytes > 0:
+            n = len(base)
+            self._shared = {
+                'arena': _raw_array(np.uint8, self.max_bytes),
+                # head, tail (positions of the ring counted from the
+                # beginning) and bytes of cached images.
+                'state': _raw_array(np.int64, 3),
+                # Position of the record of each image, or -1.
+                'entries': _raw_array(np.int64, n),
+                'shapes': _raw_array(np.int32, n * (_max_ndim + 1)),
+                'labels': _raw_array(np.int32, n),
+            }
+            self._lock = multiprocessing.Lock()
+            self._get_views()['entries'][:] = -1
+
+        self._spill = None
+        self._labels = None
+        self._flags = None
+        if spill_path is not None:
+            if image_shape is None:
+                image_shape = self.base[0][0].shape
+            self._open_spill(spill_path, tuple(image_shape), spill_key)
+
+    def __getstate__(self):
+        # Views are made again from the shared arrays in each process.
+        state = self.__dict__.copy()
+        state['_views'] = None
+        return state
+
+    def _get_views(self):
+        if self._views is None:
+            shared = self._shared
+            views = {
+                name: np.frombuffer(shared[name], dtype=dtype)
+                for name, dtype in (
+                    ('arena', np.uint8), ('state', np.int64),
+                    ('entries', np.int64), ('shapes', np.int32),
+                    ('labels', np.int32))}
+            views['shapes'] = views['shapes'].reshape(-1, _max_ndim + 1)
+            self._views = views
+        return self._views
+
+    def _open_spill(self, path, image_shape, key):
+        n = len(self.base)
+        files = [
+            (path, np.uint8, (n,) + image_shape),
+            (path + '.labels', np.int32, (n,)),
+            (path + '.flags', np.uint8, (n,)),
+        ]
+        header_path = path + '.header'
+        header = json.dumps({'key': key, 'n': n, 'shape': list(image_shape)},
+                            sort_keys=True)
+        valid = os.path.exists(header_path) and all(
+            os.path.exists(p) and os.path.getsize(p) ==
+            int(np.prod(shape)) * np.dtype(dtype).itemsize
+            for p, dtype, shape in files)
+        if valid:
+            with open(header_path) as f:
+                valid = f.read() == header
+        if not valid:
+            # (Re)create all files. The flags start as zero (not cached),
+            # and the header is written last so that files interrupted while
+            # being created are not reused.
+            if os.path.exists(header_path):
+                os.remove(header_path)
+            for p, dtype, shape in files:
+                np.memmap(p, dtype=dtype, mode='w+', shape=shape).flush()
+            with open(header_path, 'w') as f:
+                f.write(header)
+        self._spill, self._labels, self._flags = [
+            np.memmap(p, dtype=dtype, mode='r+', shape=shape)
+            for p, dtype, shape in files]
+
+    def __len__(self):
+        return len(self.base)
+
+    @property
+    def nbytes(self):
+        """Bytes of the images in the shared cache."""
+        if self._shared is None:
+            return 0
+        return int(self._get_views()['state'][2])
+
+    def _evict(self, views):
+        # Removes the oldest record of the ring.
+        arena, state = views['arena'], views['state']
+        tail = int(state[1])
+        pos = tail % self.max_bytes
+        i, length = arena[pos:pos + _align].view(np.int64)
+        if i >= 0:
+            views['entries'][i] = -1
+            state[2] -= length - _align
+        state[1] = tail + _record_size(length - _align)
+
+    def _put(self, views, i, image, label):
+        # Appends an image to the ring. The lock must be held.
+        size = _record_size(image.nbytes)
+        arena, state = views['arena'], views['state']
+        while True:
+            head = int(state[0])
+            free = self.max_bytes - (head - int(state[1]))
+            rest = self.max_bytes - head % self.max_bytes
+            if rest < size:
+                # Records do not wrap around. The rest is skipped with a
+                # record without an image.
+                if free < rest:
+                    self._evict(views)
+                    continue
+                pos = head % self.max_bytes
+                arena[pos:pos + _align].view(np.int64)[:] = (-1, rest)
+                state[0] = head + rest
+                continue
+            if free < size:
+                self._evict(views)
+                continue
+            break
+
+        pos = head % self.max_bytes
+        arena[pos:pos + _align].view(np.int64)[:] = (
+            i, _align + image.nbytes)
+        arena[pos + _align:pos + _align + image.nbytes] = image.ravel()
+        shape = views['shapes'][i]
+        shape[0] = image.ndim
+        shape[1:1 + image.ndim] = image.shape
+        views['labels'][i] = label
+        views['entries'][i] = head
+        state[0] = head + size
+        state[2] += image.nbytes
+
+    def _get_cached(self, i):
+        views = self._get_views()
+        with self._lock:
+            head = views['entries'][i]
+            if head < 0:
+                return None
+            pos = head % self.max_bytes
+            shape = views['shapes'][i]
+            shape = tuple(shape[1:1 + shape[0]])
+            nbytes = int(np.prod(shape))
+            image = views['arena'][pos + _align:pos + _align + nbytes] \
+                .reshape(shape).copy()
+            label = np.array(views['labels'][i], dtype=np.int32)
+            state = views['state']
+            if head - state[1] < (state[0] - state[1]) // 2:
+                # Move the image in the older half to the head.
+                views['arena'][pos:pos + _align].view(np.int64)[0] = -1
+                views['entries'][i] = -1
+                state[2] -= nbytes
+                self._put(views, i, image, label)
+        return image, label
+
+    def _cache(self, i, image, label):
+        if _record_size(image.nbytes) > self.max_bytes or \
+                image.ndim > _max_ndim:
+            return
+        views = self._get_views()
+        with self._lock:
+            # Another process may have cached it.
+            if views['entries'][i] < 0:
+                self._put(views, i, image, label)
+
+    def _get_uint8(self, i):
+        if self._shared is not None:
+            entry = self._get_cached(i)
+            if entry is not None:
+                self.hits += 1
+                return entry
+
+        if self._flags is not None and self._flags[i]:
+            self.hits += 1
+            image = np.array(self._spill[i])
+            label = np.array(self._labels[i], dtype=np.int32)
+        else:
+            self.misses += 1
+            image, label = self.base[i]
+            image = image.astype(np.uint8)
+            if self._spill is not None and \
+                    image.shape == self._spill.shape[1:]:
+                self._spill[i] = image
+                self._labels[i] = label
+                # Set the flag after the image so that readers in other
+                # processes never see a partially written image.
+                self._flags[i] = 1
+        if self._shared is not None:
+            self._cache(i, image, label)
+        return image, label
+
+    def get_example(self, i):
+        image, label = self._get_uint8(i)
+        # Return a new float32 array because callers may modify it in place.
+        return image.astype(np.float32), label
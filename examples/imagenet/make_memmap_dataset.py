@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+"""Convert an image-label list file into a memory-mapped uint8 dataset.
+
+It reads the same list file as compute_mean.py and train_imagenet.py, and
+writes all images resized to the given size into ``<output>_images.npy``
+as a (N, 3, size, size) uint8 array, and their labels into
+``<output>_labels.npy`` as an int32 array. The images file is read by
+memmap_dataset.MemmapImageDataset without decoding any image.
+
+"""
+import argparse
+import multiprocessing
+import sys
+
+import numpy as np
+from PIL import Image
+
+import chainer
+
+
+def _to_chw(image, size):
+    if image.shape[0] == 1:
+        image = np.broadcast_to(image, (3,) + image.shape[1:])
+    elif image.shape[0] == 4:
+        image = image[:3]
+    if image.shape[1:] != (size, size):
+        resized = Image.fromarray(np.ascontiguousarray(
+            image.transpose(1, 2, 0))).resize((size, size), Image.BILINEAR)
+        image = np.asarray(resized, dtype=np.uint8).transpose(2, 0, 1)
+    return image
+
+
+_worker_dataset = None
+_worker_images = None
+
+
+def _init_worker(dataset, output):
+    # The list file is parsed and the output is opened once per worker.
+    global _worker_dataset, _worker_images
+    _worker_dataset = dataset
+    _worker_images = np.load(output + '_images.npy', mmap_mode='r+')
+
+
+def _convert_range(args):
+    size, start, stop = args
+    labels = np.empty(stop - start, dtype=np.int32)
+    for i in range(start, stop):
+        image, label = _worker_dataset[i]
+        _worker_images[i] = _to_chw(image, size)
+        labels[i - start] = label
+    _worker_images.flush()
+    return start, labels
+
+
+def convert(path, root, output, size, n_processes=1, chunk_size=1000):
+    dataset = chainer.datasets.LabeledImageDataset(path, root, dtype=np.uint8)
+    n = len(dataset)
+    images = np.lib.format.open_memmap(
+        output + '_images.npy', mode='w+', dtype=np.uint8,
+        shape=(n, 3, size, size))
+    del images
+    labels = np.empty(n, dtype=np.int32)
+
+    tasks = [(size, start, min(start + chunk_size, n))
+             for start in range(0, n, chunk_size)]
+    if n_processes > 1:
+        pool = multiprocessing.Pool(n_processes, initializer=_init_worker,
+                                    initargs=(dataset, output))
+        results = pool.imap_unordered(_convert_range, tasks)
+    else:
+        pool = None
+        _init_worker(dataset, output)
+        results = map(_convert_range, tasks)
+    done = 0
+    for start, chunk_labels in results:
+        labels[start:start + len(chunk_labels)] = chunk_labels
+        done += len(chunk_labels)
+        sys.stderr.write('{} / {}\r'.format(done, n))
+        sys.stderr.flush()
+    sys.stderr.write('\n')
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    np.save(output + '_labels.npy', labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Convert images into a memory-mapped uint8 dataset')
+    parser.add_argument('dataset',
+                        help='Path to image-label list file')
+    parser.add_argument('--root', '-R', default='.',
+                        help='Root directory path of image files')
+    parser.add_argument('--output', '-o', required=True,
+                        help='Prefix of output files')
+    parser.add_argument('--size', '-s', type=int, default=256,
+                        help='Size of resized images')
+    parser.add_argument('--loaderjob', '-j', type=int, default=1,
+                        help='Number of parallel conversion processes')
+    args = parser.parse_args()
+
+    convert(args.dataset, args.root, args.output, args.size,
+            n_processes=args.loaderjob)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import random
+
+import numpy as np
+
+import chainer
+
+
+class MemmapImageDataset(chainer.dataset.DatasetMixin):
+
+    """Dataset served from files made by make_memmap_dataset.py.
+
+    Images are read from one memory-mapped (N, C, H, W) uint8 array, so no
+    file is opened and no image is decoded per sample. It applies the same
+    preprocesses as ``PreprocessedDataset`` of train_imagenet.py.
+
+    Args:
+        prefix: Prefix given to make_memmap_dataset.py as ``--output``.
+        mean: Mean image.
+        crop_size: Size of cropped images.
+        random: If ``True``, crops randomly and flips images randomly.
+        crop_only: If ``True``, examples are ``(crop, label, top, left)``
+            tuples for ``BatchPreprocessConverter``, where ``crop`` is a
+            uint8 view of the memory-mapped array.
+    """
+
+    def __init__(self, prefix, mean, crop_size, random=True,
+                 crop_only=False):
+        self.images = np.load(prefix + '_images.npy', mmap_mode='r')
+        self.labels = np.load(prefix + '_labels.npy')
+        self.mean = mean.astype(np.float32)
+        self.crop_size = crop_size
+        self.random = random
+        self.crop_only = crop_only
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _crop_offset(self):
+        _, _, h, w = self.images.shape
+        crop_size = self.crop_size
+        if self.random:
+            top = random.randint(0, h - crop_size - 1)
+            left = random.randint(0, w - crop_size - 1)
+            flip = bool(random.randint(0, 1))
+        else:
+            top = (h - crop_size) // 2
+            left = (w - crop_size) // 2
+            flip = False
+        return top, left, flip
+
+    def get_crop(self, i, top, left, flip):
+        # It returns a view of the memory-mapped array without any copy.
+        image = self.images[i]
+        if flip:
+            image = image[:, :, ::-1]
+        crop_size = self.crop_size
+        return image[:, top:top + crop_size, left:left + crop_size]
+
+    def get_example(self, i):
+        top, left, flip = self._crop_offset()
+        image = self.get_crop(i, top, left, flip)
+        if self.crop_only:
+            return image, self.labels[i], top, left
+        image = image.astype(np.float32)
+        crop_size = self.crop_size
+        image -= self.mean[:, top:top + crop_size, left:left + crop_size]
+        image *= (1.0 / 255.0)  # Scale to [0, 1]
+        return image, self.labels[i]
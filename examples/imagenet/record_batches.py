@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+"""Record preprocessed minibatches for deterministic benchmarking.
+
+It loads images of a list file by ``PreprocessedDataset`` of
+train_imagenet.py with ``MultiprocessIterator``, as train_imagenet.py
+does, and records the first ``--n_batches`` converted minibatches into
+memory-mapped files ``<output>_0.npy`` (images), ``<output>_1.npy``
+(labels) and ``<output>_meta.json``. train_imagenet.py replays them with
+``--replay <output>`` without the dataset and without decoding any image.
+
+"""
+import argparse
+
+import numpy as np
+
+import chainer
+
+from chainer_profutil import record_batches
+
+from train_imagenet import PreprocessedDataset
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Record preprocessed minibatches into memory-mapped files')
+    parser.add_argument('dataset',
+                        help='Path to image-label list file')
+    parser.add_argument('--root', '-R', default='.',
+                        help='Root directory path of image files')
+    parser.add_argument('--mean', '-m', default='mean.npy',
+                        help='Mean file (computed by compute_mean.py)')
+    parser.add_argument('--insize', type=int, default=224,
+                        help=('Size of cropped images (227 for alex and nin, '
+                              '224 for the others)'))
+    parser.add_argument('--batchsize', '-B', type=int, default=32,
+                        help='Minibatch size')
+    parser.add_argument('--n_batches', '-n', type=int, default=100,
+                        help='Number of minibatches to record')
+    parser.add_argument('--val', action='store_true',
+                        help='Crop the center without flipping')
+    parser.add_argument('--loaderjob', '-j', type=int,
+                        help='Number of parallel data loading processes')
+    parser.add_argument('--output', '-o', required=True,
+                        help='Prefix of output files')
+    args = parser.parse_args()
+
+    mean = np.load(args.mean)
+    dataset = PreprocessedDataset(args.dataset, args.root, mean, args.insize,
+                                  not args.val)
+    iterator = chainer.iterators.MultiprocessIterator(
+        dataset, args.batchsize, shuffle=not args.val,
+        n_processes=args.loaderjob)
+    try:
+        n = record_batches(iterator, args.output, args.n_batches)
+    finally:
+        iterator.finalize()
+    print('Recorded {} minibatches of {} examples into {}_*'.format(
+        n, args.batchsize, args.output))
+
+
+if __name__ == '__main__':
+    main()
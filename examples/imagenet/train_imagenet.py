@@ -9,6 +9,7 @@ ImageDataLayer).
 
 """
 import argparse
+import os
 import random
 
 import numpy as np
@@ -18,9 +19,22 @@ from chainer import dataset
 from chainer import training
 from chainer.training import extensions
 
+from chainer_profutil import BatchPreprocessConverter
 from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import DynamicLossScaler
+from chainer_profutil import OverheadGovernor
+from chainer_profutil import PrefetchingUpdater
+from chainer_profutil import RangeFlameGraph
+from chainer_profutil import ReplayConverter
+from chainer_profutil import ReplayIterator
+from chainer_profutil import StackSampler
+from chainer_profutil import StagingConverter
+from chainer_profutil import SyntheticConverter
+from chainer_profutil import SyntheticIterator
 
 import dali_util
+import image_cache
+import memmap_dataset
 
 import alex
 import googlenet
@@ -30,13 +44,45 @@ import resnet50
 import resnext50
 
 
+archs = {
+    'alex': alex.Alex,
+    'alex_fp16': alex.AlexFp16,
+    'googlenet': googlenet.GoogLeNet,
+    'googlenetbn': googlenetbn.GoogLeNetBN,
+    'googlenetbn_fp16': googlenetbn.GoogLeNetBNFp16,
+    'nin': nin.NIN,
+    'resnet50': resnet50.ResNet50,
+    'resnext50': resnext50.ResNeXt50,
+}
+
+# Numbers of the training and the validation images of ILSVRC2012, which
+# set the length of an epoch of synthetic data.
+_n_train_examples = 1281167
+_n_val_examples = 50000
+
+
 class PreprocessedDataset(chainer.dataset.DatasetMixin):
 
-    def __init__(self, path, root, mean, crop_size, random=True):
+    def __init__(self, path, root, mean, crop_size, random=True,
+                 cache_bytes=0, cache_spill=None, crop_only=False):
         self.base = chainer.datasets.LabeledImageDataset(path, root)
+        if cache_bytes > 0 or cache_spill is not None:
+            # Keep decoded images to skip decoding at later epochs.
+            spill_key = ''
+            if cache_spill is not None:
+                # Images of a spill file made for another list are not
+                # reused.
+                spill_key = '{} {}'.format(image_cache.file_digest(path),
+                                           os.path.abspath(root))
+            self.base = image_cache.CachedImageDataset(
+                self.base, max_bytes=cache_bytes, spill_path=cache_spill,
+                spill_key=spill_key)
         self.mean = mean.astype(np.float32)
         self.crop_size = crop_size
         self.random = random
+        # If True, the mean subtraction and the scaling are left to
+        # BatchPreprocessConverter.
+        self.crop_only = crop_only
 
     def __len__(self):
         return len(self.base)
@@ -47,6 +93,8 @@ class PreprocessedDataset(chainer.dataset.DatasetMixin):
         #     - Cropping (random or center rectangular)
         #     - Random flip
         #     - Scaling to [0, 1] value
+        # With crop_only, it returns the cropped (and flipped) image, the
+        # label and the crop offset instead.
         crop_size = self.crop_size
 
         image, label = self.base[i]
@@ -66,23 +114,14 @@ class PreprocessedDataset(chainer.dataset.DatasetMixin):
         right = left + crop_size
 
         image = image[:, top:bottom, left:right]
+        if self.crop_only:
+            return image, label, top, left
         image -= self.mean[:, top:bottom, left:right]
         image *= (1.0 / 255.0)  # Scale to [0, 1]
         return image, label
 
 
 def main():
-    archs = {
-        'alex': alex.Alex,
-        'alex_fp16': alex.AlexFp16,
-        'googlenet': googlenet.GoogLeNet,
-        'googlenetbn': googlenetbn.GoogLeNetBN,
-        'googlenetbn_fp16': googlenetbn.GoogLeNetBNFp16,
-        'nin': nin.NIN,
-        'resnet50': resnet50.ResNet50,
-        'resnext50': resnext50.ResNeXt50,
-    }
-
     parser = argparse.ArgumentParser(
         description='Learning convnet from ILSVRC2012 dataset')
     parser.add_argument('train', help='Path to training image-label list file')
@@ -113,9 +152,71 @@ def main():
     parser.set_defaults(test=False)
     parser.add_argument('--dali', action='store_true')
     parser.set_defaults(dali=False)
+    parser.add_argument('--dali_dtype', choices=('float16', 'float32'),
+                        help=('Dtype of images converted from DALI outputs. '
+                              'Defaults to the dtype of the model'))
+    parser.add_argument('--memmap', action='store_true',
+                        help=('Regard train and val as prefixes of datasets '
+                              'made by make_memmap_dataset.py'))
+    parser.add_argument('--cache_mb', type=int, default=0,
+                        help=('Size of decoded image cache shared by '
+                              'loader processes in MiB'))
+    parser.add_argument('--cache_spill_dir',
+                        help=('Directory of memory-mapped files shared by '
+                              'loader processes to cache decoded images'))
+    parser.add_argument('--batch_preprocess', action='store_true',
+                        help=('Only decode and crop images in the loader '
+                              'processes, and subtract the mean while '
+                              'assembling each minibatch'))
+    parser.add_argument('--dynamic_loss_scale', action='store_true',
+                        help=('Use dynamic loss scaling and float32 master '
+                              'weights (e.g. for alex_fp16, requires '
+                              '--nvtx_mark)'))
+    parser.add_argument('--staging', action='store_true',
+                        help=('Concatenate examples into reused (pinned) '
+                              'batch buffers'))
+    parser.add_argument('--prefetch', type=int, default=0,
+                        help=('Number of batches converted and transferred '
+                              'ahead in a background thread'))
+    parser.add_argument('--synthetic', action='store_true',
+                        help=('Train on a single random batch instead of '
+                              'the dataset to measure the model throughput '
+                              '(train, val and the mean file are ignored)'))
+    parser.add_argument('--replay',
+                        help=('Prefix of minibatches recorded by '
+                              'record_batches.py to train on instead of the '
+                              'dataset (train and the mean file are '
+                              'ignored)'))
+    parser.add_argument('--replay_val',
+                        help=('Prefix of recorded minibatches to validate on '
+                              '(defaults to --replay)'))
+    parser.add_argument('--accum_steps', type=int, default=1,
+                        help=('Number of micro-batches each minibatch is '
+                              'split into for gradient accumulation '
+                              '(requires --nvtx_mark)'))
+
+    parser.add_argument('--flame_graph',
+                        help=('Write a flame graph of the ranges of the last '
+                              '100 iterations into this file (.svg, .html, '
+                              'or collapsed stacks otherwise, requires '
+                              '--nvtx_mark)'))
+    parser.add_argument('--sample_stacks',
+                        help=('Sample Python stacks of the training thread '
+                              'and write them as collapsed stacks tagged '
+                              'with the open ranges into this file'))
+    parser.add_argument('--sample_interval', type=float, default=0.005,
+                        help='Stack sampling interval in seconds')
+    parser.add_argument('--overhead_budget', type=float, default=0,
+                        help=('Keep the overhead of profiling under this '
+                              'percentage of the iteration time by lowering '
+                              'the synchronization level and the sampling '
+                              'rate (requires --nvtx_mark)'))
 
     parser.add_argument('--nvtx_mark', action='store_true',
                         help='Enable NVTX\'s marks during profiling by nvprof.')
+    parser.add_argument('--sync_level', type=int, default=2,
+                        choices=(1, 2, 3),
+                        help='Synchronization level of NVTX\'s marks')
     parser.add_argument('--iter', type=int, default=0,
                         help=('Number of iterations for profiling.'
                               ' NOTE: this option is preferred over epoch option.'))
@@ -132,9 +233,30 @@ def main():
             args.gpu).use()  # Make the GPU current
         model.to_gpu()
 
-    # Load the mean file
-    mean = np.load(args.mean)
-    if args.dali:
+    if args.synthetic:
+        # One pre-generated batch of the input size of the model is used
+        # in every iteration, so nothing is read nor converted.
+        insize = model.insize
+        dtype = getattr(model, 'dtype', np.float32)
+        train_iter = SyntheticIterator(
+            args.batchsize, (3, insize, insize), dtype=dtype,
+            n_examples=_n_train_examples)
+        val_iter = SyntheticIterator(
+            args.val_batchsize, (3, insize, insize), dtype=dtype,
+            n_examples=_n_val_examples, repeat=False, seed=1)
+        converter = SyntheticConverter()
+        val_converter = converter
+    elif args.replay:
+        # Recorded minibatches are served from memory-mapped files in the
+        # same order in every run.
+        train_iter = ReplayIterator(args.replay)
+        val_iter = ReplayIterator(args.replay_val or args.replay,
+                                  repeat=False)
+        converter = ReplayConverter()
+        val_converter = converter
+    elif args.dali:
+        # Load the mean file
+        mean = np.load(args.mean)
         if not dali_util._dali_available:
             raise RuntimeError('DALI seems not available on your system.')
         num_threads = args.loaderjob
@@ -152,30 +274,82 @@ def main():
         train_iter = chainer.iterators.DaliIterator(train_pipe)
         val_iter = chainer.iterators.DaliIterator(val_pipe, repeat=False)
         # converter = dali_converter
-        converter = dali_util.DaliConverter(mean=mean, crop_size=model.insize)
+        dali_dtype = args.dali_dtype
+        if dali_dtype is None:
+            dali_dtype = getattr(model, 'dtype', np.float32)
+        # Returned buffers are reused, so the training converter has one
+        # for each batch alive with --prefetch.
+        converter = dali_util.DaliConverter(mean=mean, crop_size=model.insize,
+                                            n_buffers=args.prefetch + 2,
+                                            dtype=dali_dtype)
+        val_converter = dali_util.DaliConverter(
+            mean=mean, crop_size=model.insize, dtype=dali_dtype)
     else:
-        # Load the dataset files
-        train = PreprocessedDataset(args.train, args.root, mean, model.insize)
-        val = PreprocessedDataset(args.val, args.root, mean, model.insize,
-                                  False)
-        # These iterators load the images with subprocesses running in parallel
-        # to the training/validation.
+        # Load the mean and dataset files
+        mean = np.load(args.mean)
+        cache_bytes = args.cache_mb * 1024 * 1024
+        train_spill = None
+        val_spill = None
+        if args.cache_spill_dir:
+            train_spill = os.path.join(args.cache_spill_dir, 'train.cache')
+            val_spill = os.path.join(args.cache_spill_dir, 'val.cache')
+        if args.memmap:
+            train = memmap_dataset.MemmapImageDataset(
+                args.train, mean, model.insize,
+                crop_only=args.batch_preprocess)
+            val = memmap_dataset.MemmapImageDataset(
+                args.val, mean, model.insize, False,
+                crop_only=args.batch_preprocess)
+        else:
+            train = PreprocessedDataset(args.train, args.root, mean,
+                                        model.insize,
+                                        cache_bytes=cache_bytes,
+                                        cache_spill=train_spill,
+                                        crop_only=args.batch_preprocess)
+            val = PreprocessedDataset(args.val, args.root, mean, model.insize,
+                                      False, cache_bytes=cache_bytes,
+                                      cache_spill=val_spill,
+                                      crop_only=args.batch_preprocess)
+        # These iterators load the images with subprocesses running in
+        # parallel to the training/validation.
         train_iter = chainer.iterators.MultiprocessIterator(
             train, args.batchsize, n_processes=args.loaderjob)
         val_iter = chainer.iterators.MultiprocessIterator(
-            val, args.val_batchsize, repeat=False, n_processes=args.loaderjob)
-        converter = dataset.concat_examples
+            val, args.val_batchsize, repeat=False,
+            n_processes=args.loaderjob)
+        if args.batch_preprocess:
+            # The loader processes only decode and crop images, and the
+            # converter subtracts the mean while assembling each minibatch.
+            converter = BatchPreprocessConverter(
+                mean, n_buffers=args.prefetch + 2)
+            val_converter = BatchPreprocessConverter(mean)
+        elif args.staging:
+            converter = StagingConverter(n_buffers=args.prefetch + 2)
+            val_converter = StagingConverter()
+        else:
+            converter = dataset.concat_examples
+            val_converter = converter
 
     # Set up an optimizer
     optimizer = chainer.optimizers.MomentumSGD(lr=0.01, momentum=0.9)
     if args.nvtx_mark:
+        loss_scaler = None
+        if args.dynamic_loss_scale:
+            loss_scaler = DynamicLossScaler()
         optimizer = create_marked_profile_optimizer(
-            optimizer, sync=True, sync_level=2)
+            optimizer, sync=True, sync_level=args.sync_level,
+            loss_scaler=loss_scaler,
+            accum_steps=args.accum_steps)
     optimizer.setup(model)
 
     # Set up a trainer
-    updater = training.updaters.StandardUpdater(
-        train_iter, optimizer, converter=converter, device=args.gpu)
+    if args.prefetch > 0:
+        updater = PrefetchingUpdater(
+            train_iter, optimizer, converter=converter, device=args.gpu,
+            depth=args.prefetch)
+    else:
+        updater = training.updaters.StandardUpdater(
+            train_iter, optimizer, converter=converter, device=args.gpu)
 
     if args.iter > 0:
         # Evaluation and etc are skipped during profiling
@@ -187,7 +361,8 @@ def main():
         val_interval = (1 if args.test else 100000), 'iteration'
         log_interval = (1 if args.test else 1000), 'iteration'
 
-        trainer.extend(extensions.Evaluator(val_iter, model, converter=converter,
+        trainer.extend(extensions.Evaluator(val_iter, model,
+                                            converter=val_converter,
                                             device=args.gpu), trigger=val_interval)
         trainer.extend(extensions.dump_graph('main/loss'))
         trainer.extend(extensions.snapshot(), trigger=val_interval)
@@ -206,7 +381,38 @@ def main():
         if args.resume:
             chainer.serializers.load_npz(args.resume, trainer)
 
-    trainer.run()
+    if args.flame_graph:
+        flame_graph = RangeFlameGraph(window=100).attach()
+    sampler = None
+    if args.sample_stacks:
+        sampler = StackSampler(interval=args.sample_interval)
+    governor = None
+    if args.overhead_budget > 0:
+        if not args.nvtx_mark:
+            raise ValueError('--overhead_budget requires --nvtx_mark.')
+        governor = OverheadGovernor(
+            optimizer, budget=args.overhead_budget / 100., sampler=sampler)
+        governor.attach()
+    if sampler is not None:
+        # e.g. flamegraph.pl <file> > flame.svg
+        with sampler:
+            trainer.run()
+        sampler.write_collapsed(args.sample_stacks)
+    else:
+        trainer.run()
+    if governor is not None:
+        governor.detach()
+        for change in governor.changes:
+            print(change)
+
+    if args.flame_graph:
+        flame_graph.detach()
+        if args.flame_graph.endswith('.svg'):
+            flame_graph.write_svg(args.flame_graph)
+        elif args.flame_graph.endswith('.html'):
+            flame_graph.write_html(args.flame_graph)
+        else:
+            flame_graph.write_collapsed(args.flame_graph)
 
 
 if __name__ == '__main__':
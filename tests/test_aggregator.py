@@ -0,0 +1,171 @@
+
+
+import unittest
+
+from chainer_profutil import ProfileAggregator
+from chainer_profutil.profiled_optimizer import _range_listeners
+
+
+def _run_iteration(aggregator, start, fwd, bwd, upd):
+    t = start
+    aggregator.range_pushed('iteration', t)
+    aggregator.range_pushed('model.forward', t)
+    aggregator.range_popped('model.forward', t, t + fwd)
+    t += fwd
+    aggregator.range_pushed('model.backward', t)
+    aggregator.range_pushed('Convolution2DFunction.backward', t)
+    aggregator.range_popped('Convolution2DFunction.backward', t, t + bwd)
+    aggregator.range_popped('model.backward', t, t + bwd)
+    t += bwd
+    aggregator.range_pushed('model.update', t)
+    aggregator.range_popped('model.update', t, t + upd)
+    t += upd
+    aggregator.range_popped('iteration', start, t)
+    return t
+
+
+class TestProfileAggregator(unittest.TestCase):
+    def test_collect_series(self):
+        aggregator = ProfileAggregator(max_len=3)
+        t = 0.0
+        for i in range(5):
+            t = _run_iteration(aggregator, t, 1.0 + i, 2.0, 0.5)
+
+        self.assertEqual(aggregator.iteration, 5)
+        self.assertEqual(aggregator.iterations(), [3, 4, 5])
+        self.assertEqual(aggregator.series('model.forward'), [3.0, 4.0, 5.0])
+        self.assertEqual(aggregator.series('model.backward'), [2.0] * 3)
+        self.assertEqual(aggregator.series('iteration'), [5.5, 6.5, 7.5])
+
+        summary = aggregator.summary()
+        self.assertEqual(summary['model.update']['count'], 3)
+        self.assertAlmostEqual(summary['model.forward']['mean'], 4.0)
+
+    def test_detect_spike_with_mad(self):
+        aggregator = ProfileAggregator(detector='mad', min_samples=5)
+        t = 0.0
+        for i in range(20):
+            fwd = 1.0 + 0.01 * (i % 3)
+            upd = 5.0 if i == 14 else 0.5 + 0.01 * (i % 2)
+            t = _run_iteration(aggregator, t, fwd, 2.0, upd)
+
+        phases = {(a.iteration, a.phase) for a in aggregator.anomalies}
+        self.assertIn((15, 'model.update'), phases)
+        self.assertIn((15, 'iteration'), phases)
+        self.assertNotIn((15, 'model.forward'), phases)
+        self.assertEqual(len(phases), 2)
+
+    def test_detect_spike_with_ewma(self):
+        aggregator = ProfileAggregator(detector='ewma', min_samples=5)
+        t = 0.0
+        for i in range(20):
+            fwd = 8.0 if i == 10 else 1.0 + 0.01 * (i % 3)
+            t = _run_iteration(aggregator, t, fwd, 2.0, 0.5)
+
+        anomalies = [a for a in aggregator.anomalies
+                     if a.phase == 'model.forward']
+        self.assertEqual(len(anomalies), 1)
+        self.assertEqual(anomalies[0].iteration, 11)
+        self.assertAlmostEqual(anomalies[0].duration, 8.0)
+
+    def test_sum_up_micro_batches(self):
+        aggregator = ProfileAggregator()
+        aggregator.range_popped('model.forward#0', 0.0, 1.0)
+        aggregator.range_popped('model.backward#0', 1.0, 3.0)
+        aggregator.range_popped('model.forward#1', 3.0, 4.5)
+        aggregator.range_popped('model.backward#1', 4.5, 6.0)
+        aggregator.range_popped('model.update', 6.0, 6.5)
+        aggregator.range_popped('iteration', 0.0, 6.5)
+        self.assertEqual(aggregator.series('model.forward'), [2.5])
+        self.assertEqual(aggregator.series('model.backward'), [3.5])
+
+    def test_detect_warmup(self):
+        aggregator = ProfileAggregator(warmup_window=5)
+        t = 0.0
+        # Slow iterations decaying into the steady state, with a spike in
+        # the steady state.
+        fwds = [20.0, 9.0, 5.0, 3.0, 2.0, 1.5]
+        fwds += [1.0 + 0.01 * (i % 3) for i in range(30)]
+        fwds[20] = 10.0
+        for fwd in fwds:
+            t = _run_iteration(aggregator, t, fwd, 2.0, 0.5)
+
+        self.assertEqual(aggregator.warmup_iterations(), 6)
+        split = aggregator.summary('split')
+        self.assertEqual(split['warmup_iterations'], 6)
+        self.assertEqual(split['warmup']['iteration']['count'], 6)
+        self.assertEqual(split['steady']['iteration']['count'], 30)
+        self.assertAlmostEqual(split['steady']['model.forward']['median'],
+                               1.01)
+        self.assertEqual(aggregator.summary('steady'), split['steady'])
+        self.assertEqual(aggregator.summary()['iteration']['count'], 36)
+
+    def test_no_warmup(self):
+        aggregator = ProfileAggregator(warmup_window=5)
+        t = 0.0
+        for i in range(20):
+            t = _run_iteration(aggregator, t, 1.0 + 0.01 * (i % 3), 2.0, 0.5)
+        self.assertEqual(aggregator.warmup_iterations(), 0)
+
+    def test_single_slow_iteration(self):
+        # Lazy initialization makes only the first iteration slow.
+        aggregator = ProfileAggregator(warmup_window=5)
+        t = 0.0
+        for i in range(20):
+            fwd = 30.0 if i == 0 else 1.0 + 0.01 * (i % 3)
+            t = _run_iteration(aggregator, t, fwd, 2.0, 0.5)
+        self.assertEqual(aggregator.warmup_iterations(), 1)
+
+    def test_not_stable_yet(self):
+        aggregator = ProfileAggregator(warmup_window=5)
+        t = 0.0
+        for i in range(8):
+            t = _run_iteration(aggregator, t, 1.0, 2.0, 0.5)
+        # Too few iterations to tell.
+        self.assertIsNone(aggregator.warmup_iterations())
+        self.assertEqual(aggregator.summary('steady'), {})
+        self.assertEqual(aggregator.summary('warmup')['iteration']['count'],
+                         8)
+        for i in range(12):
+            t = _run_iteration(aggregator, t, 1.0 + i, 2.0, 0.5)
+        # Still getting slower.
+        self.assertIsNone(aggregator.warmup_iterations())
+
+    def test_fixed_warmup(self):
+        aggregator = ProfileAggregator(max_len=5, warmup=3)
+        t = 0.0
+        for i in range(2):
+            t = _run_iteration(aggregator, t, 1.0, 2.0, 0.5)
+        self.assertEqual(aggregator.warmup_iterations(), 2)
+        for i in range(4):
+            t = _run_iteration(aggregator, t, 1.0, 2.0, 0.5)
+        # The first of the warmup iterations has been dropped.
+        self.assertEqual(aggregator.warmup_iterations(), 2)
+        self.assertEqual(aggregator.summary('steady')['iteration']['count'],
+                         3)
+
+    def test_attach_and_detach(self):
+        aggregator = ProfileAggregator()
+        with aggregator:
+            self.assertIn(aggregator, _range_listeners)
+        self.assertNotIn(aggregator, _range_listeners)
+
+
+class TestProfileAggregatorError(unittest.TestCase):
+    def test_fail_without_iteration_phase(self):
+        with self.assertRaises(ValueError):
+            ProfileAggregator(phases=('model.forward',))
+
+    def test_fail_on_unknown_detector(self):
+        with self.assertRaises(ValueError):
+            ProfileAggregator(detector='unknown')
+
+    def test_fail_on_invalid_warmup(self):
+        with self.assertRaises(ValueError):
+            ProfileAggregator(warmup=-1)
+        with self.assertRaises(ValueError):
+            ProfileAggregator(warmup='first')
+
+    def test_fail_on_unknown_part(self):
+        with self.assertRaises(ValueError):
+            ProfileAggregator().summary('unknown')
@@ -0,0 +1,317 @@
+import threading
+import unittest
+
+import numpy as np
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+
+from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import GradientBucketer
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import remove_range_listener
+
+
+class _ThreadCommunicator(object):
+    # Communicator of processes emulated by threads.
+
+    def __init__(self, rank, size, shared):
+        self.rank = rank
+        self.size = size
+        self._shared = shared
+        self.calls = []
+
+    def allreduce(self, x):
+        shared = self._shared
+        self.calls.append(x.size)
+        shared['inputs'][self.rank] = x.copy()
+        shared['barrier'].wait()
+        ret = sum(shared['inputs'])
+        shared['barrier'].wait()
+        return ret
+
+    def bcast_data(self, model):
+        shared = self._shared
+        if self.rank == 0:
+            shared['params'] = dict((name, param.array.copy())
+                                    for name, param in model.namedparams())
+        shared['barrier'].wait()
+        for name, param in model.namedparams():
+            param.array[...] = shared['params'][name]
+        shared['barrier'].wait()
+
+
+class _MultiNodeOptimizer(object):
+    # Stands for the multi-node optimizer of ChainerMN.
+
+    def __init__(self, actual_optimizer, communicator):
+        super(_MultiNodeOptimizer, self).__setattr__(
+            'actual_optimizer', actual_optimizer)
+        super(_MultiNodeOptimizer, self).__setattr__(
+            'communicator', communicator)
+        super(_MultiNodeOptimizer, self).__setattr__(
+            'target_params', None)
+
+    def setup(self, link):
+        self.actual_optimizer.setup(link)
+        return self
+
+    def is_changed(self, target):
+        previous = self.target_params
+        super(_MultiNodeOptimizer, self).__setattr__(
+            'target_params', [(name, param.array is not None)
+                              for name, param in sorted(target.namedparams())])
+        return previous != self.target_params
+
+    def __getattr__(self, attr_name):
+        return getattr(self.actual_optimizer, attr_name)
+
+    def __setattr__(self, attr_name, value):
+        setattr(self.actual_optimizer, attr_name, value)
+
+
+class _MLP(chainer.Chain):
+    def __init__(self):
+        super(_MLP, self).__init__()
+        with self.init_scope():
+            self.l1 = L.Linear(4, 8)
+            self.l2 = L.Linear(8, 8)
+            self.l3 = L.Linear(8, 3)
+
+    def forward(self, x, t):
+        h = F.relu(self.l1(x))
+        h = F.relu(self.l2(h))
+        return F.softmax_cross_entropy(self.l3(h), t)
+
+
+class _LazyMLP(chainer.Chain):
+    # The last layer, whose parameters are bucketed first, is initialized
+    # in forward.
+
+    def __init__(self):
+        super(_LazyMLP, self).__init__()
+        with self.init_scope():
+            self.l1 = L.Linear(4, 8)
+            self.l2 = L.Linear(8, 8)
+            self.l3 = L.Linear(None, 3)
+
+    def forward(self, x, t):
+        h = F.relu(self.l1(x))
+        h = F.relu(self.l2(h))
+        return F.softmax_cross_entropy(self.l3(h), t)
+
+
+class _RecordingBucketer(GradientBucketer):
+    def __init__(self, communicator, bucket_bytes, backward_done):
+        super(_RecordingBucketer, self).__init__(communicator, bucket_bytes)
+        self._backward_done = backward_done
+        self.launched_in_backward = []
+
+    def _launch(self, bucket):
+        self.launched_in_backward.append(
+            not self._backward_done[self._communicator.rank])
+        super(_RecordingBucketer, self)._launch(bucket)
+
+
+def _make_models(size, model_class=_MLP):
+    models = []
+    for _ in range(size):
+        np.random.seed(0)
+        models.append(model_class())
+    return models
+
+
+def _run_in_threads(size, run):
+    errors = []
+
+    def target(rank):
+        try:
+            run(rank)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=target, args=(rank,))
+               for rank in range(size)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def _mean_grads(models, size):
+    # Mean gradients over the batches of all ranks.
+    grads = {}
+    for rank, model in enumerate(models):
+        model.cleargrads()
+        model(*_make_batch(rank)).backward()
+        for name, param in model.namedparams():
+            grads[name] = grads.get(name, 0) + param.grad / size
+    return grads
+
+
+def _make_batch(rank):
+    rng = np.random.RandomState(rank)
+    x = rng.randn(5, 4).astype(np.float32)
+    t = rng.randint(0, 3, size=5).astype(np.int32)
+    return x, t
+
+
+class TestGradientBucketer(unittest.TestCase):
+    def test_average_gradients_during_backward(self):
+        size = 2
+        shared = {
+            'barrier': threading.Barrier(size),
+            'inputs': [None] * size,
+            'backward_done': [False] * size,
+        }
+        comms = [_ThreadCommunicator(rank, size, shared)
+                 for rank in range(size)]
+        models = _make_models(size)
+        # Each bucket holds at most one layer.
+        bucketers = [_RecordingBucketer(comm, 8 * 8 * 4,
+                                        shared['backward_done'])
+                     for comm in comms]
+        errors = []
+
+        def run(rank):
+            try:
+                model, bucketer = models[rank], bucketers[rank]
+                bucketer.start(model)
+                with bucketer:
+                    loss = model(*_make_batch(rank))
+                    model.cleargrads()
+                    loss.backward()
+                shared['backward_done'][rank] = True
+                bucketer.finish()
+                bucketer.wait()
+                bucketer.close()
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=(rank,))
+                   for rank in range(size)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        expected = _make_models(size)
+        for rank, model in enumerate(expected):
+            model.cleargrads()
+            model(*_make_batch(rank)).backward()
+        for name, param in models[0].namedparams():
+            mean = sum(dict(m.namedparams())[name].grad
+                       for m in expected) / size
+            for model in models:
+                np.testing.assert_allclose(
+                    dict(model.namedparams())[name].grad, mean,
+                    rtol=1e-5, atol=1e-6, err_msg=name)
+
+        for comm, bucketer in zip(comms, bucketers):
+            self.assertGreater(bucketer.n_buckets, 2)
+            self.assertEqual(len(comm.calls), bucketer.n_buckets)
+            self.assertEqual(sum(comm.calls),
+                             sum(p.size for p in models[0].params()))
+            # Buckets of the last layers are launched before backward
+            # finishes, and the first layer only after its backward.
+            self.assertTrue(bucketer.launched_in_backward[0])
+            self.assertFalse(bucketer.launched_in_backward[-1])
+
+    def test_rebuild_buckets_in_finish(self):
+        size = 2
+        shared = {'barrier': threading.Barrier(size), 'inputs': [None] * size}
+        comms = [_ThreadCommunicator(rank, size, shared)
+                 for rank in range(size)]
+        models = _make_models(size, _LazyMLP)
+        bucketers = [GradientBucketer(comm, 8 * 8 * 4) for comm in comms]
+
+        def run(rank):
+            model, bucketer = models[rank], bucketers[rank]
+            bucketer.start(model)
+            with bucketer:
+                loss = model(*_make_batch(rank))
+                model.cleargrads()
+                loss.backward()
+            bucketer.finish()
+            bucketer.wait()
+            bucketer.close()
+
+        self.assertEqual(_run_in_threads(size, run), [])
+        expected = _mean_grads(_make_models(size, _LazyMLP), size)
+        for model in models:
+            for name, param in model.namedparams():
+                np.testing.assert_allclose(
+                    param.grad, expected[name], rtol=1e-5, atol=1e-6,
+                    err_msg=name)
+
+    def test_fail_on_non_positive_bucket_bytes(self):
+        with self.assertRaises(ValueError):
+            GradientBucketer(None, bucket_bytes=0)
+
+
+class _RangeRecorder(object):
+    def __init__(self):
+        self.popped = []
+
+    def range_pushed(self, msg, timestamp):
+        pass
+
+    def range_popped(self, msg, start, end):
+        self.popped.append(msg)
+
+
+class TestBucketedUpdate(unittest.TestCase):
+    def test_update(self):
+        size = 2
+        lr = 0.1
+        shared = {'barrier': threading.Barrier(size), 'inputs': [None] * size}
+        comms = [_ThreadCommunicator(rank, size, shared)
+                 for rank in range(size)]
+        models = _make_models(size)
+        # Parameters of rank 1 are overwritten by the broadcast.
+        for param in models[1].params():
+            param.array[...] = 0
+        optimizers = []
+        for comm, model in zip(comms, models):
+            optimizer = create_marked_profile_optimizer(
+                _MultiNodeOptimizer(chainer.optimizers.SGD(lr=lr), comm),
+                sync=False, grad_bucketer=GradientBucketer(comm, 8 * 8 * 4))
+            optimizer.setup(model)
+            optimizers.append(optimizer)
+        recorder = _RangeRecorder()
+        add_range_listener(recorder)
+        self.addCleanup(remove_range_listener, recorder)
+
+        def run(rank):
+            model, optimizer = models[rank], optimizers[rank]
+            for _ in range(2):
+                optimizer.update(model, *_make_batch(rank))
+            optimizer._grad_bucketer.close()
+
+        self.assertEqual(_run_in_threads(size, run), [])
+
+        # The first update broadcasts the parameters, and the second one
+        # updates them with the averaged gradients.
+        expected = _make_models(1)[0]
+        grads = _mean_grads(_make_models(size), size)
+        for model in models:
+            for name, param in model.namedparams():
+                np.testing.assert_allclose(
+                    param.array,
+                    dict(expected.namedparams())[name].array -
+                    lr * grads[name],
+                    rtol=1e-5, atol=1e-6, err_msg=name)
+        for optimizer in optimizers:
+            self.assertEqual(optimizer.t, 1)
+
+        n_buckets = optimizers[0]._grad_bucketer.n_buckets
+        self.assertGreater(n_buckets, 2)
+        for msg in ['allreduce.wait'] + [
+                'allreduce.bucket{}'.format(k) for k in range(n_buckets)]:
+            # Both ranks wait in both updates, and allreduce each bucket in
+            # both updates.
+            self.assertEqual(recorder.popped.count(msg), 2 * size, msg)
+        self.assertEqual(recorder.popped.count('iteration'), 2 * size)
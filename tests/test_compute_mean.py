@@ -0,0 +1,123 @@
+import importlib.util
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+
+_examples = os.path.join(os.path.dirname(__file__), os.pardir, 'examples')
+
+
+def _load(name, *path):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(_examples, *path))
+    module = importlib.util.module_from_spec(spec)
+    # Worker processes find functions by the name of their module.
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+# The ChainerMN example has the same script.
+_modules = [
+    _load('compute_mean', 'imagenet', 'compute_mean.py'),
+    _load('chainermn_compute_mean', 'chainermn', 'imagenet',
+          'compute_mean.py'),
+]
+
+
+class _Dataset(object):
+    # Image dataset counting reads, which fails at an index if given.
+
+    def __init__(self, n, fail_at=None):
+        rng = np.random.RandomState(0)
+        self.images = rng.randint(0, 256, (n, 3, 4, 5)).astype(np.float32)
+        self.fail_at = fail_at
+        self.reads = []
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        if i == self.fail_at:
+            raise RuntimeError('interrupted')
+        self.reads.append(i)
+        return self.images[i], np.int32(0)
+
+
+class TestComputeMean(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmpdir, 'mean.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _check(self, dataset, ret):
+        mean, std = ret
+        np.testing.assert_allclose(mean, dataset.images.mean(axis=0),
+                                   rtol=1e-6)
+        np.testing.assert_allclose(
+            std, dataset.images.transpose(1, 0, 2, 3).reshape(3, -1).std(
+                axis=1), rtol=1e-5)
+
+    def test_serial_and_parallel(self):
+        for module in _modules:
+            for n_processes in (1, 3):
+                dataset = _Dataset(10)
+                self._check(dataset, module.compute_mean(
+                    dataset, n_processes=n_processes, chunk_size=3,
+                    with_std=True))
+
+    def test_resume(self):
+        for module in _modules:
+            # The computation is interrupted in the third chunk.
+            dataset = _Dataset(10, fail_at=7)
+            with self.assertRaises(RuntimeError):
+                module.compute_mean(dataset, chunk_size=3,
+                                    checkpoint=self.checkpoint,
+                                    checkpoint_interval=1, with_std=True)
+
+            dataset.fail_at = None
+            del dataset.reads[:]
+            self._check(dataset, module.compute_mean(
+                dataset, chunk_size=3, checkpoint=self.checkpoint,
+                with_std=True))
+            # The first two chunks are not read again.
+            self.assertEqual(dataset.reads, [6, 7, 8, 9])
+
+            # The checkpoint of all chunks is reused by worker processes.
+            self._check(dataset, module.compute_mean(
+                dataset, n_processes=2, chunk_size=3,
+                checkpoint=self.checkpoint, with_std=True))
+            os.remove(self.checkpoint)
+
+    def test_resume_in_parallel(self):
+        for module in _modules:
+            dataset = _Dataset(10, fail_at=7)
+            with self.assertRaises(RuntimeError):
+                module.compute_mean(dataset, chunk_size=3,
+                                    checkpoint=self.checkpoint,
+                                    checkpoint_interval=1, with_std=True)
+            dataset.fail_at = None
+            self._check(dataset, module.compute_mean(
+                dataset, n_processes=2, chunk_size=3,
+                checkpoint=self.checkpoint, with_std=True))
+            os.remove(self.checkpoint)
+
+    def test_fail_on_another_checkpoint(self):
+        for module in _modules:
+            module.compute_mean(_Dataset(10), chunk_size=3,
+                                checkpoint=self.checkpoint)
+            with self.assertRaises(ValueError):
+                module.compute_mean(_Dataset(10), chunk_size=4,
+                                    checkpoint=self.checkpoint)
+            os.remove(self.checkpoint)
+
+    def test_fail_on_empty_dataset(self):
+        for module in _modules:
+            with self.assertRaises(ValueError):
+                module.compute_mean(_Dataset(0))
@@ -0,0 +1,172 @@
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+from chainer.backends import cuda
+from chainer.dataset import convert
+
+from chainer_profutil import BatchPreprocessConverter
+from chainer_profutil import StagingConverter
+
+
+def _make_batch(n, seed):
+    rng = np.random.RandomState(seed)
+    return [(rng.randn(3, 4).astype(np.float32), np.int32(i))
+            for i in range(n)]
+
+
+class TestStagingConverter(unittest.TestCase):
+    def test_same_as_concat_examples(self):
+        converter = StagingConverter()
+        batch = _make_batch(5, 0)
+        actual = converter(batch)
+        expected = convert.concat_examples(batch)
+        self.assertEqual(len(actual), 2)
+        for x, y in zip(actual, expected):
+            self.assertEqual(x.dtype, y.dtype)
+            np.testing.assert_array_equal(x, y)
+
+    def test_arrays_and_dicts(self):
+        converter = StagingConverter()
+        arrays = [np.full((2,), i, dtype=np.float32) for i in range(3)]
+        np.testing.assert_array_equal(
+            converter(arrays), convert.concat_examples(arrays))
+        dicts = [{'x': a, 't': np.int32(i)} for i, a in enumerate(arrays)]
+        actual = converter(dicts)
+        np.testing.assert_array_equal(actual['x'], np.stack(arrays))
+        np.testing.assert_array_equal(actual['t'], [0, 1, 2])
+
+    def test_no_allocation_in_steady_state(self):
+        converter = StagingConverter(n_buffers=2)
+        outputs = [converter(_make_batch(4, i)) for i in range(2)]
+        self.assertEqual(converter.n_allocations, 4)
+        allocated_bytes = converter.allocated_bytes
+
+        for i in range(2, 10):
+            x, t = converter(_make_batch(4, i))
+            np.testing.assert_array_equal(
+                x, convert.concat_examples(_make_batch(4, i))[0])
+            # Buffers are used in turn.
+            self.assertIs(x, outputs[i % 2][0])
+        self.assertEqual(converter.n_allocations, 4)
+        self.assertEqual(converter.stats(), {
+            'calls': 10,
+            'allocations': 4,
+            'allocated_bytes': allocated_bytes,
+        })
+
+        # A new shape needs new buffers.
+        converter(_make_batch(3, 0))
+        self.assertEqual(converter.n_allocations, 6)
+
+    def test_fail_on_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            StagingConverter(n_buffers=0)
+        with self.assertRaises(ValueError):
+            StagingConverter()([])
+
+    def test_fail_on_different_shapes(self):
+        batches = [
+            [np.zeros((3, 2, 2)), np.zeros((1, 2, 2))],
+            [np.zeros(3), np.float32(0)],
+            [(np.zeros(2), np.int32(0)), (np.zeros(2), np.zeros(1))],
+        ]
+        for batch in batches:
+            with self.assertRaises(ValueError):
+                StagingConverter()(batch)
+            with self.assertRaises(ValueError):
+                convert.concat_examples(batch)
+
+
+class _FakeDeviceArray(object):
+    def __init__(self, calls, shape, dtype):
+        self._calls = calls
+        self.array = np.empty(shape, dtype=dtype)
+
+    def set(self, host, stream=None):
+        self._calls.append(('set', stream))
+        self.array[...] = host
+
+
+class _FakeEvent(object):
+    def __init__(self, calls):
+        self._calls = calls
+
+    def record(self, stream=None):
+        self._calls.append(('record', stream))
+
+    def synchronize(self):
+        self._calls.append(('synchronize',))
+
+
+def _fake_cupy(calls, stream):
+    return types.SimpleNamespace(
+        empty=lambda shape, dtype: _FakeDeviceArray(calls, shape, dtype),
+        cuda=types.SimpleNamespace(
+            alloc_pinned_memory=bytearray,
+            get_current_stream=lambda: stream,
+            Event=lambda: _FakeEvent(calls)))
+
+
+class TestStagingConverterTransfer(unittest.TestCase):
+    def test_copy_asynchronously_on_current_stream(self):
+        calls = []
+        stream = object()
+        with mock.patch.object(cuda, 'cupy', _fake_cupy(calls, stream),
+                               create=True), \
+                mock.patch.object(cuda, 'get_device_from_id',
+                                  lambda device: mock.MagicMock()):
+            converter = StagingConverter(n_buffers=1)
+            x = converter([np.full((2,), i, dtype=np.float32)
+                           for i in range(3)], device=0)
+            np.testing.assert_array_equal(x.array, [[0, 0], [1, 1], [2, 2]])
+            self.assertEqual(calls, [('set', stream), ('record', stream)])
+
+            # The host buffer is refilled after the previous copy.
+            del calls[:]
+            converter([np.zeros((2,), dtype=np.float32)] * 3, device=0)
+            self.assertEqual(calls, [('synchronize',), ('set', stream),
+                                     ('record', stream)])
+
+
+class TestBatchPreprocessConverter(unittest.TestCase):
+    def test_same_as_per_example_preprocessing(self):
+        rng = np.random.RandomState(0)
+        mean = rng.uniform(0, 255, (3, 8, 8)).astype(np.float32)
+        images = rng.randint(0, 256, (4, 3, 8, 8)).astype(np.uint8)
+        offsets = [(0, 0), (1, 2), (3, 3), (2, 0)]
+        batch = []
+        for k, (top, left) in enumerate(offsets):
+            crop = images[k, :, top:top + 5, left:left + 5]
+            if k % 2:
+                crop = crop[:, :, ::-1]
+            batch.append((crop, np.int32(k), top, left))
+
+        converter = BatchPreprocessConverter(mean)
+        x, t = converter(batch)
+        self.assertEqual(x.dtype, np.float32)
+        self.assertEqual(x.shape, (4, 3, 5, 5))
+        for k, (crop, _, top, left) in enumerate(batch):
+            expected = (crop - mean[:, top:top + 5, left:left + 5]) / 255.0
+            np.testing.assert_allclose(x[k], expected, rtol=1e-6)
+        np.testing.assert_array_equal(t, [0, 1, 2, 3])
+
+    def test_no_allocation_in_steady_state(self):
+        mean = np.zeros((3, 4, 4), dtype=np.float32)
+        batch = [(np.ones((3, 2, 2), dtype=np.uint8), np.int32(0), 1, 1)]
+        converter = BatchPreprocessConverter(mean, n_buffers=2)
+        outputs = [converter(batch) for _ in range(2)]
+        self.assertEqual(converter.n_allocations, 4)
+        for i in range(2, 6):
+            x, _ = converter(batch)
+            self.assertIs(x, outputs[i % 2][0])
+        self.assertEqual(converter.n_allocations, 4)
+
+    def test_fail_on_different_shapes(self):
+        mean = np.zeros((3, 4, 4), dtype=np.float32)
+        batch = [(np.ones((3, 2, 2), dtype=np.uint8), np.int32(0), 1, 1),
+                 (np.ones((1, 2, 2), dtype=np.uint8), np.int32(1), 1, 1)]
+        with self.assertRaises(ValueError):
+            BatchPreprocessConverter(mean)(batch)
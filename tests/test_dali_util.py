@@ -0,0 +1,190 @@
+import os
+import sys
+import tracemalloc
+import types
+import unittest
+from unittest import mock
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'examples', 'imagenet'))
+import dali_util  # NOQA
+
+
+def _inputs(seed, n=2, size=4):
+    rng = np.random.RandomState(seed)
+    images = rng.uniform(-1, 1, (n, 3, size, size)).astype(np.float32)
+    labels = rng.randint(0, 10, (n, 1)).astype(np.int32)
+    return (dali_util.MockTensor(images),
+            dali_util.MockTensor(labels, is_gpu=False))
+
+
+class TestDaliConverter(unittest.TestCase):
+    def test_reuse_buffers(self):
+        backend = dali_util.MockTensorBackend()
+        converter = dali_util.DaliConverter(tensor_backend=backend,
+                                            n_buffers=2)
+        outputs = [converter(_inputs(i)) for i in range(2)]
+        self.assertEqual(converter.n_allocations, 2)
+
+        for i in range(2, 8):
+            inputs = _inputs(i)
+            x, t = converter(inputs)
+            np.testing.assert_array_equal(x, inputs[0].array)
+            np.testing.assert_array_equal(t, inputs[1].array[:, 0])
+            # Buffers are used in turn.
+            self.assertIs(x, outputs[i % 2][0])
+        self.assertEqual(converter.n_allocations, 2)
+        self.assertEqual(backend.n_copies, 8)
+
+    def test_not_reuse_buffers(self):
+        converter = dali_util.DaliConverter(
+            tensor_backend=dali_util.MockTensorBackend(), n_buffers=None)
+        inputs = [_inputs(i) for i in range(3)]
+        outputs = [converter(x) for x in inputs]
+        for x, (y, _) in zip(inputs, outputs):
+            np.testing.assert_array_equal(y, x[0].array)
+        self.assertEqual(converter.n_allocations, 3)
+
+    @mock.patch.object(dali_util, '_default_converter', None)
+    @mock.patch.object(dali_util, '_DaliTensorBackend',
+                       dali_util.MockTensorBackend)
+    def test_dali_converter_returns_new_arrays(self):
+        inputs = [_inputs(i) for i in range(3)]
+        outputs = [dali_util.dali_converter(x) for x in inputs]
+        # Batches returned earlier are not overwritten.
+        for x, (y, _) in zip(inputs, outputs):
+            np.testing.assert_array_equal(y, x[0].array)
+
+
+class _Recorder(object):
+    def __init__(self):
+        self.calls = []
+
+
+class _FakeStream(object):
+    def __init__(self, recorder, name, ptr):
+        self._recorder = recorder
+        self.name = name
+        self.ptr = ptr
+
+    def record(self):
+        event = 'event of {}'.format(self.name)
+        self._recorder.calls.append(('record', self.name))
+        return event
+
+    def wait_event(self, event):
+        self._recorder.calls.append(('wait', self.name, event))
+
+
+def _fake_cupy(recorder):
+    consumer = _FakeStream(recorder, 'consumer', 1)
+
+    def make_stream(non_blocking=False):
+        return _FakeStream(recorder, 'copy', 2)
+
+    def synchronize():
+        recorder.calls.append(('synchronize',))
+
+    cuda = types.SimpleNamespace(
+        Stream=make_stream,
+        get_current_stream=lambda: consumer,
+        runtime=types.SimpleNamespace(deviceSynchronize=synchronize))
+    return types.SimpleNamespace(cuda=cuda)
+
+
+class _TensorGPU(object):
+    def __init__(self, recorder):
+        self._recorder = recorder
+
+    def copy_to_external(self, ptr, cuda_stream=None):
+        """copy_to_external(self, ptr: object, cuda_stream: object = None)"""
+        self._recorder.calls.append(('copy', cuda_stream))
+
+
+class _OldTensorGPU(object):
+    def __init__(self, recorder):
+        self._recorder = recorder
+
+    def copy_to_external(self, ptr):
+        """copy_to_external(self, ptr: object)"""
+        self._recorder.calls.append(('copy', None))
+
+
+class _FailingTensorGPU(_TensorGPU):
+    def copy_to_external(self, ptr, cuda_stream=None):
+        """copy_to_external(self, ptr: object, cuda_stream: object = None)"""
+        raise TypeError('broken')
+
+
+class TestDaliTensorBackend(unittest.TestCase):
+    def setUp(self):
+        self.recorder = _Recorder()
+        patcher = mock.patch.object(dali_util.cuda, 'cupy',
+                                    _fake_cupy(self.recorder), create=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.out = types.SimpleNamespace(data=types.SimpleNamespace(ptr=0))
+
+    def test_copy_in_stream_order(self):
+        backend = dali_util._DaliTensorBackend()
+        backend.copy(_TensorGPU(self.recorder), self.out)
+        self.assertEqual(self.recorder.calls, [
+            # The copy waits for the work queued on the consumer stream,
+            ('record', 'consumer'),
+            ('wait', 'copy', 'event of consumer'),
+            # runs on the copy stream,
+            ('copy', 2),
+            # and the consumer waits for the copy without blocking the host.
+            ('record', 'copy'),
+            ('wait', 'consumer', 'event of copy'),
+        ])
+
+    def test_copy_without_stream_argument(self):
+        backend = dali_util._DaliTensorBackend()
+        backend.copy(_OldTensorGPU(self.recorder), self.out)
+        self.assertEqual(self.recorder.calls, [
+            ('synchronize',), ('copy', None), ('synchronize',)])
+
+    def test_not_mask_errors(self):
+        backend = dali_util._DaliTensorBackend()
+        with self.assertRaises(TypeError):
+            backend.copy(_FailingTensorGPU(self.recorder), self.out)
+
+
+class TestDaliConverterSubtractAndCast(unittest.TestCase):
+    def _check(self, dtype, n_arrays):
+        rng = np.random.RandomState(0)
+        mean = rng.uniform(0, 255, (3, 80, 80)).astype(np.float32)
+        converter = dali_util.DaliConverter(
+            mean=mean, crop_size=64, dtype=dtype,
+            tensor_backend=dali_util.MockTensorBackend())
+        outputs = []
+        for i in range(6):
+            inputs = _inputs(i, n=8, size=64)
+            tracemalloc.start()
+            try:
+                x, _ = converter(inputs)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            if i >= 2:
+                # No temporary of the size of the batch is allocated.
+                self.assertLess(peak, inputs[0].array.nbytes // 2)
+            self.assertEqual(x.dtype, dtype)
+            expected = (inputs[0].array -
+                        converter.perturbation).astype(dtype)
+            np.testing.assert_array_equal(x, expected)
+            outputs.append(x)
+        # Only the reused buffers are allocated: the copy of the DALI output
+        # and, when casting, the output.
+        self.assertEqual(converter.n_allocations, 2 * n_arrays)
+        for i in range(2, 6):
+            self.assertIs(outputs[i], outputs[i % 2])
+
+    def test_float16(self):
+        self._check(np.float16, 2)
+
+    def test_float32(self):
+        self._check(np.float32, 1)
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from xml.etree import ElementTree
+
+from chainer_profutil import RangeFlameGraph
+from chainer_profutil import render_flame_graph
+from chainer_profutil.profiled_optimizer import time_range
+
+
+def _run_iteration(recorder, t):
+    recorder.range_pushed('iteration', t)
+    recorder.range_pushed('model.forward', t)
+    recorder.range_pushed('Linear', t)
+    recorder.range_popped('Linear', t, t + 2.0)
+    recorder.range_popped('model.forward', t, t + 3.0)
+    recorder.range_pushed('model.backward#0', t + 3.0)
+    recorder.range_popped('model.backward#0', t + 3.0, t + 4.0)
+    recorder.range_pushed('model.backward#1', t + 4.0)
+    recorder.range_popped('model.backward#1', t + 4.0, t + 5.0)
+    recorder.range_pushed('model.update', t + 5.0)
+    recorder.range_popped('model.update', t + 5.0, t + 5.5)
+    recorder.range_popped('iteration', t, t + 6.0)
+    return t + 6.0
+
+
+class TestRangeFlameGraph(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_self_times(self):
+        recorder = RangeFlameGraph(window=2)
+        t = 0.0
+        for _ in range(3):
+            t = _run_iteration(recorder, t)
+        self.assertEqual(recorder.iteration, 3)
+        stacks = recorder.stacks()
+        # The last two iterations are aggregated.
+        self.assertAlmostEqual(stacks['iteration'], 1.0)
+        self.assertAlmostEqual(stacks['iteration;model.forward'], 2.0)
+        self.assertAlmostEqual(stacks['iteration;model.forward;Linear'], 4.0)
+        self.assertAlmostEqual(stacks['iteration;model.backward'], 4.0)
+        self.assertAlmostEqual(stacks['iteration;model.update'], 1.0)
+        self.assertAlmostEqual(sum(stacks.values()), 12.0)
+
+        lines = recorder.collapsed().splitlines()
+        self.assertIn('iteration;model.forward;Linear 4000000', lines)
+        self.assertEqual(len(lines), 5)
+
+    def test_ranges_of_threads(self):
+        recorder = RangeFlameGraph()
+
+        def target():
+            with time_range('batch.prefetch'):
+                pass
+
+        with recorder:
+            with time_range('iteration'):
+                thread = threading.Thread(target=target, name='loader')
+                thread.start()
+                thread.join()
+        stacks = recorder.stacks()
+        self.assertIn('iteration', stacks)
+        self.assertIn('loader;batch.prefetch', stacks)
+
+    def test_svg_and_html(self):
+        recorder = RangeFlameGraph()
+        _run_iteration(recorder, 0.0)
+        svg_path = os.path.join(self.tmpdir, 'flame.svg')
+        recorder.write_svg(svg_path, title='<test>')
+        root = ElementTree.parse(svg_path).getroot()
+        ns = '{http://www.w3.org/2000/svg}'
+        titles = [e.text for e in root.iter(ns + 'title')]
+        self.assertIn('all (6000 ms, 100.00%)', titles)
+        self.assertIn('Linear (2000 ms, 33.33%)', titles)
+        texts = [e.text for e in root.iter(ns + 'text')]
+        self.assertIn('<test>', texts)
+
+        html_path = os.path.join(self.tmpdir, 'flame.html')
+        recorder.write_html(html_path)
+        with open(html_path) as f:
+            html = f.read()
+        self.assertTrue(html.startswith('<!DOCTYPE html>'))
+        self.assertIn('<svg', html)
+        self.assertNotIn('<?xml', html)
+
+    def test_render_samples(self):
+        svg = render_flame_graph({'main;f;g': 3, 'main;f': 1, 'main;h': 0})
+        root = ElementTree.fromstring(svg)
+        ns = '{http://www.w3.org/2000/svg}'
+        rects = {e.find(ns + 'title').text.split(' ')[0]:
+                 float(e.find(ns + 'rect').get('width'))
+                 for e in root.iter(ns + 'g')}
+        self.assertAlmostEqual(rects['all'], 1200.0)
+        self.assertAlmostEqual(rects['g'], 900.0)
+        self.assertNotIn('h', rects)
+
+    def test_fail_on_invalid_window(self):
+        with self.assertRaises(ValueError):
+            RangeFlameGraph(window=0)
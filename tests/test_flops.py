@@ -0,0 +1,98 @@
+
+
+import numpy as np
+import unittest
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer.functions.connection.convolution_2d import Convolution2DFunction
+from chainer.functions.connection.linear import LinearFunction
+from chainer.functions.pooling.max_pooling_2d import MaxPooling2D
+
+from chainer_profutil import FlopCounter
+from chainer_profutil.flops import estimate_cost
+from chainer_profutil.profiled_optimizer import FwdBwdProfileMarkHook
+
+
+class TestEstimateCost(unittest.TestCase):
+    def test_convolution_2d(self):
+        x = np.zeros((2, 3, 8, 8), dtype=np.float32)
+        W = np.zeros((4, 3, 3, 3), dtype=np.float32)
+        flops, nbytes = estimate_cost(
+            Convolution2DFunction(stride=2, pad=1), (x, W))
+        # Output is (2, 4, 4, 4).
+        self.assertEqual(flops, 2 * (2 * 4 * 4 * 4) * 3 * 3 * 3)
+        self.assertEqual(nbytes, x.nbytes + W.nbytes + 2 * 4 * 4 * 4 * 4)
+
+    def test_linear_backward(self):
+        x = np.zeros((5, 10), dtype=np.float32)
+        W = np.zeros((3, 10), dtype=np.float32)
+        forward = estimate_cost(LinearFunction(), (x, W))
+        backward = estimate_cost(LinearFunction(), (x, W), backward=True)
+        self.assertEqual(forward[0], 2 * 5 * 10 * 3)
+        self.assertEqual(backward[0], 2 * forward[0])
+        self.assertEqual(backward[1], 2 * forward[1])
+
+    def test_pooling(self):
+        x = np.zeros((1, 2, 4, 4), dtype=np.float32)
+        flops, _ = estimate_cost(MaxPooling2D(2, 2, cover_all=False), (x,))
+        self.assertEqual(flops, 1 * 2 * 2 * 2 * 4)
+
+    def test_basic_math(self):
+        # Labels of these functions are e.g. '_ + _', '_ * 2' and 'exp'.
+        x = np.ones((2, 3), dtype=np.float32)
+        y = np.ones((2, 3), dtype=np.float32)
+        cases = [
+            (F.identity(x) + y, (x, y)),
+            (F.identity(x) * 2, (x,)),
+            (F.exp(x), (x,)),
+        ]
+        for out, in_data in cases:
+            flops, nbytes = estimate_cost(out.creator, in_data)
+            self.assertEqual(flops, 6)
+            self.assertEqual(nbytes, (len(in_data) + 1) * x.nbytes)
+
+    def test_unsupported_function(self):
+        x = np.zeros((2, 3), dtype=np.float32)
+        node = F.reshape(chainer.Variable(x), (3, 2)).creator
+        self.assertIsNone(estimate_cost(node, (x,)))
+
+
+class TestFlopCounter(unittest.TestCase):
+    def test_count_per_function_and_layer(self):
+        model = chainer.Sequential(L.Linear(4, 3), F.relu)
+        counter = FlopCounter()
+        counter.register_link(model)
+        x = np.ones((2, 4), dtype=np.float32)
+        with FwdBwdProfileMarkHook(sync=False, cost_counter=counter):
+            y = model(x)
+            F.sum(y).backward()
+
+        summary = counter.summary()
+        self.assertEqual(summary[('LinearFunction', 'forward')]['count'], 1)
+        self.assertAlmostEqual(
+            summary[('LinearFunction', 'forward')]['gflop'],
+            (2 * 2 * 4 * 3 + 2 * 3) * 1e-9)
+        self.assertIn(('ReLU', 'backward'), summary)
+        self.assertNotIn(('Sum', 'forward'), summary)
+
+        layers = counter.layer_summary()
+        self.assertEqual(sorted(layers.keys()),
+                         [('/0', 'backward'), ('/0', 'forward')])
+
+    def test_register_link_only_when_params_change(self):
+        model = chainer.Sequential(L.Linear(None, 3))
+        counter = FlopCounter()
+        counter.register_link(model)
+        param_to_layer = counter._param_to_layer
+        counter.register_link(model)
+        self.assertIs(counter._param_to_layer, param_to_layer)
+
+        x = np.ones((2, 4), dtype=np.float32)
+        model(x)
+        # The weight has been initialized.
+        counter.register_link(model)
+        self.assertIsNot(counter._param_to_layer, param_to_layer)
+        self.assertEqual(
+            counter._param_to_layer.get(id(model[0].W.array)), '/0')
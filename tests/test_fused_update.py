@@ -0,0 +1,103 @@
+import numpy as np
+import tracemalloc
+import unittest
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer import optimizers
+
+from chainer_profutil import FusedUpdateHook
+
+
+class _MLP(chainer.Chain):
+    def __init__(self):
+        super(_MLP, self).__init__()
+        with self.init_scope():
+            self.l1 = L.Linear(4, 8)
+            self.l2 = L.Linear(8, 3)
+            self.unused = L.Linear(2, 2)
+
+    def __call__(self, x, t):
+        h = F.relu(self.l1(x))
+        return F.softmax_cross_entropy(self.l2(h), t)
+
+
+def _train(optimizer, fused, n_steps=5):
+    np.random.seed(0)
+    model = _MLP()
+    optimizer.setup(model)
+    if fused:
+        hook = FusedUpdateHook()
+        hook.setup(optimizer)
+        optimizer.add_hook(hook)
+    rng = np.random.RandomState(1)
+    for _ in range(n_steps):
+        x = rng.randn(6, 4).astype(np.float32)
+        t = rng.randint(0, 3, size=6).astype(np.int32)
+        optimizer.update(model, x, t)
+    return model
+
+
+class TestFusedUpdateHook(unittest.TestCase):
+    def check_same_as_update_rules(self, make_optimizer):
+        expected = _train(make_optimizer(), fused=False)
+        actual = _train(make_optimizer(), fused=True)
+        for (name, p), (_, q) in zip(sorted(expected.namedparams()),
+                                     sorted(actual.namedparams())):
+            np.testing.assert_allclose(
+                q.array, p.array, rtol=1e-5, atol=1e-6, err_msg=name)
+
+    def test_momentum_sgd(self):
+        self.check_same_as_update_rules(
+            lambda: optimizers.MomentumSGD(lr=0.1, momentum=0.9))
+
+    def test_adam(self):
+        self.check_same_as_update_rules(
+            lambda: optimizers.Adam(alpha=0.01, weight_decay_rate=0.01))
+
+    def test_params_are_views_of_flat_buffer(self):
+        model = _train(optimizers.MomentumSGD(), fused=True, n_steps=1)
+        self.assertIsNotNone(model.l1.W.array.base)
+        self.assertIs(model.l1.W.array.base, model.l2.b.array.base)
+        self.assertEqual(model.l1.W.update_rule.t, 1)
+
+    def test_grads_are_views_of_flat_buffer(self):
+        np.random.seed(0)
+        model = chainer.Sequential(L.Linear(4, 256), F.relu, L.Linear(256, 3))
+        optimizer = optimizers.MomentumSGD()
+        optimizer.setup(model)
+        hook = FusedUpdateHook()
+        hook.setup(optimizer)
+        rng = np.random.RandomState(1)
+        for i in range(3):
+            x = rng.randn(64, 4).astype(np.float32)
+            t = rng.randint(0, 3, size=64).astype(np.int32)
+            model.cleargrads()
+            F.softmax_cross_entropy(model(x), t).backward()
+            grads = dict((name, p.grad.copy())
+                         for name, p in model.namedparams()
+                         if p.grad is not None)
+            if i > 0:
+                group, = hook._groups
+                tracemalloc.start()
+                try:
+                    group.gather_grads()
+                    _, peak = tracemalloc.get_traced_memory()
+                finally:
+                    tracemalloc.stop()
+                # The gradients are copied without a temporary buffer.
+                self.assertLess(peak, group.grad.nbytes // 2)
+            hook(optimizer)
+            group, = hook._groups
+            for name, p in model.namedparams():
+                if p.grad is None:
+                    continue
+                self.assertIs(p.grad.base, group.grad)
+                np.testing.assert_array_equal(p.grad, grads[name])
+
+    def test_fail_on_unsupported_optimizer(self):
+        optimizer = optimizers.SGD()
+        optimizer.setup(_MLP())
+        with self.assertRaises(ValueError):
+            FusedUpdateHook().setup(optimizer)
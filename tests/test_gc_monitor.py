@@ -0,0 +1,69 @@
+
+
+import gc
+import unittest
+
+from chainer_profutil import GCMonitor
+from chainer_profutil.profiled_optimizer import range_pop
+from chainer_profutil.profiled_optimizer import range_push
+
+
+class TestGCMonitor(unittest.TestCase):
+    def setUp(self):
+        # Avoid automatic collections being recorded between explicit ones.
+        self._gc_enabled = gc.isenabled()
+        gc.disable()
+
+    def tearDown(self):
+        if self._gc_enabled:
+            gc.enable()
+
+    def test_attribute_to_enclosing_phase(self):
+        monitor = GCMonitor()
+        with monitor:
+            self.assertIn(monitor._gc_callback, gc.callbacks)
+            range_push(False, 'iteration', None)
+            range_push(False, 'model.backward', None)
+            range_push(False, 'LinearFunction.backward', None)
+            gc.collect(1)
+            range_pop(False, 'LinearFunction.backward')
+            range_pop(False, 'model.backward')
+            gc.collect(0)
+            range_pop(False, 'iteration')
+            gc.collect(2)
+        self.assertNotIn(monitor._gc_callback, gc.callbacks)
+
+        self.assertEqual(
+            [(e.iteration, e.phase, e.generation) for e in monitor.events],
+            [(1, 'model.backward', 1), (1, 'iteration', 0), (2, 'other', 2)])
+
+        per_iteration = monitor.per_iteration()
+        self.assertEqual(len(per_iteration), 1)
+        itr, total, durations = per_iteration[0]
+        self.assertEqual(itr, 1)
+        self.assertEqual(sorted(durations.keys()),
+                         ['iteration', 'model.backward'])
+        self.assertAlmostEqual(total, sum(durations.values()))
+
+        summary = monitor.summary()
+        self.assertEqual(summary['count'], 3)
+        self.assertEqual(summary['count_by_generation'], {0: 1, 1: 1, 2: 1})
+
+    def test_not_recording_after_detach(self):
+        monitor = GCMonitor()
+        with monitor:
+            pass
+        gc.collect()
+        self.assertEqual(len(monitor.events), 0)
+
+    def test_collection_while_lock_held(self):
+        monitor = GCMonitor()
+        with monitor:
+            range_push(False, 'iteration', None)
+            with monitor._lock:
+                # Must not deadlock when a collection is triggered by an
+                # allocation while the lock is held.
+                gc.collect(0)
+            range_pop(False, 'iteration')
+        self.assertEqual(len(monitor.events), 1)
+        self.assertEqual(len(monitor.per_iteration()), 1)
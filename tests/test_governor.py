@@ -0,0 +1,209 @@
+import unittest
+
+import numpy as np
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+
+from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import OverheadGovernor
+from chainer_profutil import SyncLevel
+from chainer_profutil.profiled_optimizer import add_range_listener
+from chainer_profutil.profiled_optimizer import remove_range_listener
+
+
+class _Optimizer(object):
+    # Stands for a marked optimizer.
+
+    def __init__(self, sync_level):
+        self._sync = True
+        self.sync_level = sync_level
+        self.function_mark_level = SyncLevel.COARSEST
+
+    def set_sync_level(self, sync_level):
+        self.sync_level = sync_level
+
+    def set_function_mark_level(self, level):
+        self.function_mark_level = level
+
+
+class _Sampler(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.sampling_time = 0.0
+
+
+def _run(governor, n, duration):
+    t = 0.0
+    for _ in range(n):
+        d = duration()
+        governor.range_popped('iteration', t, t + d)
+        t += d
+
+
+class TestOverheadGovernor(unittest.TestCase):
+    def test_lower_and_raise_sync_level(self):
+        optimizer = _Optimizer(SyncLevel.FINEST)
+        governor = OverheadGovernor(optimizer, budget=0.05, window=5)
+        costs = {SyncLevel.COARSEST: 1.0, SyncLevel.SECOND: 1.02,
+                 SyncLevel.FINEST: 1.5}
+        levels = []
+
+        def duration():
+            levels.append(optimizer.sync_level)
+            return costs[optimizer.sync_level]
+
+        # The first iteration is not measured.
+        _run(governor, 1 + 5, duration)
+        # The baseline is calibrated at COARSEST.
+        self.assertEqual(optimizer.sync_level, SyncLevel.COARSEST)
+        _run(governor, 5, duration)
+        self.assertEqual(optimizer.sync_level, SyncLevel.FINEST)
+        _run(governor, 5, duration)
+        self.assertAlmostEqual(governor.overhead, 0.5)
+        self.assertEqual(optimizer.sync_level, SyncLevel.SECOND)
+
+        _run(governor, 5 * 30, duration)
+        # FINEST is tried less and less often.
+        finest = [i for i, level in enumerate(levels)
+                  if level == SyncLevel.FINEST]
+        self.assertLess(len(finest), 5 * 8)
+        self.assertGreater(levels.count(SyncLevel.SECOND), 5 * 20)
+        self.assertTrue(all(change.setting == 'sync_level'
+                            for change in governor.changes))
+
+    def test_widen_sampling_interval(self):
+        optimizer = _Optimizer(SyncLevel.COARSEST)
+        sampler = _Sampler(0.001)
+        governor = OverheadGovernor(optimizer, budget=0.05, sampler=sampler,
+                                    window=4, max_interval=0.004)
+
+        def duration():
+            # Sampling costs 10 ms per second of sampling interval.
+            sampler.sampling_time += 0.0001 / sampler.interval
+            return 1.0
+
+        _run(governor, 1 + 4, duration)
+        self.assertAlmostEqual(sampler.interval, 0.002)
+        _run(governor, 4 * 2, duration)
+        self.assertAlmostEqual(sampler.interval, 0.004)
+        # Up to max_interval.
+        _run(governor, 4, duration)
+        self.assertAlmostEqual(sampler.interval, 0.004)
+        self.assertEqual(optimizer.sync_level, SyncLevel.COARSEST)
+
+        # The interval is narrowed again when there is headroom.
+        governor = OverheadGovernor(optimizer, budget=0.5, sampler=sampler,
+                                    window=4)
+        sampler.interval = 0.002
+        governor._min_interval = 0.001
+        _run(governor, 1 + 4, lambda: 1.0)
+        self.assertAlmostEqual(sampler.interval, 0.001)
+        self.assertEqual(governor.changes[-1].setting, 'interval')
+
+    def test_no_sync(self):
+        optimizer = _Optimizer(SyncLevel.FINEST)
+        optimizer._sync = False
+        governor = OverheadGovernor(optimizer, budget=0.05, window=2)
+        # Marking functions costs time even without synchronization.
+        costs = {SyncLevel.COARSEST: 1.0, SyncLevel.SECOND: 1.0,
+                 SyncLevel.FINEST: 1.5}
+        _run(governor, 1 + 2 * 3,
+             lambda: costs[optimizer.sync_level])
+        self.assertEqual(optimizer.sync_level, SyncLevel.SECOND)
+
+    def test_attach(self):
+        optimizer = _Optimizer(SyncLevel.FINEST)
+        with OverheadGovernor(optimizer):
+            self.assertEqual(optimizer.function_mark_level,
+                             SyncLevel.FINEST)
+        self.assertEqual(optimizer.function_mark_level, SyncLevel.COARSEST)
+
+    def test_ignore_other_ranges(self):
+        governor = OverheadGovernor(_Optimizer(SyncLevel.COARSEST))
+        governor.range_popped('model.forward', 0.0, 1.0)
+        self.assertEqual(governor.iteration, 0)
+
+    def test_fail_on_invalid_arguments(self):
+        optimizer = _Optimizer(SyncLevel.COARSEST)
+        with self.assertRaises(ValueError):
+            OverheadGovernor(optimizer, budget=0)
+        with self.assertRaises(ValueError):
+            OverheadGovernor(optimizer, window=0)
+        with self.assertRaises(ValueError):
+            OverheadGovernor(optimizer, headroom=1.0)
+
+
+class _Model(chainer.Chain):
+    def __init__(self):
+        super(_Model, self).__init__()
+        with self.init_scope():
+            self.fc = L.Linear(3, 2)
+
+    def forward(self, x, t):
+        return F.softmax_cross_entropy(self.fc(x), t)
+
+
+class TestSetSyncLevel(unittest.TestCase):
+    def test_set_sync_level(self):
+        model = _Model()
+        optimizer = create_marked_profile_optimizer(
+            chainer.optimizers.SGD(), sync=False,
+            sync_level=SyncLevel.FINEST)
+        optimizer.setup(model)
+        self.assertEqual(optimizer.sync_level, SyncLevel.FINEST)
+        optimizer.set_sync_level(SyncLevel.SECOND)
+        self.assertEqual(optimizer.sync_level, SyncLevel.SECOND)
+        self.assertEqual(model._sync_level, SyncLevel.SECOND)
+        for hook in optimizer._mark_hooks:
+            self.assertEqual(hook._sync_level, SyncLevel.SECOND)
+
+        x = np.ones((4, 3), dtype=np.float32)
+        t = np.zeros(4, dtype=np.int32)
+        optimizer.update(model, x, t)
+        self.assertEqual(optimizer.t, 1)
+
+
+class _Counter(object):
+    def __init__(self):
+        self.pushed = []
+
+    def range_pushed(self, msg, timestamp):
+        self.pushed.append(msg)
+
+    def range_popped(self, msg, start, end):
+        pass
+
+
+class TestGovernedMarks(unittest.TestCase):
+    def setUp(self):
+        self.model = _Model()
+        self.optimizer = create_marked_profile_optimizer(
+            chainer.optimizers.SGD(), sync=False,
+            sync_level=SyncLevel.FINEST)
+        self.optimizer.setup(self.model)
+        self.counter = _Counter()
+        add_range_listener(self.counter)
+        self.addCleanup(remove_range_listener, self.counter)
+
+    def _count_pushed(self):
+        x = np.ones((4, 3), dtype=np.float32)
+        t = np.zeros(4, dtype=np.int32)
+        del self.counter.pushed[:]
+        self.optimizer.update(self.model, x, t)
+        return len(self.counter.pushed)
+
+    def test_lower_level_pushes_fewer_ranges(self):
+        with OverheadGovernor(self.optimizer, window=100):
+            finest = self._count_pushed()
+            self.optimizer.set_sync_level(SyncLevel.COARSEST)
+            coarsest = self._count_pushed()
+        self.assertLess(coarsest, finest)
+        # Only the iteration and the phases are marked.
+        self.assertEqual(sorted(self.counter.pushed), [
+            'iteration', 'model.backward', 'model.forward',
+            'model.update'])
+
+        # Functions are marked at every level without the governor.
+        self.assertEqual(self._count_pushed(), finest)
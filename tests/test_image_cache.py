@@ -0,0 +1,143 @@
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'examples', 'imagenet'))
+import image_cache  # NOQA
+
+
+class _Dataset(object):
+    # Image dataset counting reads.
+
+    def __init__(self, n, shapes=((3, 4, 4),)):
+        rng = np.random.RandomState(0)
+        self.images = [
+            rng.randint(0, 256, shapes[i % len(shapes)]).astype(np.float32)
+            for i in range(n)]
+        self.reads = []
+
+    def __len__(self):
+        return len(self.images)
+
+    def __getitem__(self, i):
+        self.reads.append(i)
+        return self.images[i], np.int32(i)
+
+
+# Size of a record of a (3, 4, 4) image in the cache.
+_record = 16 + 48
+
+
+class TestCachedImageDataset(unittest.TestCase):
+    def _check(self, dataset, base, i):
+        image, label = dataset.get_example(i)
+        self.assertEqual(image.dtype, np.float32)
+        np.testing.assert_array_equal(image, base.images[i])
+        self.assertEqual(label, i)
+
+    def test_cache(self):
+        base = _Dataset(4, shapes=((3, 4, 4), (1, 5, 3)))
+        dataset = image_cache.CachedImageDataset(base, max_bytes=1024)
+        for _ in range(2):
+            for i in range(4):
+                self._check(dataset, base, i)
+        self.assertEqual(base.reads, [0, 1, 2, 3])
+        self.assertEqual((dataset.hits, dataset.misses), (4, 4))
+        self.assertEqual(dataset.nbytes, 2 * 48 + 2 * 15)
+
+    def test_evict_least_recently_used(self):
+        base = _Dataset(4)
+        dataset = image_cache.CachedImageDataset(base, max_bytes=3 * _record)
+        for i in range(3):
+            dataset.get_example(i)
+        # 0 is moved to the head of the ring, so 1 is evicted.
+        dataset.get_example(0)
+        dataset.get_example(3)
+        self.assertEqual(dataset.nbytes, 3 * 48)
+        del base.reads[:]
+        # Read from the oldest, so each image is moved without evicting
+        # others.
+        for i in (2, 0, 3, 1):
+            self._check(dataset, base, i)
+        self.assertEqual(base.reads, [1])
+
+    def test_wrap_around(self):
+        base = _Dataset(20, shapes=((3, 4, 4), (1, 5, 3), (2, 2, 2)))
+        dataset = image_cache.CachedImageDataset(base, max_bytes=200)
+        rng = np.random.RandomState(1)
+        for i in rng.randint(0, 20, 200):
+            self._check(dataset, base, i)
+        self.assertLessEqual(dataset.nbytes, 200)
+
+    def test_skip_too_large_image(self):
+        base = _Dataset(2)
+        dataset = image_cache.CachedImageDataset(base, max_bytes=_record - 16)
+        for _ in range(2):
+            self._check(dataset, base, 0)
+        self.assertEqual(base.reads, [0, 0])
+        self.assertEqual(dataset.nbytes, 0)
+
+    def test_share_between_processes(self):
+        base = _Dataset(4)
+        dataset = image_cache.CachedImageDataset(base, max_bytes=1024)
+        context = multiprocessing.get_context('fork')
+        process = context.Process(
+            target=lambda: [dataset.get_example(i) for i in range(4)])
+        process.start()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+
+        for i in range(4):
+            self._check(dataset, base, i)
+        # Images decoded by the child process are cached.
+        self.assertEqual(base.reads, [])
+        self.assertEqual(dataset.hits, 4)
+
+
+class TestSpill(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'train.cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _read_all(self, base, **kwargs):
+        dataset = image_cache.CachedImageDataset(
+            base, spill_path=self.path, **kwargs)
+        del base.reads[:]
+        for i in range(len(base)):
+            image, label = dataset.get_example(i)
+            np.testing.assert_array_equal(image, base.images[i])
+            self.assertEqual(label, i)
+        return base.reads
+
+    def test_reuse_spill(self):
+        base = _Dataset(3)
+        self.assertEqual(self._read_all(base, spill_key='a'), [0, 1, 2])
+        # Another run reads the images from the spill file.
+        self.assertEqual(self._read_all(base, spill_key='a'), [])
+
+    def test_invalidate_with_another_key(self):
+        base = _Dataset(3)
+        self._read_all(base, spill_key='a')
+        self.assertEqual(self._read_all(base, spill_key='b'), [0, 1, 2])
+        self.assertEqual(self._read_all(base, spill_key='b'), [])
+
+    def test_invalidate_with_another_shape(self):
+        base = _Dataset(3)
+        self._read_all(base, spill_key='a')
+        base = _Dataset(3, shapes=((1, 4, 4),))
+        self.assertEqual(self._read_all(base, spill_key='a'), [0, 1, 2])
+
+    def test_not_reuse_incomplete_files(self):
+        base = _Dataset(3)
+        self._read_all(base, spill_key='a')
+        os.remove(self.path + '.header')
+        self.assertEqual(self._read_all(base, spill_key='a'), [0, 1, 2])
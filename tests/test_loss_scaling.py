@@ -0,0 +1,106 @@
+import unittest
+
+import numpy as np
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer import optimizers
+
+from chainer_profutil import DynamicLossScaler
+
+
+class _MLP(chainer.Chain):
+    def __init__(self, dtype):
+        super(_MLP, self).__init__()
+        with self.init_scope():
+            self.l1 = L.Linear(4, 8, initialW=np.ones((8, 4)) * 0.1)
+            self.l2 = L.Linear(8, 3, initialW=np.ones((3, 8)) * 0.1)
+        self.to_dtype = dtype
+        for param in self.params():
+            param.array = param.array.astype(dtype)
+
+    def __call__(self, x, t):
+        h = F.relu(self.l1(x.astype(self.to_dtype)))
+        return F.softmax_cross_entropy(self.l2(h), t)
+
+
+def _batch():
+    rng = np.random.RandomState(0)
+    x = rng.randn(6, 4).astype(np.float32)
+    t = rng.randint(0, 3, size=6).astype(np.int32)
+    return x, t
+
+
+def _setup(dtype, scaler):
+    model = _MLP(dtype)
+    optimizer = optimizers.MomentumSGD(lr=0.1)
+    optimizer.setup(model)
+    optimizer.use_fp32_update()
+    unscale_hook, scale_update_hook = scaler.make_hooks()
+    optimizer.add_hook(unscale_hook)
+    optimizer.add_hook(scale_update_hook)
+    return model, optimizer
+
+
+def _step(model, optimizer, scaler, grad_fill=None):
+    loss = model(*_batch())
+    model.cleargrads()
+    scaler.scale_loss(loss).backward()
+    if grad_fill is not None:
+        model.l1.W.grad[0, 0] = grad_fill
+    optimizer.update()
+
+
+class TestDynamicLossScaler(unittest.TestCase):
+    def test_same_update_as_unscaled_fp32(self):
+        scaler = DynamicLossScaler(scale=1024.)
+        model, optimizer = _setup(np.float16, scaler)
+        _step(model, optimizer, scaler)
+
+        expected = _MLP(np.float32)
+        expected_optimizer = optimizers.MomentumSGD(lr=0.1)
+        expected_optimizer.setup(expected)
+        expected_optimizer.update(expected, *_batch())
+
+        for (name, p), (_, q) in zip(sorted(model.namedparams()),
+                                     sorted(expected.namedparams())):
+            self.assertEqual(p.dtype, np.float16)
+            np.testing.assert_allclose(
+                p.array, q.array, rtol=1e-2, atol=1e-3, err_msg=name)
+        self.assertFalse(scaler.overflow)
+        self.assertEqual(scaler.scale, 1024.)
+
+    def test_skip_update_on_overflow(self):
+        scaler = DynamicLossScaler(scale=1024.)
+        model, optimizer = _setup(np.float32, scaler)
+        before = dict((name, p.array.copy())
+                      for name, p in model.namedparams())
+        _step(model, optimizer, scaler, grad_fill=np.inf)
+
+        self.assertTrue(scaler.overflow)
+        self.assertEqual(scaler.n_overflows, 1)
+        self.assertEqual(scaler.scale, 512.)
+        for name, p in model.namedparams():
+            np.testing.assert_array_equal(p.array, before[name])
+            self.assertTrue(p.update_rule.enabled)
+
+        _step(model, optimizer, scaler)
+        self.assertFalse(scaler.overflow)
+        self.assertFalse(np.array_equal(model.l2.W.array, before['/l2/W']))
+
+    def test_increase_scale(self):
+        scaler = DynamicLossScaler(scale=8., interval=2)
+        model, optimizer = _setup(np.float32, scaler)
+        _step(model, optimizer, scaler)
+        self.assertEqual(scaler.scale, 8.)
+        _step(model, optimizer, scaler)
+        self.assertEqual(scaler.scale, 16.)
+
+    def test_fail_on_invalid_arguments(self):
+        with self.assertRaises(ValueError):
+            DynamicLossScaler(scale=0.5, min_scale=1.)
+        with self.assertRaises(ValueError):
+            DynamicLossScaler(factor=1.)
+        with self.assertRaises(ValueError):
+            DynamicLossScaler(interval=0)
@@ -0,0 +1,178 @@
+import numpy as np
+import unittest
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer import function_hook
+
+from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import MarkFilter
+from chainer_profutil import SyncLevel
+from chainer_profutil.profiled_optimizer import FwdBwdProfileMarkHook
+
+
+class _Model(chainer.Chain):
+    def __init__(self):
+        super(_Model, self).__init__()
+        with self.init_scope():
+            self.conv = L.Convolution2D(1, 2, 3)
+            self.fc = L.Linear(None, 3)
+
+    def __call__(self, x):
+        h = F.relu(self.conv(x))
+        return self.fc(F.reshape(h, (len(h), -1)))
+
+
+class _Classifier(chainer.Chain):
+    def __init__(self):
+        super(_Classifier, self).__init__()
+        with self.init_scope():
+            self.fc = L.Linear(4, 3)
+
+    def forward(self, x, t):
+        return F.softmax_cross_entropy(self.fc(x), t)
+
+
+class _CountingMarkFilter(MarkFilter):
+    def __init__(self):
+        super(_CountingMarkFilter, self).__init__()
+        self.n_registered = 0
+
+    def register_link(self, link):
+        self.n_registered += 1
+        super(_CountingMarkFilter, self).register_link(link)
+
+
+class _RecordingHook(function_hook.FunctionHook):
+    name = 'RecordingHook'
+
+    def __init__(self, mark_filter):
+        self._mark_filter = mark_filter
+        self.selected = []
+
+    def forward_preprocess(self, function, in_data):
+        if self._mark_filter(function, in_data):
+            self.selected.append((function.label, 'forward'))
+
+    def backward_preprocess(self, function, in_data, out_grad):
+        if self._mark_filter(function, in_data):
+            self.selected.append((function.label, 'backward'))
+
+
+class _RangeRecorder(object):
+    def __init__(self):
+        self.ranges = []
+
+    def range_pushed(self, msg, timestamp):
+        self.ranges.append(msg)
+
+    def range_popped(self, msg, start, end):
+        pass
+
+
+def _select(mark_filter):
+    model = _Model()
+    x = np.ones((2, 1, 5, 5), dtype=np.float32)
+    model(x)  # Initializes fc.
+    mark_filter.register_link(model)
+    hook = _RecordingHook(mark_filter)
+    with hook:
+        F.sum(model(x)).backward()
+    return sorted(set(hook.selected))
+
+
+class TestMarkFilter(unittest.TestCase):
+    def test_no_pattern(self):
+        selected = _select(MarkFilter())
+        self.assertIn(('ReLU', 'forward'), selected)
+        self.assertIn(('Reshape', 'backward'), selected)
+
+    def test_include_and_exclude_labels(self):
+        selected = _select(MarkFilter(include=['^Convolution2DFunction$',
+                                               '^LinearFunction$|ReLU'],
+                                      exclude='ReLU'))
+        self.assertEqual(selected, [
+            ('Convolution2DFunction', 'backward'),
+            ('Convolution2DFunction', 'forward'),
+            ('LinearFunction', 'backward'),
+            ('LinearFunction', 'forward'),
+        ])
+
+    def test_link_paths(self):
+        selected = _select(MarkFilter(include_links='^/fc$'))
+        self.assertIn(('LinearFunction', 'forward'), selected)
+        self.assertIn(('LinearFunction', 'backward'), selected)
+        # Including functions computing gradients of the parameters.
+        for label, _ in selected:
+            self.assertTrue(label.startswith('Linear'))
+
+        selected = _select(MarkFilter(exclude_links='conv'))
+        self.assertNotIn(('Convolution2DFunction', 'forward'), selected)
+        self.assertNotIn(('Convolution2DFunction', 'backward'), selected)
+        # Functions without parameters have no link path.
+        self.assertIn(('ReLU', 'forward'), selected)
+
+    def test_layer_of(self):
+        model = _Model()
+        mark_filter = MarkFilter()
+        mark_filter.register_link(model)
+        x = np.ones((2, 1, 5, 5), dtype=np.float32)
+        node = model.conv(x).creator
+        self.assertEqual(mark_filter.layer_of(node, (x, model.conv.W.array)),
+                         '/conv')
+        # Backward finds parameters by their nodes.
+        self.assertEqual(mark_filter.layer_of(node, (x, None)), '/conv')
+
+
+    def test_register_link_only_when_params_change(self):
+        model = _Model()
+        mark_filter = MarkFilter()
+        mark_filter.register_link(model)
+        param_to_layer = mark_filter._param_to_layer
+        mark_filter.register_link(model)
+        self.assertIs(mark_filter._param_to_layer, param_to_layer)
+
+        model(np.ones((2, 1, 5, 5), dtype=np.float32))
+        # fc.W has been initialized.
+        mark_filter.register_link(model)
+        self.assertIsNot(mark_filter._param_to_layer, param_to_layer)
+        self.assertEqual(
+            mark_filter._param_to_layer.get(id(model.fc.W.array)), '/fc')
+
+
+class TestFilteredMarkHook(unittest.TestCase):
+    def test_fold_unselected_functions(self):
+        from chainer_profutil.profiled_optimizer import add_range_listener
+        from chainer_profutil.profiled_optimizer import remove_range_listener
+
+        model = chainer.Sequential(L.Linear(4, 3), F.relu)
+        mark_filter = MarkFilter(include='^LinearFunction$')
+        mark_filter.register_link(model)
+        recorder = _RangeRecorder()
+        add_range_listener(recorder)
+        try:
+            x = np.ones((2, 4), dtype=np.float32)
+            with FwdBwdProfileMarkHook(sync=False, mark_filter=mark_filter):
+                F.sum(model(x)).backward()
+        finally:
+            remove_range_listener(recorder)
+        self.assertEqual(recorder.ranges, ['LinearFunction.forward',
+                                           'LinearFunction.backward'])
+
+    def test_not_register_link_without_marks(self):
+        model = _Classifier()
+        mark_filter = _CountingMarkFilter()
+        optimizer = create_marked_profile_optimizer(
+            chainer.optimizers.SGD(), sync=False,
+            sync_level=SyncLevel.COARSEST, mark_filter=mark_filter)
+        optimizer.setup(model)
+        optimizer.set_function_mark_level(SyncLevel.FINEST)
+        x = np.ones((2, 4), dtype=np.float32)
+        t = np.zeros(2, dtype=np.int32)
+        optimizer.update(model, x, t)
+        self.assertEqual(mark_filter.n_registered, 0)
+
+        optimizer.set_sync_level(SyncLevel.FINEST)
+        optimizer.update(model, x, t)
+        self.assertEqual(mark_filter.n_registered, 1)
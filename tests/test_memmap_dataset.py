@@ -0,0 +1,112 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+from PIL import Image
+
+from chainer_profutil import BatchPreprocessConverter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir,
+                                'examples', 'imagenet'))
+import make_memmap_dataset  # NOQA
+import memmap_dataset  # NOQA
+
+
+# Mode and (H, W) of each image.
+_images = [('RGB', (8, 8)), ('L', (8, 8)), ('RGBA', (8, 8)),
+           ('RGB', (6, 10)), ('RGB', (8, 8))]
+
+
+class TestMemmapDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.arrays = []
+        lines = []
+        for k, (mode, (h, w)) in enumerate(_images):
+            channels = len(mode)
+            array = rng.randint(0, 256, (h, w, channels)).astype(np.uint8)
+            if channels == 1:
+                array = array[:, :, 0]
+            name = '{}.png'.format(k)
+            Image.fromarray(array, mode).save(
+                os.path.join(self.tmpdir, name))
+            self.arrays.append(array)
+            lines.append('{} {}\n'.format(name, k * 10))
+        self.list_path = os.path.join(self.tmpdir, 'list.txt')
+        with open(self.list_path, 'w') as f:
+            f.writelines(lines)
+        self.prefix = os.path.join(self.tmpdir, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _convert(self, n_processes, prefix=None):
+        make_memmap_dataset.convert(
+            self.list_path, self.tmpdir, prefix or self.prefix, 8,
+            n_processes=n_processes, chunk_size=2)
+
+    def test_convert(self):
+        self._convert(1)
+        images = np.load(self.prefix + '_images.npy')
+        labels = np.load(self.prefix + '_labels.npy')
+        self.assertEqual(images.shape, (5, 3, 8, 8))
+        self.assertEqual(images.dtype, np.uint8)
+        self.assertEqual(labels.dtype, np.int32)
+        np.testing.assert_array_equal(labels, [0, 10, 20, 30, 40])
+        # Images of the size are kept as they are.
+        np.testing.assert_array_equal(images[0],
+                                      self.arrays[0].transpose(2, 0, 1))
+        # Grayscale images have three channels and alpha is dropped.
+        for c in range(3):
+            np.testing.assert_array_equal(images[1, c], self.arrays[1])
+        np.testing.assert_array_equal(
+            images[2], self.arrays[2][:, :, :3].transpose(2, 0, 1))
+
+    def test_convert_in_parallel(self):
+        self._convert(1)
+        parallel = os.path.join(self.tmpdir, 'parallel')
+        self._convert(3, parallel)
+        for suffix in ('_images.npy', '_labels.npy'):
+            np.testing.assert_array_equal(np.load(self.prefix + suffix),
+                                          np.load(parallel + suffix))
+
+    def test_dataset(self):
+        self._convert(1)
+        images = np.load(self.prefix + '_images.npy').astype(np.float32)
+        mean = np.random.RandomState(1).uniform(
+            0, 255, (3, 8, 8)).astype(np.float32)
+        dataset = memmap_dataset.MemmapImageDataset(
+            self.prefix, mean, 4, random=False)
+        self.assertEqual(len(dataset), 5)
+        for i in range(5):
+            image, label = dataset[i]
+            np.testing.assert_allclose(
+                image, (images[i] - mean)[:, 2:6, 2:6] / 255.0, rtol=1e-6)
+            self.assertEqual(label, i * 10)
+
+    def test_crop_only(self):
+        self._convert(1)
+        mean = np.random.RandomState(1).uniform(
+            0, 255, (3, 8, 8)).astype(np.float32)
+        dataset = memmap_dataset.MemmapImageDataset(
+            self.prefix, mean, 4, random=True)
+        crop_dataset = memmap_dataset.MemmapImageDataset(
+            self.prefix, mean, 4, random=True, crop_only=True)
+
+        random.seed(0)
+        expected = [dataset[i] for i in range(5)]
+        random.seed(0)
+        batch = [crop_dataset[i] for i in range(5)]
+        for crop, _, _, _ in batch:
+            self.assertEqual(crop.dtype, np.uint8)
+            # Crops are views of the memory-mapped images.
+            self.assertIsNotNone(crop.base)
+        x, t = BatchPreprocessConverter(mean)(batch)
+        for (image, label), y, u in zip(expected, x, t):
+            np.testing.assert_allclose(y, image, rtol=1e-6)
+            self.assertEqual(u, label)
@@ -4,14 +4,17 @@ import types
 
 import numpy as np
 import unittest
+from unittest import mock
 
 import chainer
+import chainer.functions as F
 import chainer.links as L
 from chainer import optimizers
 
 import chainermn
 
 from chainer_profutil import create_marked_profile_optimizer
+from chainer_profutil import DynamicLossScaler
 from chainer_profutil import SyncLevel
 from chainer_profutil.profiled_optimizer import _MarkedProfileOptimizer
 from chainer_profutil.profiled_optimizer import _MarkedProfileOptimizerForMN
@@ -63,6 +66,67 @@ class TestCreateMarkedProfileOptimizer(unittest.TestCase):
             chainer.Optimizer)
 
 
+class _MLP(chainer.Chain):
+    def __init__(self):
+        super(_MLP, self).__init__()
+        rng = np.random.RandomState(0)
+        with self.init_scope():
+            self.l1 = L.Linear(4, 5, initialW=rng.randn(5, 4) * 0.5)
+            self.l2 = L.Linear(5, 3, initialW=rng.randn(3, 5) * 0.5)
+
+    def forward(self, x, t):
+        h = F.relu(self.l1(x))
+        return F.softmax_cross_entropy(self.l2(h), t)
+
+
+def _batches(n):
+    rng = np.random.RandomState(1)
+    return [(rng.randn(8, 4).astype(np.float32),
+             rng.randint(0, 3, size=8).astype(np.int32))
+            for _ in range(n)]
+
+
+class TestGradientAccumulation(unittest.TestCase):
+    def _check_same_as_full_batch(self, accum_steps, loss_scaler=None):
+        expected = _MLP()
+        expected_optimizer = optimizers.MomentumSGD(lr=0.1)
+        expected_optimizer.setup(expected)
+
+        model = _MLP()
+        optimizer = create_marked_profile_optimizer(
+            optimizers.MomentumSGD(lr=0.1), sync=False,
+            accum_steps=accum_steps, loss_scaler=loss_scaler)
+        optimizer.setup(model)
+
+        # Two steps, so that the momentum is also compared.
+        for x, t in _batches(2):
+            expected_optimizer.update(expected, x, t)
+            optimizer.update(model, x, t)
+        for (name, p), (_, q) in zip(sorted(model.namedparams()),
+                                     sorted(expected.namedparams())):
+            np.testing.assert_allclose(p.array, q.array, rtol=1e-5,
+                                       atol=1e-6, err_msg=name)
+
+    def test_same_as_full_batch(self):
+        for accum_steps in (2, 4):
+            self._check_same_as_full_batch(accum_steps)
+
+    def test_same_as_full_batch_with_loss_scaling(self):
+        for accum_steps in (2, 4):
+            self._check_same_as_full_batch(
+                accum_steps, DynamicLossScaler(scale=1024.))
+
+    def test_return_result_of_update(self):
+        model = _MLP()
+        optimizer = create_marked_profile_optimizer(
+            optimizers.SGD(), sync=False, accum_steps=2)
+        optimizer.setup(model)
+        x, t = _batches(1)[0]
+        with mock.patch.object(optimizer.actual_optimizer, 'update',
+                               return_value='updated'):
+            self.assertEqual(optimizer.update(model, x, t), 'updated')
+
+
 class TestCreateMarkedProfileOptimizerError(unittest.TestCase):
     def test_fail_on_none_instance(self):
         with self.assertRaises(AssertionError):
@@ -97,3 +161,7 @@ class TestCreateMarkedProfileOptimizerError(unittest.TestCase):
                 optimizers.SGD(lr=1.0),
                 sync=True, sync_level=SyncLevel.FINEST+1)
 
+    def test_fail_on_invalid_accum_steps(self):
+        with self.assertRaises(ValueError):
+            create_marked_profile_optimizer(
+                optimizers.SGD(lr=1.0), sync=True, accum_steps=0)
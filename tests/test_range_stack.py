@@ -0,0 +1,72 @@
+
+
+import threading
+import unittest
+import warnings
+
+from chainer_profutil.profiled_optimizer import current_ranges
+from chainer_profutil.profiled_optimizer import range_pop
+from chainer_profutil.profiled_optimizer import range_push
+from chainer_profutil.profiled_optimizer import RangeMismatchError
+from chainer_profutil.profiled_optimizer import set_range_mismatch_policy
+from chainer_profutil.profiled_optimizer import time_range
+
+
+class TestRangeStack(unittest.TestCase):
+    def tearDown(self):
+        set_range_mismatch_policy('warn')
+
+    def test_nested_ranges(self):
+        with time_range('iteration'):
+            with time_range('model.forward'):
+                self.assertEqual(current_ranges(),
+                                 ('iteration', 'model.forward'))
+            self.assertEqual(current_ranges(), ('iteration',))
+        self.assertEqual(current_ranges(), ())
+
+    def test_per_thread_stacks(self):
+        entered = threading.Event()
+        release = threading.Event()
+        seen = {}
+
+        def worker():
+            with time_range('prefetch'):
+                seen['worker'] = current_ranges()
+                entered.set()
+                release.wait()
+
+        with time_range('iteration'):
+            thread = threading.Thread(target=worker)
+            thread.start()
+            entered.wait()
+            self.assertEqual(current_ranges(), ('iteration',))
+            self.assertEqual(current_ranges(thread.ident), ('prefetch',))
+            release.set()
+            thread.join()
+        self.assertEqual(seen['worker'], ('prefetch',))
+
+    def test_raise_on_mismatch(self):
+        set_range_mismatch_policy('raise')
+        range_push(False, 'model.forward', None)
+        with self.assertRaises(RangeMismatchError) as cm:
+            range_pop(False, 'model.update')
+        self.assertIn('model.forward', str(cm.exception))
+        self.assertIn('model.update', str(cm.exception))
+        range_pop(False, 'model.forward')
+
+        with self.assertRaises(RangeMismatchError):
+            range_pop(False, 'iteration')
+
+    def test_warn_on_mismatch(self):
+        set_range_mismatch_policy('warn')
+        range_push(False, 'model.forward', None)
+        with warnings.catch_warnings(record=True) as w:
+            warnings.simplefilter('always')
+            range_pop(False, 'model.update')
+            range_pop(False)
+        self.assertEqual(len(w), 2)
+        self.assertEqual(current_ranges(), ())
+
+    def test_fail_on_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            set_range_mismatch_policy('unknown')
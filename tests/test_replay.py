@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import chainer
+from chainer.dataset import convert
+
+from chainer_profutil import record_batches
+from chainer_profutil import ReplayConverter
+from chainer_profutil import ReplayIterator
+
+
+def _make_dataset(n):
+    rng = np.random.RandomState(0)
+    return [(rng.randn(3, 4).astype(np.float32), np.int32(i))
+            for i in range(n)]
+
+
+class TestReplay(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmpdir, 'batches')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_replay_recorded_batches(self):
+        dataset = _make_dataset(10)
+        it = chainer.iterators.SerialIterator(dataset, 4, shuffle=False)
+        self.assertEqual(record_batches(it, self.prefix, 3), 3)
+
+        it = chainer.iterators.SerialIterator(dataset, 4, shuffle=False)
+        expected = [convert.concat_examples(it.next()) for _ in range(3)]
+        replay = ReplayIterator(self.prefix)
+        converter = ReplayConverter()
+        for _ in range(2):
+            for x, t in expected:
+                actual_x, actual_t = converter(replay.next())
+                np.testing.assert_array_equal(actual_x, x)
+                np.testing.assert_array_equal(actual_t, t)
+                self.assertEqual(actual_t.dtype, np.int32)
+        self.assertEqual(replay.epoch, 2)
+        self.assertTrue(replay.is_new_epoch)
+
+    def test_dict_and_array(self):
+        dicts = [{'x': np.full((2,), i, dtype=np.float32)} for i in range(4)]
+        it = chainer.iterators.SerialIterator(dicts, 2, shuffle=False)
+        record_batches(it, self.prefix, 2)
+        batch = ReplayIterator(self.prefix).next()
+        np.testing.assert_array_equal(batch['x'], [[0, 0], [1, 1]])
+
+        arrays = [np.full((2,), i, dtype=np.float32) for i in range(4)]
+        it = chainer.iterators.SerialIterator(arrays, 2, shuffle=False)
+        record_batches(it, self.prefix, 2)
+        replay = ReplayIterator(self.prefix)
+        replay.next()
+        np.testing.assert_array_equal(replay.next(), [[2, 2], [3, 3]])
+
+    def test_stop_iteration(self):
+        dataset = _make_dataset(8)
+        it = chainer.iterators.SerialIterator(
+            dataset, 4, repeat=False, shuffle=False)
+        self.assertEqual(record_batches(it, self.prefix, 5), 2)
+        replay = ReplayIterator(self.prefix, repeat=False)
+        self.assertEqual(len(list(replay)), 2)
+
+    def test_different_shape(self):
+        dataset = _make_dataset(6)
+        it = chainer.iterators.SerialIterator(
+            dataset, 4, repeat=False, shuffle=False)
+        with self.assertRaises(ValueError):
+            record_batches(it, self.prefix, 2)
+
+    def test_invalid_n_batches(self):
+        it = chainer.iterators.SerialIterator(_make_dataset(4), 2)
+        with self.assertRaises(ValueError):
+            record_batches(it, self.prefix, 0)
+
+    def test_serialize(self):
+        it = chainer.iterators.SerialIterator(_make_dataset(8), 2)
+        record_batches(it, self.prefix, 4)
+        replay = ReplayIterator(self.prefix)
+        replay.next()
+        target = {}
+        replay.serialize(chainer.serializers.DictionarySerializer(target))
+        replay2 = ReplayIterator(self.prefix)
+        replay2.serialize(chainer.serializers.NpzDeserializer(target))
+        self.assertEqual(replay2.current_position, 1)
+        np.testing.assert_array_equal(replay2.next()[0], replay.next()[0])
@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+
+from chainer_profutil import StackSampler
+from chainer_profutil.profiled_optimizer import time_range
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def _build_graph():
+    _busy(0.2)
+
+
+class TestStackSampler(unittest.TestCase):
+    def test_tag_with_ranges(self):
+        with StackSampler(interval=0.001) as sampler:
+            with time_range('iteration'):
+                with time_range('model.forward'):
+                    _build_graph()
+        self.assertGreater(sampler.n_samples, 0)
+
+        lines = sampler.collapsed().splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        forward = [line for line in lines
+                   if line.startswith('[iteration];[model.forward];')]
+        self.assertTrue(forward)
+        self.assertTrue(any('_build_graph (test_sampler.py:' in line
+                            for line in forward))
+        # Frames are ordered outermost first.
+        for line in forward:
+            frames = line.rsplit(' ', 1)[0].split(';')
+            if any(f.startswith('_busy') for f in frames):
+                self.assertTrue(frames[-1].startswith('_busy'))
+
+    def test_sample_other_thread(self):
+        done = threading.Event()
+
+        def target():
+            with time_range('batch.prefetch'):
+                while not done.is_set():
+                    _busy(0.01)
+
+        thread = threading.Thread(target=target)
+        thread.start()
+        try:
+            sampler = StackSampler(interval=0.001,
+                                   thread_ids=[thread.ident])
+            with sampler:
+                time.sleep(0.1)
+        finally:
+            done.set()
+            thread.join()
+        stacks = sampler.counts()
+        self.assertTrue(stacks)
+        self.assertTrue(all(stack.startswith('[batch.prefetch];')
+                            for stack in stacks))
+        # The sampler thread itself is not sampled.
+        self.assertFalse(any('(sampler.py:' in stack for stack in stacks))
+
+        sampler.clear()
+        self.assertEqual(sampler.counts(), {})
+        self.assertEqual(sampler.n_samples, 0)
+
+    def test_max_depth(self):
+        with StackSampler(interval=0.001, max_depth=2) as sampler:
+            _busy(0.05)
+        for stack in sampler.counts():
+            self.assertLessEqual(len(stack.split(';')), 2)
+
+    def test_fail_on_double_start(self):
+        sampler = StackSampler()
+        with sampler:
+            with self.assertRaises(RuntimeError):
+                sampler.start()
+
+    def test_fail_on_invalid_interval(self):
+        with self.assertRaises(ValueError):
+            StackSampler(interval=0)
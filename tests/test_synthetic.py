@@ -0,0 +1,82 @@
+import unittest
+
+import numpy as np
+
+import chainer
+from chainer import training
+
+from chainer_profutil import SyntheticConverter
+from chainer_profutil import SyntheticIterator
+
+
+class TestSyntheticIterator(unittest.TestCase):
+    def test_same_batch(self):
+        it = SyntheticIterator(4, (3, 8, 8), n_classes=10)
+        x, t = it.next()
+        self.assertEqual(x.shape, (4, 3, 8, 8))
+        self.assertEqual(x.dtype, np.float32)
+        self.assertEqual(t.shape, (4,))
+        self.assertEqual(t.dtype, np.int32)
+        self.assertTrue(((0 <= t) & (t < 10)).all())
+        for _ in range(3):
+            x2, t2 = it.next()
+            self.assertIs(x2, x)
+            self.assertIs(t2, t)
+        self.assertFalse(x.flags.writeable)
+
+    def test_dtype(self):
+        it = SyntheticIterator(2, (5,), dtype=np.float16)
+        self.assertEqual(it.next()[0].dtype, np.float16)
+
+    def test_epoch(self):
+        it = SyntheticIterator(4, (2,), n_examples=10)
+        self.assertIsNone(it.previous_epoch_detail)
+        it.next()
+        self.assertEqual(it.epoch, 0)
+        self.assertAlmostEqual(it.epoch_detail, 0.4)
+        self.assertAlmostEqual(it.previous_epoch_detail, 0.)
+        self.assertFalse(it.is_new_epoch)
+        it.next()
+        it.next()
+        self.assertEqual(it.epoch, 1)
+        self.assertTrue(it.is_new_epoch)
+        self.assertAlmostEqual(it.previous_epoch_detail, 0.8)
+
+    def test_no_repeat(self):
+        it = SyntheticIterator(4, (2,), n_examples=8, repeat=False)
+        self.assertEqual(len(list(it)), 2)
+        it.reset()
+        self.assertEqual(len(list(it)), 2)
+
+    def test_serialize(self):
+        it = SyntheticIterator(4, (2,), n_examples=10)
+        for _ in range(3):
+            it.next()
+        target = {}
+        it.serialize(chainer.serializers.DictionarySerializer(target))
+        it2 = SyntheticIterator(4, (2,), n_examples=10)
+        it2.serialize(chainer.serializers.NpzDeserializer(target))
+        self.assertEqual(it2.epoch, it.epoch)
+        self.assertAlmostEqual(it2.epoch_detail, it.epoch_detail)
+
+    def test_invalid_batch_size(self):
+        with self.assertRaises(ValueError):
+            SyntheticIterator(0, (2,))
+
+
+class TestSyntheticConverter(unittest.TestCase):
+    def test_cpu(self):
+        it = SyntheticIterator(2, (3,))
+        batch = it.next()
+        self.assertIs(SyntheticConverter()(batch), batch)
+
+    def test_training(self):
+        model = chainer.links.Classifier(chainer.links.Linear(3, 4))
+        optimizer = chainer.optimizers.SGD()
+        optimizer.setup(model)
+        it = SyntheticIterator(2, (3,), n_classes=4)
+        updater = training.updaters.StandardUpdater(
+            it, optimizer, converter=SyntheticConverter())
+        trainer = training.Trainer(updater, (5, 'iteration'))
+        trainer.run()
+        self.assertEqual(optimizer.t, 5)
@@ -0,0 +1,123 @@
+import time
+import unittest
+
+import numpy as np
+
+import chainer
+import chainer.functions as F
+import chainer.links as L
+from chainer import optimizers
+from chainer.training import updaters
+
+from chainer_profutil import PrefetchingUpdater
+from chainer_profutil import StagingConverter
+
+
+class _SlowDataset(chainer.dataset.DatasetMixin):
+    def __init__(self, n, delay):
+        rng = np.random.RandomState(0)
+        self._x = rng.randn(n, 4).astype(np.float32)
+        self._t = rng.randint(0, 3, size=n).astype(np.int32)
+        self._delay = delay
+
+    def __len__(self):
+        return len(self._x)
+
+    def get_example(self, i):
+        time.sleep(self._delay)
+        return self._x[i], self._t[i]
+
+
+class _CheckingModel(chainer.Chain):
+    # It records whether its input was overwritten while it was used.
+
+    def __init__(self):
+        super(_CheckingModel, self).__init__()
+        with self.init_scope():
+            self.fc = L.Linear(4, 3)
+        self.n_overwritten = 0
+
+    def forward(self, x, t):
+        expected = x.copy()
+        loss = F.softmax_cross_entropy(self.fc(x), t)
+        # Let the background thread convert the following batches.
+        time.sleep(0.02)
+        if not np.array_equal(x, expected):
+            self.n_overwritten += 1
+        return loss
+
+
+def _make_updater(updater_class, dataset, **kwargs):
+    np.random.seed(0)
+    model = L.Classifier(L.Linear(4, 3))
+    optimizer = optimizers.SGD(lr=0.1)
+    optimizer.setup(model)
+    iterator = chainer.iterators.SerialIterator(
+        dataset, 4, shuffle=False, **kwargs)
+    return updater_class(iterator, optimizer), model
+
+
+class TestPrefetchingUpdater(unittest.TestCase):
+    def test_same_result_as_standard_updater(self):
+        dataset = _SlowDataset(10, 0)
+        expected_updater, expected = _make_updater(
+            updaters.StandardUpdater, dataset)
+        updater, model = _make_updater(PrefetchingUpdater, dataset)
+        for _ in range(6):
+            expected_updater.update()
+            updater.update()
+            self.assertEqual(updater.epoch, expected_updater.epoch)
+            self.assertEqual(updater.epoch_detail,
+                             expected_updater.epoch_detail)
+            self.assertEqual(updater.previous_epoch_detail,
+                             expected_updater.previous_epoch_detail)
+            self.assertEqual(updater.is_new_epoch,
+                             expected_updater.is_new_epoch)
+        updater.finalize()
+        np.testing.assert_allclose(
+            model.predictor.W.array, expected.predictor.W.array)
+
+    def test_overlap_batch_preparation(self):
+        updater, model = _make_updater(
+            PrefetchingUpdater, _SlowDataset(40, 0.005))
+        updater.update()
+        # The next batches are prepared while the loop is busy.
+        time.sleep(0.1)
+        self.assertGreater(
+            updater.get_iterator('main').current_position, 4)
+        self.assertAlmostEqual(updater.epoch_detail, 0.1)
+        updater.update()
+        updater.finalize()
+        self.assertEqual(updater.iteration, 2)
+
+    def test_reused_buffers_not_overwritten(self):
+        depth = 1
+        model = _CheckingModel()
+        optimizer = optimizers.SGD(lr=0.1)
+        optimizer.setup(model)
+        iterator = chainer.iterators.SerialIterator(
+            _SlowDataset(40, 0), 4, shuffle=False)
+        converter = StagingConverter(n_buffers=depth + 2)
+        updater = PrefetchingUpdater(iterator, optimizer,
+                                     converter=converter, depth=depth)
+        for _ in range(10):
+            updater.update()
+        updater.finalize()
+        self.assertEqual(model.n_overwritten, 0)
+        # All buffers have been used in turn.
+        self.assertEqual(converter.n_allocations, 2 * (depth + 2))
+
+    def test_stop_iteration(self):
+        updater, _ = _make_updater(
+            PrefetchingUpdater, _SlowDataset(8, 0), repeat=False)
+        updater.update()
+        updater.update()
+        with self.assertRaises(StopIteration):
+            updater.update()
+        updater.finalize()
+
+    def test_fail_on_invalid_depth(self):
+        with self.assertRaises(ValueError):
+            _make_updater(
+                lambda it, opt: PrefetchingUpdater(it, opt, depth=0),
+                _SlowDataset(8, 0))
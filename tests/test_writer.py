@@ -0,0 +1,123 @@
+
+
+import io
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import unittest
+
+from chainer_profutil import AsyncEventWriter
+from chainer_profutil.profiled_optimizer import _range_listeners
+from chainer_profutil.profiled_optimizer import time_range
+
+
+class _BlockingFile(io.StringIO):
+    def __init__(self):
+        super(_BlockingFile, self).__init__()
+        self.entered = threading.Event()
+        self.release = threading.Event()
+
+    def write(self, s):
+        if s.startswith('{'):
+            self.entered.set()
+            self.release.wait()
+        return super(_BlockingFile, self).write(s)
+
+    def close(self):
+        pass
+
+
+class TestAsyncEventWriter(unittest.TestCase):
+    def test_write_trace_events(self):
+        out = io.StringIO()
+        with AsyncEventWriter(out, batch_size=2, signals=()) as writer:
+            self.assertIn(writer, _range_listeners)
+            with time_range('iteration'):
+                with time_range('model.forward'):
+                    pass
+                with time_range('model.backward'):
+                    pass
+            writer.flush()
+            self.assertEqual(writer.written, 3)
+        self.assertNotIn(writer, _range_listeners)
+
+        events = json.loads(out.getvalue())
+        self.assertEqual([e['name'] for e in events],
+                         ['model.forward', 'model.backward', 'iteration'])
+        for e in events:
+            self.assertEqual(e['ph'], 'X')
+            self.assertGreaterEqual(e['dur'], 0.0)
+
+    def test_drop_when_queue_is_full(self):
+        out = _BlockingFile()
+        writer = AsyncEventWriter(out, max_queue=1, policy='drop',
+                                  signals=())
+        writer.attach()
+        writer.put(('a', 0.0, 1.0, 0))
+        out.entered.wait()
+        writer.put(('b', 1.0, 2.0, 0))
+        writer.put(('c', 2.0, 3.0, 0))
+        self.assertEqual(writer.dropped, 1)
+        out.release.set()
+        writer.close()
+
+        events = json.loads(out.getvalue())
+        self.assertEqual([e['name'] for e in events], ['a', 'b'])
+
+    def test_sample_when_queue_is_half_full(self):
+        out = _BlockingFile()
+        writer = AsyncEventWriter(out, max_queue=4, policy='sample',
+                                  sample_interval=2, signals=())
+        writer.attach()
+        writer.put(('a', 0.0, 1.0, 0))
+        out.entered.wait()
+        for name in 'bcdefg':
+            writer.put((name, 0.0, 1.0, 0))
+        out.release.set()
+        writer.close()
+
+        names = [e['name'] for e in json.loads(out.getvalue())]
+        # 'b' and 'c' fill half of the queue, then every 2nd event is kept.
+        self.assertEqual(names, ['a', 'b', 'c', 'e', 'g'])
+        self.assertEqual(writer.dropped, 2)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGTERM') and os.name == 'posix',
+                         'SIGTERM is required.')
+    def test_flush_on_signal(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'trace.json')
+            script = textwrap.dedent('''
+                import os
+                import signal
+                import sys
+                import time
+                from chainer_profutil import AsyncEventWriter
+                from chainer_profutil.profiled_optimizer import time_range
+                AsyncEventWriter(sys.argv[1]).attach()
+                for _ in range(3):
+                    with time_range('x'):
+                        pass
+                os.kill(os.getpid(), signal.SIGTERM)
+                time.sleep(10)
+                ''')
+            proc = subprocess.run([sys.executable, '-c', script, path],
+                                  timeout=60)
+            self.assertEqual(proc.returncode, 128 + signal.SIGTERM)
+            with open(path) as f:
+                events = json.load(f)
+            self.assertEqual([e['name'] for e in events], ['x'] * 3)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+class TestAsyncEventWriterError(unittest.TestCase):
+    def test_fail_on_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            AsyncEventWriter(io.StringIO(), policy='unknown')